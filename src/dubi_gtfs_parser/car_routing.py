@@ -1,4 +1,4 @@
-from utils import BinarySearchIdx, time_text_to_int, get_some_items, time_int_to_text, FOOTPATH_ID, CAR_ROUTE_ID, is_footpath, bus_line_from_trip_id
+from utils import BinarySearchIdx, time_text_to_int, time_to_int, get_some_items, time_int_to_text, FOOTPATH_ID, CAR_ROUTE_ID, is_footpath, bus_line_from_trip_id
 from connection_builder import Connection, Timetable, get_tlv_timetable
 from display import display_connections, display_visited_stations, display_RaptorResult, display_stations
 import time
@@ -168,6 +168,7 @@ def build_connections_for_car_route(tt, start_loc, end_loc, start_time, deviatio
     # This does the affected changes on the timetable.
     """
 
+    start_time = time_to_int(start_time)
     # First i need to add a stations for the start_loc and end_loc
     start_station = tt._create_walking_station(start_loc, "car_start")
     end_station = tt._create_walking_station(end_loc, "car_end")
@@ -177,15 +178,38 @@ def build_connections_for_car_route(tt, start_loc, end_loc, start_time, deviatio
         trip_id = CAR_ROUTE_ID + "_" + str(i)
         tt.trips[trip_id] = tt.trips[CAR_ROUTE_ID]  
 
-        c = Connection(start_station["station_id"], s[0]["station_id"], start_time,  time_int_to_text(time_text_to_int(start_time)+ s[1]), trip_id)
+        c = Connection(start_station["station_id"], s[0]["station_id"], start_time, start_time + s[1], trip_id)
         tt.station_connections[start_station["station_id"]].append(c)
 
-        c2 = Connection(s[0]["station_id"], end_station["station_id"], time_int_to_text(time_text_to_int(start_time)+ s[1]),
-                         time_int_to_text(time_text_to_int(start_time) + s[1] + s[2]), trip_id)
+        c2 = Connection(s[0]["station_id"], end_station["station_id"], start_time + s[1],
+                         start_time + s[1] + s[2], trip_id)
         tt.station_connections[end_station["station_id"]].append(c2)
     # display_connections(tt, tt.station_connections[start_station["station_id"]])
     return valid_stations
 
+def get_car_route_sources(tt, start_loc, end_loc, start_time, deviation=60*5, debug=False, return_deviations=False):
+    """
+    Stations the car can drop us at on its way, as raptor_route sources (see RaptorRouter.semi_ultra_route car_sources).
+    Unlike build_connections_for_car_route nothing is added to the timetable - no car stations, connections or trips,
+    so a car query is routed like a walking one no matter how many stations the car passes.
+    The car leaves start_loc (where the query starts) at start_time.
+    * return_deviations - also return how many seconds dropping us at each station adds to the driver's fastest route
+    * return - station_id -> arrival time (int seconds) of the car at the station,
+        and station_id -> deviation seconds if return_deviations
+    """
+    start_time = time_to_int(start_time)
+    sources = {}
+    deviations = {}
+    min_time = get_faster_car_route(tt, start_loc, end_loc)[0] if return_deviations else 0
+    for station, time_from_start, time_to_end in get_passable_stations(tt, start_loc, end_loc, deviation=deviation, debug=debug):
+        arrival_time = start_time + time_from_start
+        if station["station_id"] not in sources or arrival_time < sources[station["station_id"]]:
+            sources[station["station_id"]] = arrival_time
+            deviations[station["station_id"]] = max(time_from_start + time_to_end - min_time, 0)
+    if return_deviations:
+        return sources, deviations
+    return sources
+
 ############################################################
 ### TEST Car           ####################################
 ############################################################
@@ -1,17 +1,30 @@
 from parse_gtfs import get_is_gtfs, get_is_tlv_gtfs, GTFS
-from utils import ARTIFACTS_FOLDER, FOOTPATH_ID, is_footpath, is_car_route, get_some_items, print_log, error_log_to_file, load_artifact, save_artifact, decode_polyline, BinarySearchIdx, degrees_to_meters, further_than_length
+from utils import ARTIFACTS_FOLDER, FOOTPATH_ID, is_footpath, is_car_route, get_some_items, print_log, error_log_to_file, load_artifact, save_artifact, decode_polyline, BinarySearchIdx, degrees_to_meters, further_than_length, time_int_to_text
 from display import display_connections, display_all_gtfs_stations, display_stations, display_connections
 import os
+import sys
 import math
+import threading
+from array import array
 from codetiming import Timer
 from valhalla_interface import get_actor 
+from route_patterns import build_route_patterns
+from station_index import SearchableStations, DenseStations, StationsDict
+from gtfs_tables import MISSING_VALUE
+from footpath_pipeline import TLV_FOOTPATH_STORE
 
 IS_GTFS_FOLDER = "../is_gtfs"
 TLV_TIMETABLE_OBJ = os.path.join(ARTIFACTS_FOLDER, "tlv_timetable_obj.obj")
 
+# Queries (see query_timetable.py) only read a timetable, except for the caches it builds on first use - station departures,
+# route patterns, dense stations, service days, a store's connections. Those are built under this lock, so a timetable
+# can be shared by queries running in threads. A module lock and not one per timetable, timetables are pickled.
+SHARED_CACHES_LOCK = threading.RLock()
 
 
-class SearchableStations(object):
+
+class BucketSearchableStations(object):
+    # The first stations index, replaced by the grid index in station_index.py (SearchableStations). Kept for benchmarks.
     # Right now stations are grouped by id. i want to craete a stations array sorted by X, so it is searchable.
     # For maximum searchability, i will group each 100 meters of X into a bucket, which will later be sorted by Y value
     # TODO: make some expiriments and see how different bucket size affects search time
@@ -127,23 +140,96 @@ class SearchableStations(object):
 # - arrival time
 # - trip id (trip is a sequence of connections)
 class Connection(object):
-    def __init__(self, departure_stop, arrival_stop, departure_time, arrival_time, trip_id):
+    # One of these exists for every pair of following stops in the feed, so keep them small - no __dict__,
+    # and build them with shared objects: station ids from tt.stations, one trip_id string per trip and one int per distinct time (see SharedInts).
+    __slots__ = ("departure_stop", "arrival_stop", "departure_time", "arrival_time", "trip_id", "trip_index", "shapes")
+
+    def __init__(self, departure_stop, arrival_stop, departure_time, arrival_time, trip_id, trip_index=None):
         self.departure_stop = departure_stop #  stop id
         self.arrival_stop = arrival_stop # stop id
-        if type(departure_time) != str or type(arrival_time) != str:
-            raise AssertionError("departure_time and arrival_time should be strings")
-        self.departure_time = departure_time # in text format hh:mm:ss
-        self.arrival_time = arrival_time # in text format hh:mm:ss
+        if type(departure_time) != int or type(arrival_time) != int:
+            raise AssertionError("departure_time and arrival_time should be ints")
+        self.departure_time = departure_time # in seconds from the start of the service day, can be past 24:00:00
+        self.arrival_time = arrival_time # in seconds from the start of the service day, can be past 24:00:00
         self.trip_id = trip_id
+        # position of the connection in tt.trip_connections[trip_id], None for connections which are not part of a trip (walking, car)
+        # and for connections of timetables pickled before it was added - follow_trip falls back to searching the trip for those.
+        self.trip_index = trip_index
         self.shapes = None
         # self.shapes = shapes # this is used to represent the connection on a map. 
+
+    def __getstate__(self):
+        return (self.departure_stop, self.arrival_stop, self.departure_time, self.arrival_time, self.trip_id, self.trip_index, self.shapes)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before Connection had __slots__
+            state = (state["departure_stop"], state["arrival_stop"], state["departure_time"], state["arrival_time"], state["trip_id"],
+                     state.get("trip_index"), state.get("shapes"))
+        self.departure_stop, self.arrival_stop, self.departure_time, self.arrival_time, self.trip_id, self.trip_index, self.shapes = state
+
     def __repr__(self):
-        return f"Connection({self.departure_stop}, {self.arrival_stop}, {self.departure_time}, {self.arrival_time}, {self.trip_id})"
+        return f"Connection({self.departure_stop}, {self.arrival_stop}, {time_int_to_text(self.departure_time)}, {time_int_to_text(self.arrival_time)}, {self.trip_id})"
+
+def _same_connection(c1, c2):
+    # the same connection of a trip, even if they are not the same object
+    return c1.trip_id == c2.trip_id and c1.departure_stop == c2.departure_stop and c1.departure_time == c2.departure_time
+
+class SharedInts(dict):
+    # Python makes a new int object (28 bytes) for every parsed time, share one per distinct value instead.
+    def __missing__(self, value):
+        self[value] = value
+        return value
+
+class TripView(object):
+    """
+    Read only view of connections[start:stop] of a trip, without copying the list.
+    follow_trip returns these, and slicing a view gives another view, so following a trip and keeping
+    the leading connections of a station (RVisidetStation) doesn't allocate a list per boarded trip.
+    """
+    __slots__ = ("connections", "start", "stop")
+
+    def __init__(self, connections, start=0, stop=None):
+        self.connections = connections
+        self.start = start
+        self.stop = len(connections) if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.stop - self.start)
+            if step != 1:
+                return list(self)[i]
+            return TripView(self.connections, self.start + start, self.start + max(start, stop))
+        if i < 0:
+            i += self.stop - self.start
+        if i < 0 or i >= self.stop - self.start:
+            raise IndexError("TripView index out of range")
+        return self.connections[self.start + i]
+
+    def __iter__(self):
+        connections = self.connections
+        for i in range(self.start, self.stop):
+            yield connections[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (TripView, list)):
+            return len(self) == len(other) and all(a is b or a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
 
 class Timetable(object):
     # timetable is a list of connections, sorted by departure time
     # Each stop has a list of connections that depart from it, sorted by departure time
-    def __init__(self, gtfs):
+    def __init__(self, gtfs, build_footpaths=True, footpath_store=None, footpath_workers=1):
+        """
+        @build_footpaths - find footpaths between stations (slow, uses valhalla). Without them stations_footpaths is empty.
+        @footpath_store, footpath_workers - see build_station_footpaths
+        """
         # self.timetable = []
         self.station_connections = {}
         self.trip_connections = {}
@@ -152,14 +238,14 @@ class Timetable(object):
         self._walking_station_id = 0
 
         # Just copy stations and trips from gtfs
-        self.stations = gtfs.stations
+        self.stations = StationsDict(gtfs.stations)
         self.trips = gtfs.trips
      
         self.shapes = gtfs.shapes
         self.gtfs_instance = gtfs
         self.searchable_stations = SearchableStations(self.stations.values(),)
         self._build_timetable(gtfs)
-        self.stations_footpaths = self.build_station_footpaths()
+        self.stations_footpaths = self.build_station_footpaths(workers=footpath_workers, footpath_store=footpath_store) if build_footpaths else {}
 
         
     def _create_walking_station(self, station_lon_lat, name="Walking"):
@@ -188,107 +274,42 @@ class Timetable(object):
             decoded_shapes.append({ 'shape_pt_lon' : shape[0], 'shape_pt_lat' :shape[1], 'shape_id' : connection.trip_id, 'shape_pt_sequence' : i+1})
         connection.shapes = decoded_shapes
     
-    def build_station_footpaths(self, nearby_station_radius=1000, max_walking_distance = 1.2):
+    def build_station_footpaths(self, nearby_station_radius=1000, max_walking_distance = 1.2, workers=1, footpath_store=None, walking_engine=None):
         '''
         This is a preprocessing step for the timetable.
         In here we will create footpath connections between stations that are close to each other.
         This will be saved in a special filed as a dict by station, and will be used in RAPTOR in the "Relax footpath" phase.
-        In order to get results in a sensible time, limit search radius to 'nearby_station_radium'.
-        In production we can enlarge this.
         How we will do it - 
-        For each station, We will use SearchableStation class to find nearby stations, and use Valhalla one-to-many API to find walking paths between them.
+        Stations are split to tiles of 'nearby_station_radius' meters, and for each tile we use Valhalla many-to-many API
+        from its stations to all stations in walking distance of them (see footpath_pipeline.py).
         In concept this preprocessing saves me from the need later to run this on every station every query.
         
         * max_walking_distance - in KM, because this is how results from valhalla return
+        * workers - number of processes running tiles, each with its own valhalla actor
+        * footpath_store - folder to write finished tiles to. A run which crashed (the full reparse used to die with a memory error here)
+          continues from the tiles it finished. None - keep everything in memory.
+        * walking_engine - walk with this instead of valhalla, e.g. an offline pedestrian_graph.PedestrianGraph
         '''
-
-        # Note that also here i want to save time sending batches to valhalla, so for each station i will take all of the station in 1 km radius, then find many to many on a  2 KM radius.
-        DEFAULT_MAX_FACTOR = 15
-        DEFAULT_MAX_STATION_MATRIX_SIZE = 1200
-        # current_max_factor = DEFAULT_MAX_FACTOR
-        # This is the result. station -> [(station, path)]
-        station_to_station_footpaths = {}
-        # remaining_stations = self.stations.copy()
-        # le'ts just go station by station
-        it = iter(self.stations.values())
-        station, at_end = next(it,""), object()
-        while station is not at_end:
-            if station['station_id'] in station_to_station_footpaths:
-                # We already did this station with some other batch
-                station = next(it, at_end)
-                continue
-            # initiate to empty list 
-            # station_to_station_footpaths[station["station_id"]] = []
-
-            # Find nearby stations
-            # originally it was 1 and 2, but my PC couldn't carry it so i lower it so /2 and 1.5
-            factor = 1
-            batch_stations  = []
-            batch_stations = self.searchable_stations.search_nearby_stations(station, nearby_station_radius / factor)
-            nearby_stations = self.searchable_stations.search_nearby_stations(station, nearby_station_radius + nearby_station_radius / factor)
-            
-            while len(batch_stations) * len(nearby_stations) > DEFAULT_MAX_STATION_MATRIX_SIZE and factor < DEFAULT_MAX_FACTOR: 
-                # The larger the factor the less stations i will get in a batch, so the entire search will be slower but will require less memory.
-                # Using max factor of 
-                factor +=1
-                nearby_stations = self.searchable_stations.search_nearby_stations(station, nearby_station_radius + nearby_station_radius / factor)
-                batch_stations = self.searchable_stations.search_nearby_stations(station, nearby_station_radius / factor)
-            
-
-            batch_stations_as_locations = [{"lat": s["stop_lat"], "lon": s["stop_lon"]} for s in batch_stations]
-            nearby_stations_as_locations = [{"lat": s["stop_lat"], "lon": s["stop_lon"]} for s in nearby_stations]
-            
-            actor = get_actor(self)
-            query = {"sources" :batch_stations_as_locations, "targets": nearby_stations_as_locations, "costing": "pedestrian"}
-            print(f"[+] parsing query - {len(batch_stations_as_locations), len(nearby_stations_as_locations)}")
-            source_footpath_connections = []
-            # try: I tried to do incremental factoring here but it crashed python, apparently catching memory error is not viable.
-            source_footpath_connections = actor.matrix(query)
-            # except MemoryError as e:
-            #     print(f"Memory error - {e} with factor of {current_max_factor}, increasing factor")
-            #     current_max_factor = current_max_factor * 2
-            #     continue
-                # raise e
-            # except Exception as e:
-            #     # print(f"Error - {e} with factor of {current_max_factor}, increasing factor")
-            #     # print(f"Error - {dir(e)}")
-            #     raise e
-            # # finally:
-            # #     print(f"Finished with factor of {current_max_factor}")
-
-                # Continue without increasing the iterator
-            for i, st in enumerate(batch_stations):
-                footpaths = []
-                for f in source_footpath_connections['sources_to_targets'][i]:
-                    if f["distance"] > max_walking_distance or nearby_stations[f["to_index"]]["station_id"] == st["station_id"]:
-                        continue
-                    footpaths.append({"station_id": nearby_stations[f["to_index"]]["station_id"], "distance": f["distance"], "time": f["time"]})
-                
-                # Sort by walking time 
-                station_to_station_footpaths[st["station_id"]] = sorted(footpaths, key=lambda x: x["time"])             
-                #sts = [self.stations[fp["station_id"]] for fp in footpaths]
-                #display_station_footpaths(self, st, footpaths)
-                #display_stations(self, sts)
-
-            # Advance the iterator to the next station
-            station = next(it, at_end)
-            # Reset factor to default value
-            current_max_factor = DEFAULT_MAX_FACTOR
+        from footpath_pipeline import build_footpaths
+        footpaths = build_footpaths(self.stations.values(), footpath_store, tile_size=nearby_station_radius,
+                                    max_walking_distance=max_walking_distance, workers=workers, walking_engine=walking_engine)
         print("finished finding footpaths between stations!")
-        return station_to_station_footpaths
+        return footpaths
 
 
     def _build_timetable(self, gtfs):
         # A connection is besically two following stations, so each pair of stops will be a connection.
         # Pretty easy.
         # First i will make the connections, then i will attribute them to the stops 
+        times = SharedInts()
         for trip_id, trip_stops in gtfs.stop_times.items():
             self.trip_connections[trip_id] = []
             prev_stop = trip_stops[0]
             for stop in trip_stops[1:]:
                 # At this point we count on trip_stops to be sorted by stop_sequence and departure time.
                 # Get the set of shapes that represent this connection
-                connection = Connection(prev_stop["station_id"], stop["station_id"], prev_stop["departure_time"], stop["arrival_time"], trip_id)
+                connection = Connection(prev_stop["station_id"], stop["station_id"], times[prev_stop["departure_time"]], times[stop["arrival_time"]], trip_id,
+                                        len(self.trip_connections[trip_id]))
                 # Add connection to the previous stop.
                 if prev_stop["station_id"] not in self.station_connections:
                     self.station_connections[prev_stop["station_id"]] = []
@@ -308,24 +329,103 @@ class Timetable(object):
             self.station_connections[station_id] = sorted(self.station_connections[station_id], key=lambda x: x.departure_time) 
         print(f"got {len(self.stations)} stations, out of them {len(self.station_connections)} with connections")
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if getattr(state.get("searchable_stations"), "incomplete", False):
+            # pickled with the old bucket index, which lost stations - index them all from the pickled stations
+            self.searchable_stations = SearchableStations(self.stations.values())
+
+    def for_service_date(self, service_date):
+        """
+        Returns a timetable with only the trips which run on service_date (see service_days.py).
+        @service_date - datetime.date or "YYYYMMDD" text
+        Recently used days are cached on the timetable.
+        """
+        # imported here because service_days imports this module
+        from service_days import ServiceDayCache
+        with SHARED_CACHES_LOCK:
+            if getattr(self, "_service_days", None) is None:
+                self._service_days = ServiceDayCache(self)
+            return self._service_days.get(service_date)
+
+    def for_query(self):
+        """
+        Returns a timetable for one query (see query_timetable.py) - the query's walking / car route stations, connections
+        and trips are added to it, and this timetable isn't changed, so it can be shared by queries running at the same time.
+        """
+        # imported here because query_timetable imports this module
+        from query_timetable import QueryTimetable
+        return QueryTimetable(self)
+
+    def get_route_patterns(self):
+        """
+        Trips grouped by stop sequence into trips x stops matrices (see route_patterns.py), built on first use and kept.
+        """
+        if getattr(self, "_route_patterns", None) is None:
+            with SHARED_CACHES_LOCK:
+                if getattr(self, "_route_patterns", None) is None:
+                    with Timer(text="[+] building route patterns took {:.4f} seconds..."):
+                        self._route_patterns = build_route_patterns(self.trip_connections)
+                    print_log(self._route_patterns)
+        return self._route_patterns
+
+    def get_dense_stations(self):
+        """
+        Dense int ids, coordinates and matrix locations of the stations (see station_index.DenseStations), built on first use and kept.
+        Use it to map matrix results (indices) to stations instead of list(self.stations.values()).
+        """
+        with SHARED_CACHES_LOCK:
+            if getattr(self, "_dense_stations", None) is None:
+                if not isinstance(self.stations, StationsDict):
+                    # pickled before stations counted their changes
+                    self.stations = StationsDict(self.stations)
+                self._dense_stations = DenseStations(self.stations)
+            return self._dense_stations.sync()
+
+    def get_station_departures(self, station_id):
+        """
+        Sorted int array of the departure times of station_connections[station_id], same order as the list.
+        Boarding is a bisect_left on it, and the connections are then iterated by index range, so a marked station
+        doesn't parse times or copy the tail of its list.
+        Built on first use and kept, rebuilt if the station's list was replaced or grew (a query's walking / car connections).
+        """
+        # self.__dict__ and not getattr - a ServiceDayTimetable must not use its base timetable's arrays
+        station_departures = self.__dict__.get("_station_departures")
+        connections = self.station_connections[station_id]
+        cached = None if station_departures is None else station_departures.get(station_id)
+        if cached is None or cached[0] is not connections or len(cached[1]) != len(connections):
+            with SHARED_CACHES_LOCK:
+                station_departures = self.__dict__.get("_station_departures")
+                if station_departures is None:
+                    station_departures = self._station_departures = {}
+                cached = station_departures[station_id] = (connections, array("i", [c.departure_time for c in connections]))
+        return cached[1]
+
     def follow_trip(self, connection, toConnection=False):
-        # Receive a connection, and return a list of FOLLOWING connections that are in the same trip
+        # Receive a connection, and return the FOLLOWING connections that are in the same trip (a TripView, not a copy)
         # The list will be sorted by departure time
-        if connection.trip_id not in self.trip_connections:
+        # toConnection - return the connections of the trip up to (and including) this connection instead
+        trip_connections = self.trip_connections.get(connection.trip_id)
+        if trip_connections is None:
             if not is_footpath(connection.trip_id) and not is_car_route(connection.trip_id):
                 # For now this should only be valid for footpaths
                 raise AssertionError("Trip id not found in trip connections")
             return [connection]
         
-        trip_connections = self.trip_connections[connection.trip_id]
-        # Find where this connection is placed in the trip
-        # TODO: Change this to binary search
-        connection_index = trip_connections.index(connection)
+        # Find where this connection is placed in the trip - connections know their position,
+        # search only for connections without one (old pickles) or ones which are not the trip's own objects.
+        # A timetable store may hand out a new object for the same connection once it dropped its cache, that one is at trip_index too.
+        connection_index = connection.trip_index
+        if connection_index is None or connection_index >= len(trip_connections) or \
+            (trip_connections[connection_index] is not connection and not _same_connection(trip_connections[connection_index], connection)):
+            connection_index = trip_connections.index(connection)
+            if trip_connections[connection_index] is connection:
+                connection.trip_index = connection_index
         # Return all following trips
         if toConnection:
-            return trip_connections[:connection_index+1]
+            return TripView(trip_connections, 0, connection_index+1)
         else:
-            return trip_connections[connection_index:]
+            return TripView(trip_connections, connection_index)
 
     def match_shapes_to_connections(self, connections):
         # Assume all connections are from the same trip here. 
@@ -363,18 +463,32 @@ class Timetable(object):
                 print(f"stop_times - {stop_times}")
                 raise Exception("Connection does not have shapes!")
 
-def get_tlv_timetable(reparse=False, full_reparse=False):
+def get_tlv_timetable(reparse=False, full_reparse=False, use_store=True):
+    """
+    @use_store - load the memory mapped timetable store (see timetable_store.py) instead of the pickle.
+        The first load of an existing pickle converts it to a store.
+    """
+    # imported here because timetable_store imports this module
+    from timetable_store import TLV_TIMETABLE_STORE, is_timetable_store, load_timetable_store, save_timetable_store
+    if use_store and is_timetable_store(TLV_TIMETABLE_STORE) and not reparse:
+        print_log("loading tlv timetable from store...")
+        return load_timetable_store(TLV_TIMETABLE_STORE, gtfs_loader=get_is_tlv_gtfs)
     if os.path.isfile(TLV_TIMETABLE_OBJ) and not reparse:
         print_log("loading tlv timetable from file...")
-        return load_artifact(TLV_TIMETABLE_OBJ)
+        tt = load_artifact(TLV_TIMETABLE_OBJ)
+        if use_store:
+            save_timetable_store(tt, TLV_TIMETABLE_STORE)
+        return tt
     else:
         print_log("parsing tlv timetable from gtfs...")
         if(full_reparse):
             gtfs = get_is_tlv_gtfs(full_reparse, full_reparse)
         else:
             gtfs = get_is_tlv_gtfs()
-        tt = Timetable(gtfs)
+        # footpaths are the slow part of a reparse, run them on all cores and keep finished tiles in case it crashes
+        tt = Timetable(gtfs, footpath_store=TLV_FOOTPATH_STORE, footpath_workers=os.cpu_count())
         save_artifact(tt, TLV_TIMETABLE_OBJ)
+        save_timetable_store(tt, TLV_TIMETABLE_STORE)
         return tt
 
 
@@ -422,12 +536,174 @@ def test_tlv_timetable():
     display_connections(tt, following_trip)
     print("done!")
 
+def test_follow_trip(num_trips=2000):
+    # follow_trip by the connection's trip_index vs the old trip_connections.index() search
+    tt = get_tlv_timetable()
+    trip_ids = list(tt.trip_connections.keys())[:num_trips]
+    connections = [c for trip_id in trip_ids for c in tt.trip_connections[trip_id]]
+    with Timer(text="[+] follow_trip for " + str(len(connections)) + " connections took {:.4f} seconds..."):
+        for c in connections:
+            tt.follow_trip(c)
+    with Timer(text="[+] index() search for " + str(len(connections)) + " connections took {:.4f} seconds..."):
+        for c in connections:
+            trip_connections = tt.trip_connections[c.trip_id]
+            trip_connections[trip_connections.index(c):]
+    for c in connections:
+        if tt.follow_trip(c)[0] is not c or tt.follow_trip(c, toConnection=True)[-1] is not c:
+            raise AssertionError(f"follow_trip returned the wrong position for {c}")
+    print("[+] follow_trip positions are correct")
+
+def test_station_departures(departure_time="10:00:00", window=60*60):
+    # boarding lookup by key bisect + tail slice vs bisect on the departures array + index range,
+    # following connections which depart in the next window seconds like raptor_route does
+    from bisect import bisect_left, bisect_right
+    from utils import time_text_to_int
+    tt = get_tlv_timetable()
+    t = time_text_to_int(departure_time)
+    stations = list(tt.station_connections.keys())
+    for station_id in stations:
+        tt.get_station_departures(station_id)
+    with Timer(text="[+] key bisect + slice for " + str(len(stations)) + " stations took {:.4f} seconds..."):
+        for station_id in stations:
+            first_connection = BinarySearchIdx(tt.station_connections[station_id], t, key=lambda x: x.departure_time)
+            for c in tt.station_connections[station_id][first_connection:]:
+                if c.departure_time > t + window:
+                    break
+    with Timer(text="[+] departures array + index range for " + str(len(stations)) + " stations took {:.4f} seconds..."):
+        for station_id in stations:
+            connections = tt.station_connections[station_id]
+            departures = tt.get_station_departures(station_id)
+            for i in range(bisect_left(departures, t), bisect_right(departures, t + window)):
+                c = connections[i]
+
+def test_dense_stations(num_extra_stations=30000, num_lookups=2000):
+    # matrix index -> station, list(tt.stations.values())[i] per lookup (the old access walk mapping) vs the dense station ids.
+    # num_extra_stations walking like stations are added first, about the size of the nationwide feed.
+    # Done on a copy of the timetable's stations, the timetable itself isn't changed.
+    stations = StationsDict(get_tlv_timetable().stations)
+    def add_station(i):
+        station_id = "Test_" + str(i)
+        stations[station_id] = {"station_id": station_id, "stop_lon": 34.8, "stop_lat": 32.0 + i * 1e-6, "stop_name": "Test"}
+        return station_id
+    for i in range(num_extra_stations):
+        add_station(i)
+    indices = [i * 7919 % len(stations) for i in range(num_lookups)]
+    with Timer(text="[+] list(tt.stations.values())[i] for " + str(num_lookups) + " lookups took {:.4f} seconds..."):
+        old = [list(stations.values())[i]["station_id"] for i in indices]
+    with Timer(text="[+] building dense stations took {:.4f} seconds..."):
+        dense_stations = DenseStations(stations)
+    with Timer(text="[+] dense stations for " + str(num_lookups) + " lookups took {:.4f} seconds..."):
+        new = [dense_stations.station(i)["station_id"] for i in indices]
+    if old != new:
+        raise AssertionError("dense station ids differ from tt.stations order")
+    version = dense_stations.version
+    locations = dense_stations.locations()
+    add_station(num_extra_stations)
+    dense_stations.sync()
+    if dense_stations.version != version + 1 or len(locations) != len(stations):
+        raise AssertionError("adding a station did not update the dense stations")
+    # one station out and another in - the same number of stations, but not the same ids. The others keep their ids.
+    ids = {station_id: dense_stations.index(station_id) for station_id in stations}
+    removed_station = next(iter(stations))
+    del stations[removed_station]
+    added_station = add_station(num_extra_stations + 1)
+    if dense_stations.index(removed_station) != MISSING_VALUE or dense_stations.station(dense_stations.index(added_station))["station_id"] != added_station or \
+        len(dense_stations) != len(stations) + 1:
+        raise AssertionError("removing and adding a station did not update the dense stations")
+    if any(dense_stations.index(station_id) != idx for station_id, idx in ids.items() if station_id != removed_station):
+        raise AssertionError("removing a station changed the dense ids of other stations")
+    # a removed station which is added again gets its id back, at its new location
+    stations[removed_station] = {"station_id": removed_station, "stop_lon": 34.9, "stop_lat": 32.5, "stop_name": "Test"}
+    if dense_stations.index(removed_station) != ids[removed_station] or dense_stations.locations()[ids[removed_station]]["lat"] != 32.5:
+        raise AssertionError("a station added again did not get its dense id back")
+    print_log(dense_stations)
+
+def connections_memory_report(tt):
+    """
+    Estimate the memory of a timetable's connections - the Connection objects, the ids and times they point to (each distinct object
+    counted once) and the pointers in station_connections / trip_connections lists.
+    returns a dict of byte counts
+    """
+    seen = set()
+    report = {"connections": 0, "objects": 0, "times": 0, "ids": 0, "lists": 0}
+    def count_once(obj, key):
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            report[key] += sys.getsizeof(obj)
+    for connections_dict in (tt.trip_connections, tt.station_connections):
+        for connections in connections_dict.values():
+            report["lists"] += sys.getsizeof(connections)
+            for c in connections:
+                if id(c) in seen:
+                    continue
+                seen.add(id(c))
+                report["connections"] += 1
+                report["objects"] += sys.getsizeof(c)
+                if hasattr(c, "__dict__"):
+                    report["objects"] += sys.getsizeof(c.__dict__)
+                count_once(c.departure_time, "times")
+                count_once(c.arrival_time, "times")
+                count_once(c.departure_stop, "ids")
+                count_once(c.arrival_stop, "ids")
+                count_once(c.trip_id, "ids")
+    report["total"] = report["objects"] + report["times"] + report["ids"] + report["lists"]
+    return report
+
+def print_connections_memory_report(name, report):
+    print_log(f"{name} - {report['connections']} connections, {report['total'] / 2**20:.1f} MB "
+              f"({report['total'] / max(report['connections'], 1):.0f} bytes per connection): "
+              f"objects {report['objects'] / 2**20:.1f} MB, times {report['times'] / 2**20:.1f} MB, ids {report['ids'] / 2**20:.1f} MB, lists {report['lists'] / 2**20:.1f} MB")
+
+class _DictConnection(object):
+    # Connection as it was before __slots__, with a fresh int per parsed time - for the memory report only
+    def __init__(self, c):
+        self.departure_stop = c.departure_stop
+        self.arrival_stop = c.arrival_stop
+        self.departure_time = int(str(c.departure_time))
+        self.arrival_time = int(str(c.arrival_time))
+        self.trip_id = c.trip_id
+        self.trip_index = c.trip_index
+        self.shapes = None
+
+def _dict_connections_copy(tt):
+    # a bare object with the same station / trip lists, of _DictConnections
+    copies = {}
+    def copy(c):
+        if id(c) not in copies:
+            copies[id(c)] = _DictConnection(c)
+        return copies[id(c)]
+    tt_copy = Timetable.__new__(Timetable)
+    tt_copy.trip_connections = {trip_id: [copy(c) for c in connections] for trip_id, connections in tt.trip_connections.items()}
+    tt_copy.station_connections = {station_id: [copy(c) for c in connections] for station_id, connections in tt.station_connections.items()}
+    return tt_copy
+
+def test_connections_memory(nationwide=False):
+    """
+    Memory report of the connections before (__dict__ objects, an int per parsed time) and after (__slots__, shared ints).
+    @nationwide - also report the whole country feed, the timetable is built without footpaths (they don't change connections)
+    """
+    timetables = [("tlv", get_tlv_timetable)]
+    if nationwide:
+        timetables.append(("nationwide", lambda: Timetable(get_is_gtfs(), build_footpaths=False)))
+    for name, get_timetable in timetables:
+        tt = get_timetable()
+        # materialize every connection of a store backed timetable
+        for connections in tt.trip_connections.values():
+            pass
+        after = connections_memory_report(tt)
+        before = connections_memory_report(_dict_connections_copy(tt))
+        print_connections_memory_report(name + " before", before)
+        print_connections_memory_report(name + " after", after)
+        print_log(f"{name} - connections take {after['total'] / before['total']:.0%} of the memory they took")
+
 def test_stations_footpaths():
     tt = get_tlv_timetable()
     # print(f"footpaths - {tt.stations_footpaths}")
     with Timer(text="[+] searching footpaths from stations took {:.4f} seconds..."):
-        tt.stations_footpaths = tt.build_station_footpaths()
+        tt.stations_footpaths = tt.build_station_footpaths(workers=os.cpu_count(), footpath_store=TLV_FOOTPATH_STORE)
     save_artifact(tt, TLV_TIMETABLE_OBJ)
+    from timetable_store import TLV_TIMETABLE_STORE, save_timetable_store
+    save_timetable_store(tt, TLV_TIMETABLE_STORE)
 
 def display_station_footpaths(tt, station, station_footpaths):
     # Just fake connections for each footpath and display them as connections
@@ -439,8 +715,7 @@ def display_station_footpaths(tt, station, station_footpaths):
         trip_id = FOOTPATH_ID + "_" + str(i)
         tt.trips[trip_id] = tt.trips[FOOTPATH_ID]  
 
-        c = Connection(station["station_id"], footpath["station_id"], "00:00:00",
-            "00:00:00", trip_id)
+        c = Connection(station["station_id"], footpath["station_id"], 0, 0, trip_id)
         connections.append(c)
     display_connections(tt, connections)
 
@@ -0,0 +1,337 @@
+import random
+import time
+
+import numpy as np
+
+from utils import time_to_int, FOOTPATH_ID, print_log, distance, degrees_to_meters
+from connection_builder import Connection, TripView, get_tlv_timetable
+from raptor_routing import raptor_route, run_ultra_wrapper, BENCHMARK_ODS, UNREACHABLE_WALKING_TIME, MAX_ROUNDS
+from pattern_raptor_routing import PatternScanner
+
+# Connection Scan Algorithm (select it with run_ultra_wrapper(..., engine=csa_route)).
+# All the connections of the timetable are one set of arrays sorted by departure time. A query bisects to its start time
+# and goes over the connections once, in order:
+#   a connection can be taken if its trip is already boarded (a bit per trip), or if we are at its departure station in time,
+#   and then it may improve the arrival of its arrival station - and the footpaths from there.
+# Once a connection departs after the best arrival at the end nothing later can improve it, so the scan stops there.
+# Unlike raptor_route there is no limit on the number of trips, and it finds only the earliest arrival (one result).
+# It scans every connection departing between the start time and the arrival, so it is fast for short journeys
+# and gets slower the longer the journey takes (see test_csa_crossover).
+
+INFINITY = 2**40
+SOURCE = 1
+TRIP = 2
+WALK = 3
+# connections are turned to python ints in chunks, so a query which stops early doesn't convert the whole day
+SCAN_CHUNK_SIZE = 4096
+
+
+class ConnectionArray(object):
+    """
+    Every connection of the route patterns as arrays sorted by departure time, by dense station id.
+    get_connection_array(tt) builds them once per patterns (a timetable, or a service day).
+    """
+    def __init__(self, patterns, dense_stations):
+        self.patterns = patterns
+        departure_station = []
+        arrival_station = []
+        departure_time = []
+        arrival_time = []
+        trip = []
+        position = []
+        self.trip_ids = []
+        for pattern in patterns.patterns:
+            num_trips, num_stops = pattern.departures.shape
+            stations = np.array([dense_stations.index(station_id) for station_id in pattern.stops], dtype=np.int32)
+            # connection i of a trip is from stop i to stop i + 1
+            departure_station.append(np.tile(stations[:-1], num_trips))
+            arrival_station.append(np.tile(stations[1:], num_trips))
+            departure_time.append(pattern.departures[:, :-1].ravel())
+            arrival_time.append(pattern.arrivals[:, 1:].ravel())
+            trip.append(np.repeat(np.arange(len(self.trip_ids), len(self.trip_ids) + num_trips, dtype=np.int32), num_stops - 1))
+            position.append(np.tile(np.arange(num_stops - 1, dtype=np.int32), num_trips))
+            self.trip_ids += pattern.trip_ids
+
+        def concatenate(arrays):
+            return np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int32)
+        departure_time = concatenate(departure_time)
+        arrival_time = concatenate(arrival_time)
+        # by arrival too, so a connection arriving at the same second another one departs comes before it
+        order = np.lexsort((arrival_time, departure_time))
+        self.departure_station = concatenate(departure_station)[order]
+        self.arrival_station = concatenate(arrival_station)[order]
+        self.departure_time = departure_time[order]
+        self.arrival_time = arrival_time[order]
+        self.trip = concatenate(trip)[order]
+        self.position = concatenate(position)[order]
+        self._footpaths = {}
+
+    def __len__(self):
+        return len(self.departure_time)
+
+    def footpaths(self, transfers, limit_mid_walking_time, dense_stations):
+        """
+        returns dense station id -> [(to station, walking time)] sorted by time, of the footpaths up to limit_mid_walking_time
+        """
+        key = (id(transfers), limit_mid_walking_time)
+        if key not in self._footpaths:
+            footpaths = {}
+            for station_id, station_footpaths in transfers.items():
+                walks = [(dense_stations.index(f["station_id"]), f["time"]) for f in station_footpaths if f["time"] <= limit_mid_walking_time]
+                if len(walks) > 0:
+                    footpaths[dense_stations.index(station_id)] = sorted(walks, key=lambda walk: walk[1])
+            # transfers is kept so its id isn't reused by another dict
+            self._footpaths[key] = (transfers, footpaths)
+        return self._footpaths[key][1]
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.departure_station, self.arrival_station, self.departure_time, self.arrival_time, self.trip, self.position))
+
+    def __repr__(self):
+        return f"ConnectionArray({len(self)} connections, {len(self.trip_ids)} trips, {self.nbytes() / 2**20:.1f}MB)"
+
+
+def get_connection_array(tt):
+    patterns = tt.get_route_patterns()
+    connection_array = getattr(patterns, "_connection_array", None)
+    if connection_array is None:
+        connection_array = ConnectionArray(patterns, tt.get_dense_stations())
+        patterns._connection_array = connection_array
+    return connection_array
+
+
+def _trace(tt, ca, dense_stations, kind, parent, parent_info, arrival, station, start_station, end_station, egress_time, start_time,
+           source_trip_ids, target_trip_ids):
+    # the result route (like raptor_route's) of getting off at station and walking to the end
+    station_id = dense_stations.station_id(station)
+    result_route = [(end_station, [Connection(station_id, end_station, arrival[station], arrival[station] + egress_time,
+                                              target_trip_ids.get(station_id, FOOTPATH_ID))])]
+    while station_id != start_station:
+        if kind[station] == TRIP:
+            alight = parent[station]
+            board = parent_info[station]
+            trip_id = ca.trip_ids[int(ca.trip[alight])]
+            connections = TripView(tt.trip_connections[trip_id], int(ca.position[board]), int(ca.position[alight]) + 1)
+            previous = int(ca.departure_station[board])
+        elif kind[station] == WALK:
+            previous = parent[station]
+            connections = [Connection(dense_stations.station_id(previous), station_id, parent_info[station], arrival[station], FOOTPATH_ID)]
+        else:
+            previous = dense_stations.index(start_station)
+            connections = [Connection(start_station, station_id, start_time, arrival[station], source_trip_ids.get(station_id, FOOTPATH_ID))]
+        result_route.insert(0, (station_id, connections))
+        station = previous
+        station_id = dense_stations.station_id(station)
+    return result_route
+
+
+def csa_route(start_station, end_station, start_time, tt, end_footpath_connections=None, relax_footpaths=True, limit_walking_time=1* 60 * 60,
+              limit_mid_walking_time= 60*6, debug=False, scanner=None, transfer_shortcuts=None, sources=None, targets=None,
+              source_trip_ids=None, target_trip_ids=None):
+    """
+    Earliest arrival by connection scan - raptor_route's parameters (scanner is ignored), and its results - MAX_ROUNDS rounds,
+    the first one holding the earliest arrival journey and the others empty.
+    Walking follows raptor_route - footpaths only after getting off a trip, and the walk to the end only from a station we got to
+    by a trip (or a source).
+    """
+    source_trip_ids = source_trip_ids or {}
+    target_trip_ids = target_trip_ids or {}
+    ca = get_connection_array(tt)
+    dense_stations = tt.get_dense_stations()
+    # walking stations of the query get their ids now
+    dense_stations.sync()
+    num_stations = len(dense_stations)
+    start_time_int = time_to_int(start_time)
+
+    # stations_to_end of raptor_route, only the ones we can walk from
+    stations_to_end = {}
+    if end_footpath_connections is not None:
+        for s_to_t in end_footpath_connections["sources_to_targets"]:
+            if s_to_t[0]["time"] is not None:
+                stations_to_end[s_to_t[0]["from_index"]] = s_to_t[0]["time"]
+    if targets is not None:
+        for station_id, egress_time in targets.items():
+            idx = dense_stations.index(station_id)
+            stations_to_end[idx] = min(egress_time, stations_to_end.get(idx, UNREACHABLE_WALKING_TIME))
+    stations_to_end = {station: egress_time for station, egress_time in stations_to_end.items() if egress_time < limit_walking_time}
+
+    footpaths = {}
+    if relax_footpaths:
+        transfers = tt.stations_footpaths if transfer_shortcuts is None else transfer_shortcuts
+        footpaths = ca.footpaths(transfers, limit_mid_walking_time if transfer_shortcuts is None else INFINITY, dense_stations)
+
+    arrival = [INFINITY] * num_stations
+    kind = bytearray(num_stations)
+    # TRIP - connection we got off at, and the connection we boarded at. WALK - station we walked from, and the walk's departure.
+    parent = [-1] * num_stations
+    parent_info = [-1] * num_stations
+    best_arrival = INFINITY
+    best_station = -1
+
+    arrival[dense_stations.index(start_station)] = start_time_int
+    for station_id, arrival_time in (sources or {}).items():
+        station = dense_stations.index(station_id)
+        if arrival_time < start_time_int or arrival_time >= arrival[station]:
+            continue
+        arrival[station] = arrival_time
+        kind[station] = SOURCE
+        if station in stations_to_end and arrival_time + stations_to_end[station] < best_arrival:
+            best_arrival = arrival_time + stations_to_end[station]
+            best_station = station
+
+    # trip reachability bits, and the connection each boarded trip was boarded at
+    boarded = bytearray(len(ca.trip_ids))
+    board_connection = {}
+    first = int(np.searchsorted(ca.departure_time, start_time_int, side="left"))
+    num_scanned = 0
+    done = False
+    for chunk_start in range(first, len(ca), SCAN_CHUNK_SIZE):
+        chunk_end = min(chunk_start + SCAN_CHUNK_SIZE, len(ca))
+        chunk = zip(range(chunk_start, chunk_end), ca.departure_station[chunk_start:chunk_end].tolist(), ca.arrival_station[chunk_start:chunk_end].tolist(),
+                    ca.departure_time[chunk_start:chunk_end].tolist(), ca.arrival_time[chunk_start:chunk_end].tolist(), ca.trip[chunk_start:chunk_end].tolist())
+        for c, departure_station, arrival_station, departure_time, arrival_time, trip in chunk:
+            if departure_time >= best_arrival:
+                # the arrival at the end is fixed
+                done = True
+                break
+            if not boarded[trip]:
+                if arrival[departure_station] > departure_time:
+                    continue
+                boarded[trip] = 1
+                board_connection[trip] = c
+            if arrival_time >= arrival[arrival_station] or arrival_time >= best_arrival:
+                continue
+            arrival[arrival_station] = arrival_time
+            kind[arrival_station] = TRIP
+            parent[arrival_station] = c
+            parent_info[arrival_station] = board_connection[trip]
+            if arrival_station in stations_to_end and arrival_time + stations_to_end[arrival_station] < best_arrival:
+                best_arrival = arrival_time + stations_to_end[arrival_station]
+                best_station = arrival_station
+            for to, walking_time in footpaths.get(arrival_station, ()):
+                walk_arrival = arrival_time + walking_time
+                if walk_arrival >= best_arrival:
+                    # footpaths are sorted by time
+                    break
+                if walk_arrival < arrival[to]:
+                    arrival[to] = walk_arrival
+                    kind[to] = WALK
+                    parent[to] = arrival_station
+                    parent_info[to] = arrival_time
+        num_scanned += chunk_end - chunk_start
+        if done:
+            break
+    if debug:
+        print(f"csa - scanned {num_scanned} connections from {first}, boarded {len(board_connection)} trips")
+
+    result_routes = [[] for _ in range(MAX_ROUNDS)]
+    if best_station != -1:
+        result_routes[0].append(_trace(tt, ca, dense_stations, kind, parent, parent_info, arrival, best_station, start_station, end_station,
+                                       stations_to_end[best_station], start_time_int, source_trip_ids, target_trip_ids))
+    return result_routes
+
+
+############################################################
+### TEST CSA ###############################################
+############################################################
+
+def _earliest_arrival(result_routes):
+    arrivals = [result[-1][1][-1].arrival_time for round_res in result_routes for result in round_res]
+    return min(arrivals) if len(arrivals) > 0 else None
+
+def test_csa_route(ods=BENCHMARK_ODS, limit_walking_time=60*15):
+    """
+    The benchmark ODs with raptor_route (PatternScanner) and with csa_route.
+    returns True if CSA always arrives at least as early as the best RAPTOR result (it can be earlier - it isn't limited to 4 trips)
+    """
+    tt = get_tlv_timetable()
+    get_connection_array(tt)
+    print_log(get_connection_array(tt))
+    never_worse = True
+    for start_loc, end_loc, start_time in ods:
+        # mapped timetables materialize stations on first use, don't time that
+        run_ultra_wrapper(start_loc, end_loc, start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner)
+        query_start = time.perf_counter()
+        raptor_results = run_ultra_wrapper(start_loc, end_loc, start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner)
+        raptor_time = time.perf_counter() - query_start
+        query_start = time.perf_counter()
+        csa_results = run_ultra_wrapper(start_loc, end_loc, start_time, tt, limit_walking_time=limit_walking_time, engine=csa_route)
+        csa_time = time.perf_counter() - query_start
+        raptor_best = min((r.arrival_time for r in raptor_results), default=None)
+        csa_best = min((r.arrival_time for r in csa_results), default=None)
+        print(f"[+] {start_time} - raptor {raptor_time * 1000:.2f} ms, csa {csa_time * 1000:.2f} ms (with walking)")
+        if raptor_best is not None and (csa_best is None or csa_best > raptor_best):
+            never_worse = False
+            print("    [!] csa is worse:")
+        for r in raptor_results:
+            print("    raptor -", r)
+        for r in csa_results:
+            print("    csa    -", r)
+    return never_worse
+
+def test_csa_crossover(num_queries=300, start_time="08:00:00", seed=0, buckets_km=(2, 5, 10, 20, 40)):
+    """
+    Where is CSA faster than RAPTOR? Random station to station queries on TLV (with footpaths, without access / egress walking),
+    timed with raptor_route (PatternScanner) and csa_route, grouped by the straight line distance between the stations.
+    CSA's work grows with the journey's duration (every connection departing until the arrival), RAPTOR's with its rounds and patterns.
+    returns True if CSA never arrived later than RAPTOR
+    """
+    rng = random.Random(seed)
+    tt = get_tlv_timetable()
+    patterns = tt.get_route_patterns()
+    ca = get_connection_array(tt)
+    print_log(ca)
+    station_ids = [station_id for station_id in tt.stations if station_id in patterns.station_patterns]
+    # bucket -> [queries, raptor seconds, csa seconds]
+    stats = {bucket: [0, 0.0, 0.0] for bucket in buckets_km + (None,)}
+    never_worse = True
+    for _ in range(num_queries):
+        start_station, end_station = rng.sample(station_ids, 2)
+        start, end = tt.stations[start_station], tt.stations[end_station]
+        km = degrees_to_meters(distance((float(start["stop_lat"]), float(start["stop_lon"])), (float(end["stop_lat"]), float(end["stop_lon"])))) / 1000
+        bucket = next((b for b in buckets_km if km < b), None)
+        # mapped timetables materialize stations on first use, don't time that
+        raptor_route(start_station, end_station, start_time, tt, scanner=PatternScanner, targets={end_station: 0})
+        query_start = time.perf_counter()
+        raptor_results = raptor_route(start_station, end_station, start_time, tt, scanner=PatternScanner, targets={end_station: 0})
+        raptor_time = time.perf_counter() - query_start
+        query_start = time.perf_counter()
+        csa_results = csa_route(start_station, end_station, start_time, tt, targets={end_station: 0})
+        csa_time = time.perf_counter() - query_start
+        raptor_best = _earliest_arrival(raptor_results)
+        csa_best = _earliest_arrival(csa_results)
+        if raptor_best is not None and (csa_best is None or csa_best > raptor_best):
+            never_worse = False
+            print(f"    [!] {start_station} -> {end_station} - raptor arrives at {raptor_best}, csa at {csa_best}")
+        stats[bucket][0] += 1
+        stats[bucket][1] += raptor_time
+        stats[bucket][2] += csa_time
+
+    print_log(f"{'distance':>10} {'queries':>8} {'raptor ms':>10} {'csa ms':>8} {'csa speedup':>12}")
+    low = 0
+    # (lower bound km, faster engine) of every bucket with queries, by distance
+    winners = []
+    for bucket in buckets_km + (None,):
+        queries, raptor_time, csa_time = stats[bucket]
+        name = f"{low}-{bucket}km" if bucket is not None else f"{low}km+"
+        bucket_low = low
+        low = bucket
+        if queries == 0:
+            continue
+        print_log(f"{name:>10} {queries:>8} {raptor_time / queries * 1000:>10.2f} {csa_time / queries * 1000:>8.2f} {raptor_time / csa_time:>11.2f}x")
+        winners.append((bucket_low, "CSA" if csa_time < raptor_time else "RAPTOR"))
+    # The crossover is where the raptor / csa time ratio crosses 1 between neighbouring buckets, in either direction
+    crossovers = [(bucket_low, below, above) for (_, below), (bucket_low, above) in zip(winners, winners[1:]) if below != above]
+    for boundary, below, above in crossovers:
+        print_log(f"crossover at {boundary}km - {below} is faster below it, {above} from it on")
+    if len(winners) > 0 and len(crossovers) == 0:
+        print_log(f"{winners[0][1]} is faster at every distance")
+    return never_worse
+
+
+def main():
+    test_csa_route()
+    test_csa_crossover()
+
+if __name__ == "__main__":
+    main()
@@ -294,12 +294,12 @@ def display_RaptorResult(raptor_result):
     for i, st in enumerate(stations):
         print(x,y)
         # raptor_result.result_route is a tuple of (station, [connections])
-        arrival_time = raptor_result.result_route[i][1][-1].arrival_time 
+        arrival_time = time_int_to_text(raptor_result.result_route[i][1][-1].arrival_time)
         station_str = ""
         if i == len(stations) - 1:
             station_str = f"{raptor_result.bus_lines[i]}, {arrival_time}"
         else:
-            departure_time = raptor_result.result_route[i+1][1][0].departure_time
+            departure_time = time_int_to_text(raptor_result.result_route[i+1][1][0].departure_time)
             station_str = f"({raptor_result.bus_lines[i]}, {arrival_time}) -> ({raptor_result.bus_lines[i+1]}, {departure_time})"
             
         ax.annotate(station_str, (x[i], y[i]), color="red")
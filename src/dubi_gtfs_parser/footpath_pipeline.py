@@ -0,0 +1,288 @@
+import json
+import math
+import os
+import shutil
+import time
+import hashlib
+from multiprocessing import Pool
+
+from utils import ARTIFACTS_FOLDER, print_log
+from station_index import SearchableStations, METERS_PER_DEGREE
+from valhalla_interface import get_actor
+
+# Footpath precomputation as a pipeline (used by Timetable.build_station_footpaths).
+# Stations are partitioned into square tiles, a tile is one unit of work - matrix calls from the tile's stations to every station
+# within walking distance of them, split to chunks valhalla accepts. Tiles run on a process pool, each worker has its own valhalla actor.
+# Every finished tile is written to the footpath store folder right away, so the main process doesn't hold the results,
+# and a crashed / interrupted run continues from the tiles it didn't finish.
+#
+# Footpath store folder:
+#   manifest.json    - format, version, the parameters and a fingerprint of the stations. A run with other ones starts over.
+#   tile_<idx>.json  - {station_id: [{"station_id", "distance", "time"}, ...]} of the tile's stations, sorted by time.
+#                      Written to a temp file and renamed, so a tile file is always complete.
+
+FOOTPATH_STORE_FORMAT = "tremp-footpaths"
+FOOTPATH_STORE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+TLV_FOOTPATH_STORE = os.path.join(ARTIFACTS_FOLDER, "tlv_footpath_store")
+
+DEFAULT_TILE_SIZE = 1000 # meters
+DEFAULT_MAX_WALKING_DISTANCE = 1.2 # KM, valhalla gives distances in KM
+DEFAULT_MAX_MATRIX_PAIRS = 1200
+
+
+def _location(station):
+    return {"lat": station["stop_lat"], "lon": station["stop_lon"]}
+
+def _stations_fingerprint(stations):
+    h = hashlib.sha1()
+    for s in stations:
+        h.update(f"{s['station_id']},{s['stop_lat']},{s['stop_lon']};".encode())
+    return h.hexdigest()
+
+def _tile_file(folder, tile_idx):
+    return os.path.join(folder, f"tile_{tile_idx}.json")
+
+
+def partition_to_tiles(stations, tile_size=DEFAULT_TILE_SIZE):
+    """
+    @stations - list of stations
+    @tile_size - meters
+    returns a list of station lists, one per non empty tile. Same stations give the same tiles in the same order.
+    """
+    if len(stations) == 0:
+        return []
+    min_lat = min(float(s["stop_lat"]) for s in stations)
+    min_lon = min(float(s["stop_lon"]) for s in stations)
+    max_abs_lat = max(abs(float(s["stop_lat"])) for s in stations)
+    tile_dlat = tile_size / METERS_PER_DEGREE
+    tile_dlon = tile_size / (METERS_PER_DEGREE * math.cos(math.radians(max_abs_lat)))
+    tiles = {}
+    for s in stations:
+        key = (math.floor((float(s["stop_lat"]) - min_lat) / tile_dlat), math.floor((float(s["stop_lon"]) - min_lon) / tile_dlon))
+        tiles.setdefault(key, []).append(s)
+    return [tiles[key] for key in sorted(tiles.keys())]
+
+
+def plan_tile(index, tile_stations, max_walking_distance, max_pairs):
+    """
+    Matrix calls of a tile - [(sources, targets)] with len(sources) * len(targets) <= max_pairs.
+    Targets are all stations within max_walking_distance in a straight line, walking is never shorter than that.
+    """
+    radius = max_walking_distance * 1000
+    tile_targets = index.search_nearby_stations_batch(tile_stations, radius)
+    calls = []
+    chunk_sources, chunk_targets = [], {}
+    def flush():
+        if len(chunk_sources) > 0:
+            calls.append((list(chunk_sources), list(chunk_targets.values())))
+        chunk_sources.clear()
+        chunk_targets.clear()
+    for station, targets in zip(tile_stations, tile_targets):
+        new_targets = {t["station_id"]: t for t in targets if t["station_id"] not in chunk_targets}
+        if (len(chunk_sources) + 1) * (len(chunk_targets) + len(new_targets)) > max_pairs:
+            flush()
+            new_targets = {t["station_id"]: t for t in targets}
+        if len(new_targets) > max_pairs:
+            # a single station with more targets than a call can take - split its targets
+            target_list = list(new_targets.values())
+            for i in range(0, len(target_list), max_pairs):
+                calls.append(([station], target_list[i:i + max_pairs]))
+            continue
+        chunk_sources.append(station)
+        chunk_targets.update(new_targets)
+    flush()
+    return calls
+
+
+# walking engine of this process - None for valhalla. Set by the pool initializer in workers, or by build_footpaths when running inline.
+_walking_engine = None
+
+def _init_worker(num_stations, walking_engine=None):
+    # one valhalla actor per worker process, made once (get_actor keeps it)
+    global _walking_engine
+    _walking_engine = walking_engine
+    if walking_engine is None:
+        get_actor(None, num_stations)
+
+def run_tile(task):
+    """
+    Run the matrix calls of a tile and write its footpaths file. Runs in a pool worker (or inline with one worker).
+    @task - (folder, tile_idx, calls, max_walking_distance, num_stations), calls as given by plan_tile
+    returns (tile_idx, number of station pairs, seconds, the tile's footpaths - None if they were written to folder)
+    """
+    folder, tile_idx, calls, max_walking_distance, num_stations = task
+    start = time.perf_counter()
+    actor = _walking_engine if _walking_engine is not None else get_actor(None, num_stations)
+    footpaths = {}
+    num_pairs = 0
+    for sources, targets in calls:
+        query = {"sources": [_location(s) for s in sources], "targets": [_location(t) for t in targets], "costing": "pedestrian"}
+        result = actor.matrix(query)
+        num_pairs += len(sources) * len(targets)
+        for i, source in enumerate(sources):
+            source_footpaths = footpaths.setdefault(source["station_id"], [])
+            for f in result["sources_to_targets"][i]:
+                target = targets[f["to_index"]]
+                if f["distance"] is None or f["distance"] > max_walking_distance or target["station_id"] == source["station_id"]:
+                    continue
+                source_footpaths.append({"station_id": target["station_id"], "distance": f["distance"], "time": f["time"]})
+    for source_footpaths in footpaths.values():
+        # Sort by walking time
+        source_footpaths.sort(key=lambda x: x["time"])
+    if folder is None:
+        return tile_idx, num_pairs, time.perf_counter() - start, footpaths
+    tmp_file = _tile_file(folder, tile_idx) + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(footpaths, f)
+    os.replace(tmp_file, _tile_file(folder, tile_idx))
+    return tile_idx, num_pairs, time.perf_counter() - start, None
+
+
+def _prepare_store(folder, manifest):
+    """
+    Create the store folder, or check the existing one was made with the same parameters.
+    returns the set of finished tiles
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            existing = json.load(f)
+        if existing == manifest:
+            return set(int(name[len("tile_"):-len(".json")]) for name in os.listdir(folder)
+                       if name.startswith("tile_") and name.endswith(".json"))
+        print_log(f"footpath store {folder} was made with other parameters or stations, starting over")
+        shutil.rmtree(folder)
+    os.makedirs(folder, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return set()
+
+
+def build_footpaths(stations, folder=None, tile_size=DEFAULT_TILE_SIZE, max_walking_distance=DEFAULT_MAX_WALKING_DISTANCE,
+                    workers=1, max_matrix_pairs=DEFAULT_MAX_MATRIX_PAIRS, max_tiles=None, walking_engine=None):
+    """
+    @stations - list of stations (tt.stations.values())
+    @folder - footpath store folder, None to keep the results in memory only (no resume)
+    @tile_size - meters, stations of a tile are matrix call sources together
+    @max_walking_distance - KM
+    @workers - number of processes, each with its own valhalla actor
+    @max_tiles - stop after this many tiles of this run (None - all), for trying resume
+    @walking_engine - object with a valhalla like matrix(query) (e.g. pedestrian_graph.PedestrianGraph), None for valhalla
+    returns station_id -> footpaths sorted by time (only stations with footpaths). With a folder the result is read back from it.
+    """
+    stations = list(stations)
+    # Valhalla refuses matrices bigger than its limit, which get_actor sets by the number of stations
+    max_pairs = max(1, min(max_matrix_pairs, len(stations) * 3 + 100))
+    tiles = partition_to_tiles(stations, tile_size)
+    done = set()
+    if folder is not None:
+        manifest = {"format": FOOTPATH_STORE_FORMAT, "version": FOOTPATH_STORE_VERSION, "num_tiles": len(tiles),
+                    "tile_size": tile_size, "max_walking_distance": max_walking_distance, "stations": _stations_fingerprint(stations),
+                    "walking_engine": getattr(walking_engine, "cache_tag", "valhalla")}
+        done = _prepare_store(folder, manifest)
+        if len(done) > 0:
+            print_log(f"resuming footpaths - {len(done)} of {len(tiles)} tiles already done")
+
+    index = SearchableStations(stations)
+    def tasks():
+        # planned lazily, so the main process only holds the tiles waiting in the pool's queue
+        for tile_idx, tile_stations in enumerate(tiles):
+            if tile_idx in done:
+                continue
+            yield folder, tile_idx, plan_tile(index, tile_stations, max_walking_distance, max_pairs), max_walking_distance, len(stations)
+
+    footpaths = {}
+    total_pairs = 0
+    finished = 0
+    remaining = len(tiles) - len(done)
+    start = time.perf_counter()
+    def tile_done(result):
+        nonlocal total_pairs, finished
+        tile_idx, num_pairs, _, tile_footpaths = result
+        total_pairs += num_pairs
+        finished += 1
+        if tile_footpaths is not None:
+            footpaths.update(tile_footpaths)
+        if finished % 50 == 0 or finished == remaining:
+            elapsed = time.perf_counter() - start
+            print_log(f"footpaths - {finished}/{remaining} tiles, {total_pairs} station pairs, {total_pairs / max(elapsed, 1e-9):.0f} pairs/second")
+
+    task_iter = tasks()
+    if max_tiles is not None:
+        task_iter = (task for _, task in zip(range(max_tiles), task_iter))
+    if workers is None or workers <= 1:
+        global _walking_engine
+        previous_engine, _walking_engine = _walking_engine, walking_engine
+        try:
+            for task in task_iter:
+                tile_done(run_tile(task))
+        finally:
+            _walking_engine = previous_engine
+    else:
+        with Pool(workers, initializer=_init_worker, initargs=(len(stations), walking_engine)) as pool:
+            for result in pool.imap_unordered(run_tile, task_iter):
+                tile_done(result)
+
+    elapsed = time.perf_counter() - start
+    print_log(f"finished footpaths of {finished} tiles - {total_pairs} station pairs in {elapsed:.2f} seconds "
+              f"({total_pairs / max(elapsed, 1e-9):.0f} pairs/second, {workers or 1} workers)")
+    if folder is not None:
+        return load_footpath_store(folder)
+    return footpaths
+
+
+def load_footpath_store(folder):
+    """
+    returns station_id -> footpaths of all finished tiles of a footpath store
+    """
+    footpaths = {}
+    for name in sorted(os.listdir(folder)):
+        if name.startswith("tile_") and name.endswith(".json"):
+            with open(os.path.join(folder, name), "r") as f:
+                footpaths.update(json.load(f))
+    return footpaths
+
+
+def is_footpath_store_complete(folder):
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return False
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    return all(os.path.isfile(_tile_file(folder, i)) for i in range(manifest["num_tiles"]))
+
+
+############################################################
+### TEST FOOTPATH PIPELINE #################################
+############################################################
+
+def test_footpath_pipeline(workers=4, folder=TLV_FOOTPATH_STORE):
+    """
+    Build the tlv footpaths with an interrupted run and a resumed one, and compare to the footpaths of the timetable.
+    """
+    from connection_builder import get_tlv_timetable
+    tt = get_tlv_timetable()
+    stations = list(tt.stations.values())
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    print_log("first run, stopped after 3 tiles")
+    build_footpaths(stations, folder, workers=workers, max_tiles=3)
+    print_log(f"complete - {is_footpath_store_complete(folder)}")
+    print_log("second run")
+    footpaths = build_footpaths(stations, folder, workers=workers)
+    print_log(f"complete - {is_footpath_store_complete(folder)}")
+
+    same = 0
+    for station_id, station_footpaths in footpaths.items():
+        old = tt.stations_footpaths.get(station_id, [])
+        if set(f["station_id"] for f in station_footpaths) == set(f["station_id"] for f in old):
+            same += 1
+    print_log(f"{len(footpaths)} stations with footpaths, {len(tt.stations_footpaths)} in the timetable, {same} with the same footpath stations")
+
+
+def main():
+    test_footpath_pipeline()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+from array import array
+import os
+import time
+import numpy as np
+
+from utils import time_text_to_int, time_int_to_text, log_to_file
+
+# Columnar storage for the big GTFS tables (stop_times, shapes).
+# CSVParser keeps a dict of strings per row, which for the nationwide feed means millions of dicts alive at once.
+# Here every column is a typed numpy array, and string ids are interned to dense ints.
+# The tables expose a thin mapping API (table[trip_id] -> list of row dicts), so old code can still read them like the dicts.
+
+MISSING_VALUE = -1
+
+
+class IdInterner(object):
+    """
+    Maps string ids (stop_id, trip_id, shape_id...) to dense ints and back.
+    """
+    def __init__(self, ids=()):
+        self.ids = []
+        self.index = {}
+        for id_str in ids:
+            self.intern(id_str)
+
+    def intern(self, id_str):
+        idx = self.index.get(id_str)
+        if idx is None:
+            idx = len(self.ids)
+            self.index[id_str] = idx
+            self.ids.append(id_str)
+        return idx
+
+    def get(self, id_str, default=MISSING_VALUE):
+        return self.index.get(id_str, default)
+
+    def __getitem__(self, idx):
+        return self.ids[idx]
+
+    def __contains__(self, id_str):
+        return id_str in self.index
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def cached_converter(convert):
+    # Feeds repeat the same few thousand time strings millions of times, so convert each distinct text only once.
+    cache = {}
+    def _convert(text):
+        value = cache.get(text)
+        if value is None:
+            value = cache[text] = convert(text)
+        return value
+    return _convert
+
+
+def gtfs_time_to_int(time_text):
+    # Empty times are allowed by GTFS for non-timepoint stops, we keep them as MISSING_VALUE.
+    time_text = time_text.strip()
+    if time_text == "":
+        return MISSING_VALUE
+    return time_text_to_int(time_text)
+
+
+def parse_columns(lines, header, columns):
+    """
+    Parse csv lines into typed columns.
+    @lines - an iterable of csv lines (without the header)
+    @header - list of field names of the csv file
+    @columns - dict of field name -> (typecode, converter), typecode is an array module typecode and converter maps the raw text to a number
+    returns a dict of field name -> numpy array
+    """
+    fields_idx = []
+    for name in columns.keys():
+        if name not in header:
+            raise ValueError("field {} not found in csv header {}".format(name, header))
+        fields_idx.append(header.index(name))
+    converters = [conv for (_, conv) in columns.values()]
+    outputs = [array(typecode) for (typecode, _) in columns.values()]
+    parsers = list(zip(outputs, fields_idx, converters))
+
+    for line in lines:
+        line_data = line.rstrip("\r\n").split(",")
+        if len(line_data) == 1 and line_data[0] == "":
+            # empty line, usually the last one
+            continue
+        for out, i, conv in parsers:
+            out.append(conv(line_data[i] if i < len(line_data) else ""))
+
+    return {name: np.frombuffer(out, dtype=out.typecode) if len(out) > 0 else np.zeros(0, dtype=out.typecode)
+            for name, out in zip(columns.keys(), outputs)}
+
+
+def group_offsets(group_idx, num_groups):
+    # group_idx must be sorted. offsets[g]:offsets[g+1] is the range of rows of group g.
+    offsets = np.zeros(num_groups + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(group_idx, minlength=num_groups))
+    return offsets
+
+
+class ColumnarCSVParser(object):
+    """
+    Same idea as CSVParser, but reads only the requested fields into typed columns.
+    """
+    def __init__(self, file_path) -> None:
+        self.file_path = file_path
+
+    def read_header(self):
+        with open(self.file_path, "r", encoding="utf-8-sig") as f:
+            return f.readline().rstrip("\r\n").split(",")
+
+    def parse(self, columns):
+        """
+        @columns - dict of field name -> (typecode, converter), see parse_columns
+        """
+        with open(self.file_path, "r", encoding="utf-8-sig") as f:
+            header = f.readline().rstrip("\r\n").split(",")
+            return parse_columns(f, header, columns)
+
+
+class StopTimesTable(object):
+    """
+    Columnar stop_times. Rows are sorted by (trip, stop_sequence), so the stops of trip t are rows trip_offsets[t]:trip_offsets[t+1].
+    @trip_idx, @station_idx - interned ids (see trip_ids, station_ids)
+    @arrival_time, @departure_time - int32 seconds from the start of the service day (can be past 24:00:00)
+    @stop_sequence - int32 original stop_sequence
+
+    Mapping API - stop_times[trip_id] returns a list of row dicts like CSVParser used to produce:
+        {'trip_id', 'station_id', 'arrival_time', 'departure_time', 'stop_sequence'}
+    except that times are int seconds (not "hh:mm:ss" text), use utils.time_int_to_text to display them.
+    Lists returned from stop_times[trip_id] are kept, so annotations added to them (shapes matching) are not lost.
+    """
+    def __init__(self, trip_ids, station_ids, trip_idx, station_idx, stop_sequence, arrival_time, departure_time):
+        self.trip_ids = trip_ids
+        self.station_ids = station_ids
+        self.trip_idx = trip_idx
+        self.station_idx = station_idx
+        self.stop_sequence = stop_sequence
+        self.arrival_time = arrival_time
+        self.departure_time = departure_time
+        self.trip_offsets = group_offsets(trip_idx, len(trip_ids))
+        # Only trips that actually have stop times are exposed through the mapping API
+        self._trips_with_stops = np.flatnonzero(np.diff(self.trip_offsets) > 0)
+        self._materialized = {}
+
+    @classmethod
+    def from_unsorted(cls, trip_ids, station_ids, columns):
+        """
+        @columns - dict with trip_idx, station_idx, stop_sequence, arrival_time, departure_time arrays in file order.
+        """
+        # lexsort is stable, so stops with the same sequence keep their file order.
+        order = np.lexsort((columns["stop_sequence"], columns["trip_idx"]))
+        return cls(trip_ids, station_ids,
+                   np.ascontiguousarray(columns["trip_idx"][order], dtype=np.int32),
+                   np.ascontiguousarray(columns["station_idx"][order], dtype=np.int32),
+                   np.ascontiguousarray(columns["stop_sequence"][order], dtype=np.int32),
+                   np.ascontiguousarray(columns["arrival_time"][order], dtype=np.int32),
+                   np.ascontiguousarray(columns["departure_time"][order], dtype=np.int32))
+
+    def trip_rows(self, trip):
+        # trip is an interned trip idx
+        return self.trip_offsets[trip], self.trip_offsets[trip + 1]
+
+    def _rows(self, trip):
+        start, end = self.trip_rows(trip)
+        trip_id = self.trip_ids[trip]
+        station_ids = self.station_ids.ids
+        return [{"trip_id": trip_id,
+                 "station_id": station_ids[self.station_idx[i]],
+                 "arrival_time": int(self.arrival_time[i]),
+                 "departure_time": int(self.departure_time[i]),
+                 "stop_sequence": int(self.stop_sequence[i])} for i in range(start, end)]
+
+    def select_trips(self, trips_mask):
+        """
+        Return a new table with only the trips in trips_mask (bool array by trip idx).
+        """
+        rows_mask = trips_mask[self.trip_idx]
+        table = StopTimesTable(self.trip_ids, self.station_ids, self.trip_idx[rows_mask], self.station_idx[rows_mask],
+                               self.stop_sequence[rows_mask], self.arrival_time[rows_mask], self.departure_time[rows_mask])
+        table._materialized = {t: rows for t, rows in self._materialized.items() if trips_mask[self.trip_ids.get(t)]}
+        return table
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.trip_idx, self.station_idx, self.stop_sequence, self.arrival_time, self.departure_time, self.trip_offsets))
+
+    # Mapping API
+    def __getitem__(self, trip_id):
+        rows = self._materialized.get(trip_id)
+        if rows is None:
+            trip = self.trip_ids.get(trip_id)
+            if trip == MISSING_VALUE or self.trip_offsets[trip] == self.trip_offsets[trip + 1]:
+                raise KeyError(trip_id)
+            rows = self._materialized[trip_id] = self._rows(trip)
+        return rows
+
+    def __contains__(self, trip_id):
+        trip = self.trip_ids.get(trip_id)
+        return trip != MISSING_VALUE and self.trip_offsets[trip] != self.trip_offsets[trip + 1]
+
+    def __len__(self):
+        return len(self._trips_with_stops)
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        for trip in self._trips_with_stops:
+            yield self.trip_ids[trip]
+
+    def values(self):
+        for _, rows in self.items():
+            yield rows
+
+    def items(self):
+        # Do not keep rows that were not asked for explicitly, iterating the whole table should not materialize it.
+        for trip in self._trips_with_stops:
+            trip_id = self.trip_ids[trip]
+            rows = self._materialized.get(trip_id)
+            if rows is None:
+                rows = self._rows(trip)
+            yield trip_id, rows
+
+
+class ShapesTable(object):
+    """
+    Columnar shapes. Rows are sorted by shape, and keep the file order inside a shape.
+    Mapping API - shapes[shape_id] returns a list of {'shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'} dicts,
+    where shape_pt_sequence is the index of the point in the shape (same as the old validation did).
+    """
+    def __init__(self, shape_ids, shape_idx, lat, lon):
+        self.shape_ids = shape_ids
+        self.shape_idx = shape_idx
+        self.lat = lat
+        self.lon = lon
+        self.shape_offsets = group_offsets(shape_idx, len(shape_ids))
+
+    def __getitem__(self, shape_id):
+        shape = self.shape_ids.get(shape_id)
+        if shape == MISSING_VALUE:
+            raise KeyError(shape_id)
+        start, end = self.shape_offsets[shape], self.shape_offsets[shape + 1]
+        return [{"shape_id": shape_id, "shape_pt_lat": float(self.lat[i]), "shape_pt_lon": float(self.lon[i]),
+                 "shape_pt_sequence": int(i - start)} for i in range(start, end)]
+
+    def __contains__(self, shape_id):
+        return shape_id in self.shape_ids
+
+    def __len__(self):
+        return len(self.shape_ids)
+
+    def __iter__(self):
+        return iter(self.shape_ids.ids)
+
+    def keys(self):
+        return iter(self.shape_ids.ids)
+
+    def values(self):
+        for shape_id in self.shape_ids.ids:
+            yield self[shape_id]
+
+    def items(self):
+        for shape_id in self.shape_ids.ids:
+            yield shape_id, self[shape_id]
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.shape_idx, self.lat, self.lon, self.shape_offsets))
+
+
+# ************************************* #
+# stop_times parsing and validation
+# ************************************* #
+
+def stop_times_columns(trip_index, station_index):
+    """
+    Columns to read from stop_times.txt.
+    @trip_index, @station_index - dicts of already interned trip/station ids (IdInterner.index)
+    """
+    to_seconds = cached_converter(gtfs_time_to_int)
+    return {"trip_id": ("i", lambda t: trip_index.get(t, MISSING_VALUE)),
+            "stop_id": ("i", lambda s: station_index.get(s, MISSING_VALUE)),
+            "stop_sequence": ("i", int),
+            "arrival_time": ("i", to_seconds),
+            "departure_time": ("i", to_seconds)}
+
+
+def find_unrepresentable_trips(columns, num_trips):
+    """
+    Rows we can not represent - unknown trip or station, or a missing time - drop their entire trip.
+    returns (unknown_trip_rows, bad_trips) - number of rows with an unknown trip, and a bool mask (by trip idx) of trips to drop
+    """
+    trip_col = columns["trip_id"]
+    unknown_trips = trip_col == MISSING_VALUE
+    bad_rows = (columns["stop_id"] == MISSING_VALUE) | (columns["arrival_time"] == MISSING_VALUE) | (columns["departure_time"] == MISSING_VALUE)
+    bad_trips = np.zeros(num_trips, dtype=bool)
+    bad_trips[trip_col[bad_rows & ~unknown_trips]] = True
+    return int(unknown_trips.sum()), bad_trips
+
+
+def drop_trips(columns, bad_trips):
+    """
+    Drop rows of unknown trips and of bad_trips, and rename the columns to the StopTimesTable names.
+    """
+    trip_col = columns["trip_id"]
+    keep = trip_col != MISSING_VALUE
+    keep[keep] = ~bad_trips[trip_col[keep]]
+    return {"trip_idx": trip_col[keep],
+            "station_idx": columns["stop_id"][keep],
+            "stop_sequence": columns["stop_sequence"][keep],
+            "arrival_time": columns["arrival_time"][keep],
+            "departure_time": columns["departure_time"][keep]}
+
+
+def validate_stop_times(stop_times, trips_mask=None):
+    """
+    Stops are already sorted by stop_sequence, so the only thing left to check is that times are not going back.
+    Vectorized - only trips where some arrival time is before the previous departure time are checked one by one.
+    @trips_mask - optional bool mask by trip idx, only these trips are validated
+    returns a list of (trip idx, error), bad trips are only reported, not dropped.
+    """
+    same_trip = stop_times.trip_idx[1:] == stop_times.trip_idx[:-1]
+    suspicious_rows = np.flatnonzero(same_trip & (stop_times.arrival_time[1:] < stop_times.departure_time[:-1])) + 1
+    suspicious_trips = np.unique(stop_times.trip_idx[suspicious_rows])
+    if trips_mask is not None:
+        suspicious_trips = suspicious_trips[trips_mask[suspicious_trips]]
+    bad_stop_times = []
+    for trip in suspicious_trips:
+        try:
+            validate_trip_stop_times(stop_times, trip)
+        except ValueError as e:
+            bad_stop_times.append((int(trip), str(e)))
+    return bad_stop_times
+
+
+def validate_trip_stop_times(stop_times, trip):
+    start, end = stop_times.trip_rows(trip)
+    noon = time_text_to_int("12:00:00")
+    prev_departure_time = 0
+    for i in range(start, end):
+        arrival_time = stop_times.arrival_time[i]
+        # Check if arrival time is before prev depatrue time
+        # arrival time of 00:02:00 is before previous departure time 23:52:00,
+        if arrival_time < prev_departure_time:
+            if arrival_time < noon and prev_departure_time > noon:
+                # Do heuristics which assumes trip doesn't take more then 12 hours.
+                # If this happens then we crossed midnight, so this is ok
+                log_to_file("identified day transfer")
+            elif stop_times.station_idx[i] == stop_times.station_idx[i-1]:
+                # 1. The trip is visiting the same station twice
+                log_to_file("identified same station twice")
+                # swap arival\departure times...
+                for times in (stop_times.arrival_time, stop_times.departure_time):
+                    times[i-1], times[i] = times[i], times[i-1]
+            else:
+                # 2. The times are simply messed up
+                # For now just keep it that way, from a few trips i've examined i saw that this is probably a mistake
+                # The sequences are correct, but the times are not.
+                raise ValueError("arrival time of {} is before previous departure time {}, sequences {}, {}".format(
+                    time_int_to_text(arrival_time), time_int_to_text(prev_departure_time),
+                    stop_times.stop_sequence[i], stop_times.stop_sequence[i-1]))
+        prev_departure_time = stop_times.departure_time[i]
+
+
+# ************************************* #
+# Parallel stop_times parsing
+# ************************************* #
+# stop_times.txt is split into byte ranges that start and end on line boundaries.
+# Workers parse and validate their range, and hand the arrays back through .npy files in a temp folder,
+# so rows are never pickled through the pool's pipe - only file names and small summaries are.
+# Trips that are split between ranges are validated by the parent after the merge.
+
+_STOP_TIMES_CHUNK_FIELDS = ("trip_idx", "station_idx", "stop_sequence", "arrival_time", "departure_time")
+
+
+def split_file_ranges(file_path, num_chunks):
+    """
+    Split a csv file into num_chunks byte ranges [start, end), aligned to line boundaries, skipping the header line.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        f.readline()
+        data_start = f.tell()
+        boundaries = [data_start]
+        for i in range(1, num_chunks):
+            f.seek(max(data_start + (file_size - data_start) * i // num_chunks, boundaries[-1]))
+            # Move forward to the start of the next line
+            if f.tell() > data_start:
+                f.seek(f.tell() - 1)
+                f.readline()
+            if f.tell() > boundaries[-1] and f.tell() < file_size:
+                boundaries.append(f.tell())
+        boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+_worker_state = {}
+
+def init_stop_times_worker(file_path, header, trip_ids, station_ids):
+    # Runs once per worker process, so the id dicts are sent once per worker and not once per chunk.
+    _worker_state["file_path"] = file_path
+    _worker_state["header"] = header
+    _worker_state["trip_ids"] = trip_ids
+    _worker_state["trip_index"] = {t: i for i, t in enumerate(trip_ids)}
+    _worker_state["station_index"] = {s: i for i, s in enumerate(station_ids)}
+
+
+def _chunk_file(out_dir, chunk_no, name):
+    return os.path.join(out_dir, "chunk_{}_{}.npy".format(chunk_no, name))
+
+
+def parse_stop_times_chunk(chunk_no, start, end, out_dir):
+    """
+    Phase 1 - parse the byte range [start, end) of stop_times.txt, and save the raw columns.
+    returns a small summary - (chunk_no, num_rows, trips in chunk, unknown trip rows, bad trips, seconds)
+    """
+    t = time.perf_counter()
+    with open(_worker_state["file_path"], "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("utf-8").split("\n")
+    columns = parse_columns(lines, _worker_state["header"], stop_times_columns(_worker_state["trip_index"], _worker_state["station_index"]))
+    for name, column in columns.items():
+        np.save(_chunk_file(out_dir, chunk_no, "raw_" + name), column)
+    unknown_trip_rows, bad_trips = find_unrepresentable_trips(columns, len(_worker_state["trip_ids"]))
+    trip_col = columns["trip_id"]
+    chunk_trips = np.unique(trip_col[trip_col != MISSING_VALUE])
+    return chunk_no, len(trip_col), chunk_trips, unknown_trip_rows, np.flatnonzero(bad_trips), time.perf_counter() - t
+
+
+def validate_stop_times_chunk(chunk_no, out_dir, bad_trips, split_trips, validate=True):
+    """
+    Phase 2 - drop bad trips, sort the chunk by (trip, stop_sequence) and validate the trips that are fully inside this chunk.
+    @bad_trips, @split_trips - trip idx arrays, gathered from all chunks by the parent.
+    returns (chunk_no, num_rows, [(trip idx, error)], seconds)
+    """
+    t = time.perf_counter()
+    num_trips = len(_worker_state["trip_ids"])
+    columns = {name: np.load(_chunk_file(out_dir, chunk_no, "raw_" + name)) for name in ("trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time")}
+    bad_mask = np.zeros(num_trips, dtype=bool)
+    bad_mask[bad_trips] = True
+    chunk = StopTimesTable.from_unsorted(_worker_state["trip_ids"], None, drop_trips(columns, bad_mask))
+    bad_stop_times = []
+    if validate:
+        owned_trips = np.ones(num_trips, dtype=bool)
+        owned_trips[split_trips] = False
+        bad_stop_times = validate_stop_times(chunk, owned_trips)
+    for name in _STOP_TIMES_CHUNK_FIELDS:
+        np.save(_chunk_file(out_dir, chunk_no, name), getattr(chunk, name))
+    return chunk_no, len(chunk.trip_idx), bad_stop_times, time.perf_counter() - t
+
+
+def load_stop_times_chunks(out_dir, num_chunks):
+    # Concatenate the validated chunks, loaded with mmap so the only copy is the concatenated array.
+    return {name: np.concatenate([np.load(_chunk_file(out_dir, chunk_no, name), mmap_mode="r") for chunk_no in range(num_chunks)])
+            for name in _STOP_TIMES_CHUNK_FIELDS}
@@ -0,0 +1,357 @@
+from bisect import bisect_left
+from dataclasses import dataclass
+import time
+
+from utils import time_to_int, time_int_to_text, FOOTPATH_ID, CAR_ROUTE_ID, is_footpath, print_log
+from connection_builder import Connection, TripView, get_tlv_timetable
+from query_timetable import QueryTimetable
+from raptor_routing import RaptorRouter, RaptorResult_v2, run_ultra_wrapper, BENCHMARK_ODS, DEFAULT_WALKING_RADIUS, INITIAL_ARRIVAL_TIME
+from pattern_raptor_routing import PatternScanner
+
+# McRAPTOR (Delling et al. "Round-Based Public Transit Routing") - multi criteria RAPTOR.
+# raptor_route keeps one label per station (the earliest arrival) and one result per round. Here every station has a bag
+# of Pareto labels - no label in it is as good as another in all criteria - and the result is the Pareto set of journeys.
+# Transfers are a criterion through the rounds (a label of round k has k trips, and bags hold labels of all rounds so far,
+# so a label is only added if no label with as few trips dominates it). The other criteria are picked by name:
+#   "arrival" - arrival time, always a criterion
+#   "walking" - seconds of walking - from the start, transfers and to the end
+#   "car_deviation" - seconds a car drop off adds to the driver's route (car_routing.get_car_route_sources(return_deviations=True))
+# A pattern is scanned with a route bag - labels riding a trip (trip row, walking, deviation), dominance on the trip row
+# instead of the arrival, since trips of a pattern don't overtake each other.
+# Labels are pruned by the target's bag - a label something already at the end beats can't get better.
+
+ARRIVAL = "arrival"
+WALKING = "walking"
+CAR_DEVIATION = "car_deviation"
+DEFAULT_CRITERIA = (ARRIVAL,)
+CRITERIA_INDICES = {ARRIVAL: 0, WALKING: 1, CAR_DEVIATION: 2}
+DEFAULT_MAX_TRIPS = 3 # raptor_route's 4 rounds - walking from the start, then 3 trips
+
+# A label is a tuple (arrival_time, walking_time, car_deviation, station, previous label, leg)
+# leg - ("start", departure_time, trip_id) / ("walk",) / ("trip", trip_id, board stop, alight stop),
+#   labels at the end station (the target bag) - ("walk", number of trips)
+
+
+@dataclass
+class McJourney:
+    arrival_time: int
+    num_trips: int
+    walking_time: int
+    car_deviation: int
+    result: RaptorResult_v2
+
+    def __str__(self):
+        return f"McJourney: arrive at {time_int_to_text(self.arrival_time)}, {self.num_trips} trips, {self.walking_time // 60} minutes walking, {self.car_deviation} seconds car deviation"
+
+
+class McRaptorSearch(object):
+    """
+    One McRAPTOR query over route patterns, from sources to targets.
+    bags - station -> Pareto labels of all rounds so far
+    """
+    def __init__(self, tt, start_station, end_station, start_time, criteria=DEFAULT_CRITERIA, transfers=None, limit_mid_walking_time=60*6,
+                 max_trips=DEFAULT_MAX_TRIPS, max_journey_time=None):
+        """
+        @criteria - names of the criteria besides the number of trips (see above)
+        @transfers - station_id -> footpaths sorted by time (tt.stations_footpaths, ultra_shortcuts.get_transfer_shortcuts), None for no transfers
+        @max_journey_time - seconds from start_time, labels arriving later are dropped. None for no limit, like raptor_route.
+        """
+        self.tt = tt
+        self.patterns = tt.get_route_patterns()
+        self.start_station = start_station
+        self.end_station = end_station
+        self.start_time = time_to_int(start_time)
+        self.dims = sorted({CRITERIA_INDICES[ARRIVAL]} | {CRITERIA_INDICES[c] for c in criteria})
+        # the route bag compares the trip row instead of the arrival time
+        self.route_dims = [d for d in self.dims if d != CRITERIA_INDICES[ARRIVAL]]
+        self.transfers = {} if transfers is None else \
+            {station_id: [(f["time"], f["station_id"]) for f in footpaths if f["time"] <= limit_mid_walking_time] for station_id, footpaths in transfers.items()}
+        self.max_trips = max_trips
+        self.max_arrival_time = INITIAL_ARRIVAL_TIME if max_journey_time is None else self.start_time + max_journey_time
+        self.bags = {}
+        self.target_bag = []
+        self.num_labels = 0
+        self.num_route_labels = 0
+
+    def _dominates(self, first, second):
+        for d in self.dims:
+            if first[d] > second[d]:
+                return False
+        return True
+
+    def _add(self, station, label):
+        """
+        returns True if label is added to the bag of station - nothing in it or in the target bag dominates it
+        """
+        if label[0] > self.max_arrival_time:
+            return False
+        for other in self.target_bag:
+            if self._dominates(other, label):
+                return False
+        bag = self.bags.get(station)
+        if bag is None:
+            self.bags[station] = [label]
+        else:
+            for other in bag:
+                if self._dominates(other, label):
+                    return False
+            bag[:] = [other for other in bag if not self._dominates(label, other)]
+            bag.append(label)
+        self.num_labels += 1
+        return True
+
+    def _in_bag(self, station, label):
+        # labels carry their whole journey, compare identity and not tuples
+        return any(other is label for other in self.bags.get(station, ()))
+
+    def _add_route_label(self, route_bag, route_label):
+        # route_label - (trip row, walking, deviation, boarding label, board stop)
+        for other in route_bag:
+            if other[0] <= route_label[0] and all(other[d] <= route_label[d] for d in self.route_dims):
+                return
+        route_bag[:] = [other for other in route_bag
+                        if not (route_label[0] <= other[0] and all(route_label[d] <= other[d] for d in self.route_dims))]
+        route_bag.append(route_label)
+        self.num_route_labels += 1
+
+    def _scan_patterns(self, marked):
+        """
+        @marked - station -> labels added last round
+        returns station -> labels added this round
+        """
+        station_patterns = self.patterns.station_patterns
+        patterns_to_scan = {}
+        for station in marked:
+            for p, i in station_patterns.get(station, ()):
+                if p not in patterns_to_scan or i < patterns_to_scan[p]:
+                    patterns_to_scan[p] = i
+
+        improved = {}
+        for p, first_stop in patterns_to_scan.items():
+            pattern = self.patterns[p]
+            departures_by_stop, arrivals_by_trip = pattern.scan_arrays()
+            stops = pattern.stops
+            last_stop = len(stops) - 1
+            route_bag = []
+            for i in range(first_stop, len(stops)):
+                station = stops[i]
+                for trip, walking_time, car_deviation, board_label, board_stop in route_bag:
+                    label = (arrivals_by_trip[trip][i], walking_time, car_deviation, station, board_label,
+                             ("trip", pattern.trip_ids[trip], board_stop, i))
+                    if self._add(station, label):
+                        improved.setdefault(station, []).append(label)
+
+                if i == last_stop or station not in marked:
+                    continue
+                departures = departures_by_stop[i]
+                for label in marked[station]:
+                    trip = bisect_left(departures, label[0])
+                    if trip < len(pattern) and departures[trip] <= self.max_arrival_time:
+                        self._add_route_label(route_bag, (trip, label[1], label[2], label, i))
+        return improved
+
+    def _relax_transfers(self, improved):
+        """
+        returns improved, with the labels of walking from its stations added
+        """
+        result = {station: list(labels) for station, labels in improved.items()}
+        for station, labels in improved.items():
+            for label in labels:
+                if not self._in_bag(station, label):
+                    continue
+                for transfer_time, target in self.transfers.get(station, ()):
+                    walk_label = (label[0] + transfer_time, label[1] + transfer_time, label[2], target, label, ("walk",))
+                    if walk_label[0] > self.max_arrival_time:
+                        break
+                    if self._add(target, walk_label):
+                        result.setdefault(target, []).append(walk_label)
+        return result
+
+    def _reach_targets(self, improved, targets, num_trips):
+        for station, labels in improved.items():
+            if station not in targets:
+                continue
+            walking_time = targets[station]
+            for label in labels:
+                if not self._in_bag(station, label):
+                    continue
+                target_label = (label[0] + walking_time, label[1] + walking_time, label[2], self.end_station, label, ("walk", num_trips))
+                if any(self._dominates(other, target_label) for other in self.target_bag):
+                    continue
+                # rounds come in order - only journeys of this round can have as many trips as this one
+                self.target_bag = [other for other in self.target_bag
+                                   if other[5][1] < num_trips or not self._dominates(target_label, other)]
+                self.target_bag.append(target_label)
+
+    def _trace(self, target_label):
+        route = []
+        label = target_label
+        while label is not None:
+            arrival_time, _, _, station, previous, leg = label
+            if leg[0] == "start":
+                connections = [Connection(self.start_station, station, leg[1], arrival_time, leg[2])]
+            elif leg[0] == "walk":
+                connections = [Connection(previous[3], station, previous[0], arrival_time, FOOTPATH_ID)]
+            else:
+                connections = TripView(self.tt.trip_connections[leg[1]], leg[2], leg[3])
+            route.insert(0, (station, connections))
+            label = previous
+        return RaptorResult_v2(route, self.tt)
+
+    def run(self, sources, targets):
+        """
+        @sources - list of legs from the start - (station_id, arrival time, trip id, walking seconds, car deviation seconds).
+            A station can have several (walking there, and a car drop off) - the criteria decide which are kept.
+        @targets - station_id -> walking seconds to the end station
+        returns the Pareto set of McJourney, fewer trips first
+        """
+        marked = {}
+        for station, arrival_time, trip_id, walking_time, car_deviation in sources:
+            if arrival_time < self.start_time:
+                continue
+            label = (arrival_time, walking_time, car_deviation, station, None, ("start", self.start_time, trip_id))
+            if self._add(station, label):
+                marked.setdefault(station, []).append(label)
+        marked = self._relax_transfers(marked)
+        self._reach_targets(marked, targets, 0)
+
+        for num_trips in range(1, self.max_trips + 1):
+            if len(marked) == 0:
+                break
+            improved = self._scan_patterns(marked)
+            marked = self._relax_transfers(improved)
+            self._reach_targets(marked, targets, num_trips)
+
+        journeys = []
+        for target_label in self.target_bag:
+            journeys.append(McJourney(target_label[0], target_label[5][1], target_label[1], target_label[2], self._trace(target_label)))
+        return sorted(journeys, key=lambda j: (j.num_trips, j.arrival_time))
+
+
+def mc_raptor_route(start_station, end_station, start_time, tt, sources, targets, criteria=DEFAULT_CRITERIA, relax_footpaths=True, limit_mid_walking_time=60*6,
+                    transfer_shortcuts=None, max_trips=DEFAULT_MAX_TRIPS):
+    """
+    McRAPTOR from sources to targets.
+    @sources - list of (station_id, arrival time, trip id, walking seconds, car deviation seconds), see McRaptorSearch.run
+    @targets - station_id -> walking seconds to end_station
+    @criteria - criteria besides the number of trips, ARRIVAL / WALKING / CAR_DEVIATION
+    @transfer_shortcuts - like raptor_route, relaxed instead of tt.stations_footpaths and without limit_mid_walking_time
+    returns (the Pareto set of McJourney, the McRaptorSearch - for its counters)
+    """
+    transfers = None
+    if relax_footpaths:
+        transfers = tt.stations_footpaths if transfer_shortcuts is None else transfer_shortcuts
+        if transfer_shortcuts is not None:
+            limit_mid_walking_time = 24 * 60 * 60
+    search = McRaptorSearch(tt, start_station, end_station, start_time, criteria=criteria, transfers=transfers,
+                            limit_mid_walking_time=limit_mid_walking_time, max_trips=max_trips)
+    journeys = search.run(sources, targets)
+    return journeys, search
+
+
+def run_mc_raptor_wrapper(start_loc, end_loc, start_time, tt, criteria=DEFAULT_CRITERIA, relax_footpaths=True, limit_walking_time=60*60, service_date=None,
+                          walking_engine=None, transfer_shortcuts=None, walking_radius=DEFAULT_WALKING_RADIUS, car_sources=None, car_deviations=None,
+                          return_search=False):
+    """
+    Like run_ultra_wrapper, with McRAPTOR.
+    @car_sources / car_deviations - car_routing.get_car_route_sources(..., return_deviations=True)
+    @return_search - also return the McRaptorSearch (label counters)
+    returns the Pareto set of McJourney, fewer trips first
+    """
+    if service_date is not None:
+        tt = tt.for_service_date(service_date)
+    if not isinstance(tt, QueryTimetable):
+        tt = tt.for_query()
+    start_time = time_to_int(start_time)
+    rr = RaptorRouter(tt, walking_engine=walking_engine)
+    start_lon_lat = {"lat": start_loc["stop_lat"], "lon": start_loc["stop_lon"]}
+    end_lon_lat = {"lat": end_loc["stop_lat"], "lon": end_loc["stop_lon"]}
+    start_station = tt._create_walking_station(start_lon_lat, name="Start")
+    end_station = tt._create_walking_station(end_lon_lat, name="End")
+    radius = None if walking_radius is None else min(walking_radius, limit_walking_time * rr.walking_speed)
+    access, targets = rr._walking_sources_targets(start_station, end_station, start_lon_lat, end_lon_lat, tt, radius, limit_walking_time=limit_walking_time)
+    targets = {station_id: walking_time for station_id, walking_time in targets.items() if walking_time < limit_walking_time}
+
+    sources = [(station_id, start_time + walking_time, FOOTPATH_ID, walking_time, 0) for station_id, walking_time in access.items()]
+    if car_sources is not None:
+        car_deviations = car_deviations or {}
+        sources += [(station_id, arrival_time, CAR_ROUTE_ID, 0, car_deviations.get(station_id, 0)) for station_id, arrival_time in car_sources.items()]
+
+    journeys, search = mc_raptor_route(start_station["station_id"], end_station["station_id"], start_time, tt, sources, targets, criteria=criteria,
+                                       relax_footpaths=relax_footpaths, transfer_shortcuts=transfer_shortcuts)
+    if return_search:
+        return journeys, search
+    return journeys
+
+
+############################################################
+### TEST MC RAPTOR #########################################
+############################################################
+
+def _num_trips(result):
+    return sum(1 for _, connections in result.result_route if not is_footpath(connections[0].trip_id))
+
+def test_mc_raptor_parity(ods=BENCHMARK_ODS, limit_walking_time=60*15):
+    """
+    With arrival time only (and trips), every raptor_route result (PatternScanner) should be matched by a McRAPTOR journey
+    with no more trips that arrives as early.
+    returns True if it was
+    """
+    tt = get_tlv_timetable()
+    all_matched = True
+    for start_loc, end_loc, start_time in ods:
+        journeys = run_mc_raptor_wrapper(start_loc, end_loc, start_time, tt, limit_walking_time=limit_walking_time)
+        for r in run_ultra_wrapper(start_loc, end_loc, start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner) or []:
+            if not any(j.num_trips <= _num_trips(r) and j.arrival_time <= r.arrival_time for j in journeys):
+                print(f"    [!] {start_time} - {r} isn't matched by McRAPTOR")
+                all_matched = False
+    if all_matched:
+        print_log("McRAPTOR matches every raptor_route result")
+    return all_matched
+
+def test_mc_raptor_scaling(ods=BENCHMARK_ODS, limit_walking_time=60*15, repeat=3):
+    """
+    Benchmark - labels and latency of McRAPTOR by criteria, on the benchmark ODs.
+    The car deviation criterion is benchmarked on the car query of test_ultra_route_with_car, against the same query without it.
+    """
+    from car_routing import get_car_route_sources
+    tt = get_tlv_timetable()
+    # mapped timetables materialize stations on first use, don't time that
+    for start_loc, end_loc, start_time in ods:
+        run_mc_raptor_wrapper(start_loc, end_loc, start_time, tt, criteria=(ARRIVAL, WALKING), limit_walking_time=limit_walking_time)
+
+    def bench(criteria, queries):
+        total_time, labels, route_labels, journeys = 0, 0, 0, 0
+        for _ in range(repeat):
+            for start_loc, end_loc, start_time, car_sources, car_deviations in queries:
+                query_start = time.perf_counter()
+                query_journeys, search = run_mc_raptor_wrapper(start_loc, end_loc, start_time, tt, criteria=criteria, limit_walking_time=limit_walking_time,
+                                                               car_sources=car_sources, car_deviations=car_deviations, return_search=True)
+                total_time += time.perf_counter() - query_start
+                labels += search.num_labels
+                route_labels += search.num_route_labels
+                journeys += len(query_journeys)
+        num_queries = repeat * len(queries)
+        print(f"    {' + '.join(('trips',) + criteria):<40} {total_time / num_queries * 1000:8.2f} ms {labels / num_queries:10.1f} labels "
+              f"{route_labels / num_queries:10.1f} route labels {journeys / num_queries:6.1f} journeys")
+
+    walking_queries = [(start_loc, end_loc, start_time, None, None) for start_loc, end_loc, start_time in ods]
+    print("[+] McRAPTOR on the benchmark ODs, per query:")
+    for criteria in [(ARRIVAL,), (ARRIVAL, WALKING)]:
+        bench(criteria, walking_queries)
+
+    start_loc, end_loc, start_time = ods[0]
+    car_sources, car_deviations = get_car_route_sources(tt, {"lat": start_loc["stop_lat"], "lon": start_loc["stop_lon"]}, {"lat": 32.14188, "lon": 34.84082},
+                                                        start_time, deviation=60*2, return_deviations=True)
+    car_queries = [(start_loc, end_loc, start_time, car_sources, car_deviations)]
+    print(f"[+] McRAPTOR on a car query ({len(car_sources)} drop off stations), per query:")
+    for criteria in [(ARRIVAL,), (ARRIVAL, WALKING), (ARRIVAL, CAR_DEVIATION), (ARRIVAL, WALKING, CAR_DEVIATION)]:
+        bench(criteria, car_queries)
+
+
+def main():
+    test_mc_raptor_parity()
+    test_mc_raptor_scaling()
+
+if __name__ == "__main__":
+    main()
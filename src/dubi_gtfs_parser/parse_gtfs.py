@@ -2,10 +2,17 @@ import os
 import matplotlib.pyplot as plt
 import tilemapbase
 import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from codetiming import Timer
 
 from display import display_all_gtfs_stations, display_all_gtfs_stations_for_trip, display_gtfs_trip, display_gtfs_trip_shapes, get_stations_area
 
 from utils import *
+from gtfs_tables import IdInterner, ColumnarCSVParser, StopTimesTable, ShapesTable, cached_converter, stop_times_columns, \
+    find_unrepresentable_trips, drop_trips, validate_stop_times, split_file_ranges, init_stop_times_worker, parse_stop_times_chunk, \
+    validate_stop_times_chunk, load_stop_times_chunks
 
 VALIDATE = True
 COMPLETE_PARSE = False
@@ -59,6 +66,9 @@ class GTFS:
     @agencies - a dict of agency, which translate agency_id to data {"agency_id": "1", "agency_name": "Dan", "agency_url" :"<url>", 'agency_timezone': 'Asia/Jerusalem', 'agency_lang': 'he'}
     
     @calendar - a list of service options {'service_id': '1', 'sunday': '1', 'monday': '1', 'tuesday': '1', 'wednesday': '1', 'thursday': '1', 'friday': '1', 'saturday': '0', 'start_date': '20230209', 'end_date': '20230311'}
+
+    @calendar_dates - optional exceptions to calendar, service_id -> [{'service_id': '1', 'date': '20230215', 'exception_type': '2'}] (1 - added, 2 - removed)
+        empty if the feed has no calendar_dates.txt
     
     @stations - a list of stations  {'stations': '1', 'stop_code': '38831', 'stop_name': "בי''ס בר לב/בן יהודה", 'stop_desc': 'רחוב: בן יהודה 74 עיר: כפר סבא רציף:  קומה: ',
       'stop_lat': '32.183985', 'stop_lon': '34.917554', 'location_type': '0', 'parent_station': '', 'zone_id': '38831'}
@@ -76,15 +86,21 @@ class GTFS:
         11 - Trolleybus. Electric buses that draw power from overhead wires using poles.
         12 - Monorail. Railway in which the track consists of a single rail or a beam.
     
+    @station_ids - IdInterner of station ids, @stations_lat, @stations_lon - float64 arrays indexed by station_ids.
+
     @shapes - list of shapes, in original specifications each shape is 2 dots in a shape-sequence, determined by the sequence_id.
             We will process it so that each shape is a list of dots, and we will drop "shape_pt_sequence" field.
-        {'shape_id': '44779', 'shape_pt_lat': '31.887695', 'shape_pt_lon': '35.016271', 'shape_pt_sequence': '1'}
-    
+        {'shape_id': '44779', 'shape_pt_lat': 31.887695, 'shape_pt_lon': 35.016271, 'shape_pt_sequence': 0}
+        This is a columnar ShapesTable, shapes[shape_id] still returns the list of dots.
+
     @trips - a list of trips, each trip is a sequence of connections.
         {'route_id': '68', 'service_id': '18668', 'trip_id': '4240_090223', 'trip_headsign': 'תל אביב יפו_תחנה מרכזית', 'direction_id': '0', 'shape_id': '128020'}
-    
+    @trip_ids - IdInterner of trip ids
+
     @stop_times - a list of stops for each trips.
     trip_id,arrival_time,departure_time,stop_id,stop_sequence,pickup_type,drop_off_type,shape_dist_traveled
+        This is a columnar StopTimesTable (int32 times and interned ids), stop_times[trip_id] still returns a list of stop dicts,
+        {'trip_id', 'station_id', 'arrival_time', 'departure_time', 'stop_sequence'} where times are int seconds from the start of the service day
 
     
         
@@ -94,15 +110,20 @@ class GTFS:
     # I can create connections by iterating stop_times of a given trip and create a connection for each pair of consecutive stop_times.
     """
 
-    def __init__(self, folder_path, load_existing=False) -> None:
+    def __init__(self, folder_path, load_existing=False, parallel_workers=None) -> None:
+        """
+        @parallel_workers - if set, stop_times.txt is parsed in chunks by a pool of this many processes.
+        """
         # In init read all the files and create a dict of dataframes
         if not os.path.isdir(folder_path):
             raise ValueError("The path provided is not a directory")
         self.folder_path = folder_path
+        self.parallel_workers = parallel_workers
         self.area = None
         # Note - parsing order is important. 
         self.agencies = self._parse_agencies()
         self.calendar = self._parse_calendar()
+        self.calendar_dates = self._parse_calendar_dates()
 
         self.stations = self._parse_stations()
         self.routes = self._parse_routes()
@@ -134,16 +155,13 @@ class GTFS:
             station["station_id"] = station["stop_id"]
             del station["stop_id"]
 
+        # Intern station ids, so the big tables can hold them as ints, and keep coordinates as floats once.
+        self.station_ids = IdInterner(stations.keys())
+        self.stations_lat = np.array([float(s["stop_lat"]) for s in stations.values()], dtype=np.float64)
+        self.stations_lon = np.array([float(s["stop_lon"]) for s in stations.values()], dtype=np.float64)
+
         # Define area based on furthest stop
-        min_lon = min(stations.values(), key=lambda x: float(x["stop_lon"]))
-        max_lon = max(stations.values(), key=lambda x: float(x["stop_lon"]))
-        min_lat = min(stations.values(), key=lambda x: float(x["stop_lat"]))
-        max_lat = max(stations.values(), key=lambda x: float(x["stop_lat"]))
-        # print("min_lon - ", min_lon)
-        # print("max_lon - ", max_lon)
-        # print("min_lat - ", min_lat)
-        # print("max_lat - ", max_lat)
-        self.area = (float(min_lon["stop_lon"]), float(max_lon["stop_lon"]), float(min_lat["stop_lat"]), float(max_lat["stop_lat"])) 
+        self.area = (float(self.stations_lon.min()), float(self.stations_lon.max()), float(self.stations_lat.min()), float(self.stations_lat.max()))
         return stations
     
     def _parse_routes(self):
@@ -167,31 +185,36 @@ class GTFS:
         parser = CSVParser(curr_path)
         calendar = parser.parse(id_tag="service_id")
         return calendar
+
+    def _parse_calendar_dates(self):
+        curr_path = os.path.join(self.folder_path, "calendar_dates.txt")
+        if not os.path.isfile(curr_path):
+            # The israeli feed only has calendar.txt
+            return {}
+        parser = CSVParser(curr_path)
+        return parser.parse(id_tag="service_id", dup_ids_allowed=True)
     
     def _parse_shapes(self):
         curr_path = os.path.join(self.folder_path, "shapes.txt")
-        parser = CSVParser(curr_path)
-        shapes = parser.parse(id_tag="shape_id", dup_ids_allowed=True)
-        
+        parser = ColumnarCSVParser(curr_path)
+        shape_ids = IdInterner()
+        columns = parser.parse({"shape_id": ("i", cached_converter(shape_ids.intern)),
+                                "shape_pt_lat": ("d", float),
+                                "shape_pt_lon": ("d", float),
+                                "shape_pt_sequence": ("i", int)})
+        # Group by shape, stable sort keeps the file order of the dots inside each shape
+        order = np.argsort(columns["shape_id"], kind="stable")
+        shape_idx = columns["shape_id"][order]
+        sequence = columns["shape_pt_sequence"][order]
+
         if VALIDATE:
-            for shape_list in shapes.values():
-             
-                prev_sequence = -1
-                for i, shape in enumerate(shape_list):
-                    if int(shape["shape_pt_sequence"]) < prev_sequence:
-                        raise ValueError("shape_pt_sequence {}, {} in wrong order in shapes".format(prev_sequence, shape["shape_pt_sequence"]))
-                    shape["shape_pt_sequence"] = i
-                    prev_sequence = shape["shape_pt_sequence"]
-
-        # # Connect shapes of the same shape_id
-        # shapes_dict = {}
-        # for s in shapes:
-        #     if s["shape_id"] not in shapes_dict:
-        #         shapes_dict[s["shape_id"]] = []
-            
-        #     shapes_dict[s["shape_id"]].append(s)
-
-        return shapes
+            same_shape = shape_idx[1:] == shape_idx[:-1]
+            bad = np.flatnonzero(same_shape & (sequence[1:] < sequence[:-1]))
+            if len(bad) > 0:
+                raise ValueError("shape_pt_sequence {}, {} in wrong order in shapes".format(sequence[bad[0]], sequence[bad[0] + 1]))
+
+        # shape_pt_sequence is not kept, the index of the dot inside the shape replaces it
+        return ShapesTable(shape_ids, shape_idx, columns["shape_pt_lat"][order], columns["shape_pt_lon"][order])
 
     def _parse_trips(self):
         if self.routes is None or self.calendar is None or self.shapes is None:
@@ -211,7 +234,7 @@ class GTFS:
                 if i % 1000 == 0:
                     print_log("validated {} trips...".format(i))
                 try:
-                    if t["service_id"] not in self.calendar:
+                    if t["service_id"] not in self.calendar and t["service_id"] not in self.calendar_dates:
                         raise ValueError("service_id {} not found in calendar".format(t["service_id"]))
                     if t["route_id"] not in self.routes:
                         raise ValueError("route_id {} not found in routes".format(t["route_id"]))
@@ -242,6 +265,7 @@ class GTFS:
         car_trip = {'route_id': CAR_ROUTE_ID, 'service_id': '0', 'trip_id': CAR_ROUTE_ID, 'trip_headsign': 'Car Drive', 'direction_id': '0', 'shape_id': ''}
         trips[CAR_ROUTE_ID] = car_trip
 
+        self.trip_ids = IdInterner(trips.keys())
         return trips
 
     def _search_circle_in_stops_or_shapes(self, stops, shapes):
@@ -455,97 +479,22 @@ class GTFS:
         # trip_id,arrival_time,departure_time,stop_id(station_id),stop_sequence,pickup_type,drop_off_type,shape_dist_traveled
         curr_path = os.path.join(self.folder_path, "stop_times.txt")
         # Merge stop_times with by trips (and not by stations...?)
-        parser = CSVParser(curr_path)
-        stop_times = parser.parse(id_tag="trip_id", dup_ids_allowed=True)
-
-        # Rename stop_id to station_id
-        for trip_stops in stop_times.values():
-            for stop in trip_stops:
-                stop["station_id"] = stop["stop_id"]
-                del stop["stop_id"]
-
+        # Parse straight into typed columns - trips and stations are already parsed, so their ids are already interned.
+        # self.parse_timings holds the time in seconds each phase took.
+        self.parse_timings = {}
+        if self.parallel_workers:
+            stop_times, bad_stop_times = self._parse_stop_times_parallel(curr_path, self.parallel_workers)
+        else:
+            stop_times, bad_stop_times = self._parse_stop_times_serial(curr_path)
 
-        # arrange stops by stop_sequence
-        # for s in stop_times.keys():
-        #     stop_times[s] = sorted(stop_times["s"]
-        bad_stop_times = []
+        if len(bad_stop_times) > 0:
+            error_log_to_file("Got bad stop_times:")
+            error_log_to_file(bad_stop_times)
+        print_log(f"got {len(bad_stop_times)} bad stop_times out of {len(bad_stop_times) + len(stop_times)} stop_times")
+        print_log("stop_times parse timings - " + ", ".join(f"{phase}: {t:.2f}s" for phase, t in self.parse_timings.items()))
 
-        if VALIDATE:
-            # Validate stop times
-            print_log("validating stop times....")
-            for i, (st_keys, st_list) in enumerate(stop_times.items()):
-                if i % 1000 == 0:
-                    print_log("validated {} stop_times...".format(i))
-                try:
-                    # sort this by stop_sequence, as we've seen it's not always sorted
-                    sorted_st_list = sorted(st_list, key=lambda x: int(x["stop_sequence"]))
-                    stop_times[st_keys] = sorted_st_list
-                    prev_sequence = -1
-                    prev_dipartue_time = "00:00:00"
-                    prev_stop = None
-                    # TODO: some sequences are not ordered currectly - maybe add a sort here (it's only about 200 out of 191592)
-                    for st in sorted_st_list:
-                        if st["trip_id"] not in self.trips:
-                            raise ValueError("trip_id {} not found in trips".format(st["trip_id"]))
-                        if st["station_id"] not in self.stations:
-                            raise ValueError("station_id {} not found in routes".format(st["station_id"]))
-                        if int(st["stop_sequence"]) < prev_sequence:
-                            # TODO: this jumps alot, which means that this is not sorted in any way
-                            # From an investigation i did, it seesm like the sequence is not right in 2 cases
-                            # * sometimes when the same stations is visited twice in the same trip.
-                            # * sometimes when the trip time is crossing midnight
-                            raise ValueError("stop_sequence {}, {} in wrong order in stop_times".format(prev_sequence, st["stop_sequence"]))
-                        
-                        # Check if arrival time is before prev depatrue time
-                        # arrival time of 00:02:00 is before previous departure time 23:52:00,               
-                        if time_text_to_int(st["arrival_time"]) < time_text_to_int(prev_dipartue_time):
-                            if time_text_to_int(st["arrival_time"]) < time_text_to_int("12:00:00") and time_text_to_int(prev_dipartue_time) > time_text_to_int("12:00:00"):
-                                # Do heuristics which assumes trip doesn't take more then 12 hours.
-                                # If this happens then we crossed midnight, so this is ok
-                                log_to_file("identified day transfer")
-                            else:
-                                # After sequences are sorted out then several things might be bad
-                                # 1. The trip is visiting the same station twice
-                                if st["station_id"] == prev_stop["station_id"]:
-                                    log_to_file("identified same station twice")
-                                    # swap arival\departure times...
-                                    tmp_arrival = st["arrival_time"]
-                                    tmp_departure = st["departure_time"]
-                                    st["arrival_time"] = prev_stop["arrival_time"]
-                                    st["departure_time"] = prev_stop["departure_time"]
-                                    prev_stop["arrival_time"] = tmp_arrival
-                                    prev_stop["departure_time"] = tmp_departure
-                                else:
-                                    # 2. The times are simply messed up
-                                    # For now just keep it that way, from a few trips i've examined i saw that this is probably a mistake
-                                    # The sequences are correct, but the times are not.
-                                    # And that by always fixing the arrival time to be after the previous departure time, we get the right order.
-                                    raise ValueError("arrival time of {} is before previous departure time {}, sequences {}, {}".format(
-                                        st["arrival_time"], prev_dipartue_time, st["stop_sequence"], prev_sequence))
-                        
-                        prev_sequence = int(st["stop_sequence"])
-                        prev_dipartue_time = st["departure_time"]
-                        prev_stop = st
-                except ValueError as e:
-                    # print("got exception on stop_times - ", st_list, i)
-                    bad_stop_times.append((sorted_st_list, str(e)))
-                    prev_sequence = -1
-                    prev_dipartue_time = "00:00:00"
-                    continue
-                    # raise e
-            if len(bad_stop_times) > 0:
-                error_log_to_file("Got bad stop_times:")
-                error_log_to_file(bad_stop_times)
-
-            # for st_list in bad_stop_times:
-            # # Pop bad trips from trips dict - do this in different loop because of python shit
-            #     stop_times.pop(st_list[0][0]["trip_id"])
-            print_log("finished validating stop_times.")
-            # I see that i get some trips without headsigns, which screws me, because then shape_id is shifted one left.
-            # Or alternativly, there is no shape_id and the headsign is a number, which is wired. 
-            print_log(f"got {len(bad_stop_times)} bad stop_times out of {len(bad_stop_times) + len(stop_times)} stop_times")
-        
         if PREPROCESS_SHAPE_STOP_MATCHES:
+            self.stop_times = stop_times
             # Devide trip shapes between stop time - each stop will hold the shape of points from this station to the next station in the trip
             for j, trip_id in enumerate(stop_times.keys()):
                 #44779
@@ -554,6 +503,86 @@ class GTFS:
                 self.match_stops_to_shapes_for_trip(trip_id)
         return stop_times
 
+    def _parse_stop_times_serial(self, curr_path):
+        t = time.perf_counter()
+        parser = ColumnarCSVParser(curr_path)
+        columns = parser.parse(stop_times_columns(self.trip_ids.index, self.station_ids.index))
+        self.parse_timings["parse"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        unknown_trip_rows, bad_trips = find_unrepresentable_trips(columns, len(self.trip_ids))
+        bad_stop_times = self._unrepresentable_trips_errors(unknown_trip_rows, np.flatnonzero(bad_trips))
+        # sort this by stop_sequence, as we've seen it's not always sorted
+        stop_times = StopTimesTable.from_unsorted(self.trip_ids, self.station_ids, drop_trips(columns, bad_trips))
+        self.parse_timings["sort"] = time.perf_counter() - t
+
+        if VALIDATE:
+            t = time.perf_counter()
+            print_log("validating stop times....")
+            bad_stop_times += [(self.trip_ids[trip], e) for trip, e in validate_stop_times(stop_times)]
+            print_log("finished validating stop_times.")
+            self.parse_timings["validate"] = time.perf_counter() - t
+        return stop_times, bad_stop_times
+
+    def _parse_stop_times_parallel(self, curr_path, workers):
+        """
+        stop_times.txt is by far the largest file in the feed, so split it to byte ranges aligned to line boundaries,
+        and parse and validate each range in a process pool. See the parallel parsing section in gtfs_tables.
+        """
+        t = time.perf_counter()
+        header = ColumnarCSVParser(curr_path).read_header()
+        # A few chunks per worker, so a slow chunk does not hold the entire pool
+        ranges = split_file_ranges(curr_path, workers * 4)
+        self.parse_timings["split"] = time.perf_counter() - t
+
+        with tempfile.TemporaryDirectory(prefix="stop_times_chunks_") as out_dir, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_stop_times_worker,
+                                initargs=(curr_path, header, self.trip_ids.ids, self.station_ids.ids)) as pool:
+            t = time.perf_counter()
+            parsed = list(pool.map(parse_stop_times_chunk, range(len(ranges)), [r[0] for r in ranges], [r[1] for r in ranges], [out_dir] * len(ranges)))
+            self.parse_timings["parse"] = time.perf_counter() - t
+            self.parse_timings["parse (worker cpu)"] = sum(p[5] for p in parsed)
+
+            # Trips that have stops in more than one chunk can only be validated after the merge
+            chunks_per_trip = np.zeros(len(self.trip_ids), dtype=np.int32)
+            bad_trips = np.zeros(len(self.trip_ids), dtype=bool)
+            unknown_trip_rows = 0
+            for _, _, chunk_trips, chunk_unknown_trip_rows, chunk_bad_trips, _ in parsed:
+                chunks_per_trip[chunk_trips] += 1
+                bad_trips[chunk_bad_trips] = True
+                unknown_trip_rows += chunk_unknown_trip_rows
+            split_trips = np.flatnonzero(chunks_per_trip > 1)
+            bad_stop_times = self._unrepresentable_trips_errors(unknown_trip_rows, np.flatnonzero(bad_trips))
+
+            t = time.perf_counter()
+            validated = list(pool.map(validate_stop_times_chunk, range(len(ranges)), [out_dir] * len(ranges),
+                                      [np.flatnonzero(bad_trips)] * len(ranges), [split_trips] * len(ranges), [VALIDATE] * len(ranges)))
+            self.parse_timings["sort and validate"] = time.perf_counter() - t
+            self.parse_timings["sort and validate (worker cpu)"] = sum(v[3] for v in validated)
+            for _, _, chunk_bad_stop_times, _ in validated:
+                bad_stop_times += [(self.trip_ids[trip], e) for trip, e in chunk_bad_stop_times]
+
+            t = time.perf_counter()
+            stop_times = StopTimesTable.from_unsorted(self.trip_ids, self.station_ids, load_stop_times_chunks(out_dir, len(ranges)))
+            self.parse_timings["merge"] = time.perf_counter() - t
+
+        if VALIDATE and len(split_trips) > 0:
+            t = time.perf_counter()
+            split_trips_mask = np.zeros(len(self.trip_ids), dtype=bool)
+            split_trips_mask[split_trips] = True
+            bad_stop_times += [(self.trip_ids[trip], e) for trip, e in validate_stop_times(stop_times, split_trips_mask)]
+            self.parse_timings["validate split trips"] = time.perf_counter() - t
+        print_log(f"parsed stop_times in {len(ranges)} chunks with {workers} workers, {len(split_trips)} trips were split between chunks")
+        return stop_times, bad_stop_times
+
+    def _unrepresentable_trips_errors(self, unknown_trip_rows, bad_trips):
+        bad_stop_times = []
+        if unknown_trip_rows > 0:
+            bad_stop_times.append((None, "{} stop_times with trip_id not found in trips".format(unknown_trip_rows)))
+        for trip in bad_trips:
+            bad_stop_times.append((self.trip_ids[trip], "station_id not found in stations, or missing stop time"))
+        return bad_stop_times
+
 
     # ************************************* #
     # Non-mandatory tables
@@ -593,24 +622,27 @@ class GTFS:
 
 
 
-def get_is_gtfs(reparse=False):
+def get_is_gtfs(reparse=False, parallel_workers=None):
+    """
+    @parallel_workers - on reparse, parse stop_times.txt with a pool of this many processes (os.cpu_count() is a good value)
+    """
     if os.path.isfile(IS_GTFS_OBJ) and not reparse:
         print_log("loading gtfs from file...")
         return load_artifact(IS_GTFS_OBJ)
     else:
         print_log("parsing gtfs from folder...")
-        gtfs = GTFS(IS_GTFS_FOLDER)
+        gtfs = GTFS(IS_GTFS_FOLDER, parallel_workers=parallel_workers)
         save_artifact(gtfs, IS_GTFS_OBJ)
         return gtfs
 
-def get_is_tlv_gtfs(reparse=False, full_reparse=False):
+def get_is_tlv_gtfs(reparse=False, full_reparse=False, parallel_workers=None):
     if os.path.isfile(TLV_GTFS_OBJ) and not reparse:
         print_log("loading gtfs from file...")
         return load_artifact(TLV_GTFS_OBJ)
     else:
         print_log("parsing reducing from is_gtfs...")
         if full_reparse:
-            gtfs = get_is_gtfs(True)
+            gtfs = get_is_gtfs(True, parallel_workers=parallel_workers)
         else:
             gtfs = get_is_gtfs()
         rgtfs = reduce_gtfs(gtfs, *TEL_AVIV_AREA)
@@ -627,27 +659,24 @@ def reduce_gtfs(gtfs, min_lon, max_lon, min_lat, max_lat):
         if float(stop[1]["stop_lon"]) >= min_lon and float(stop[1]["stop_lon"]) <= max_lon and \
             float(stop[1]["stop_lat"]) >= min_lat and float(stop[1]["stop_lat"]) <= max_lat:
             new_stations[stop[0]] = stop[1]
+    # Keep a trip only if all of its stops are inside the area - done on the stop_times columns instead of per stop dict.
+    stop_times = gtfs.stop_times
+    station_in_area = np.zeros(len(stop_times.station_ids), dtype=bool)
+    for station_id in new_stations.keys():
+        station_in_area[stop_times.station_ids.get(station_id)] = True
+    # TODO: maybe instead of deleting trips i can just delete the stations which are not in the area
+    keep_trip = np.diff(stop_times.trip_offsets) > 0
+    keep_trip[stop_times.trip_idx[~station_in_area[stop_times.station_idx]]] = False
+
     new_trips = {}
-    new_stop_times = {}
     for trip in gtfs.trips.keys():
-        if is_footpath(trip) or is_car_route(trip):
+        if is_footpath(trip) or is_car_route(trip) or keep_trip[stop_times.trip_ids.get(trip)]:
             new_trips[trip] = gtfs.trips[trip]
-            # new_stop_times[trip] = []
-            continue
-        keep_trip = True
-        for stop in gtfs.stop_times[trip]:
-            if stop["station_id"] not in new_stations:
-                # TODO: maybe instead of deleting trips i can just delete the stations which are not in the area
-                keep_trip = False
-                break
-        if keep_trip:
-            new_trips[trip] = gtfs.trips[trip]
-            new_stop_times[trip] = gtfs.stop_times[trip]
-    
+
     # change 3 segnificant parameters of gtfs
     gtfs.stations = new_stations
     gtfs.trips = new_trips
-    gtfs.stop_times = new_stop_times
+    gtfs.stop_times = stop_times.select_trips(keep_trip)
 
     gtfs.area = get_stations_area(new_stations.values())
     return gtfs
@@ -674,6 +703,20 @@ def test_is_gtfs_parser():
     display_gtfs_trip(gtfs, "17076498_090223")
     # display_stations(gtfs, 1)
 
+def test_parallel_is_gtfs_parser(workers=os.cpu_count()):
+    # Compare serial and parallel parsing of the full feed, and print the per-phase timings of both.
+    print(f"[+] running from cwd: {os.getcwd()}")
+    with Timer(text="[+] serial gtfs parse took {:.4f} seconds..."):
+        serial_gtfs = GTFS(IS_GTFS_FOLDER)
+    with Timer(text=f"[+] parallel gtfs parse with {workers} workers took {{:.4f}} seconds..."):
+        parallel_gtfs = GTFS(IS_GTFS_FOLDER, parallel_workers=workers)
+    print("serial timings - ", serial_gtfs.parse_timings)
+    print("parallel timings - ", parallel_gtfs.parse_timings)
+    for field in ("trip_idx", "station_idx", "stop_sequence", "arrival_time", "departure_time"):
+        if not np.array_equal(getattr(serial_gtfs.stop_times, field), getattr(parallel_gtfs.stop_times, field)):
+            raise AssertionError(f"parallel parse differs from serial parse in {field}")
+    print("[+] parallel parse matches serial parse")
+
 def test_is_tlv_gtfs_parser():
 
     print(f"[+] running from cwd: {os.getcwd()}")    
@@ -0,0 +1,151 @@
+from bisect import bisect_left
+import time
+
+from raptor_routing import TripScanner, RVisidetStation, run_ultra_wrapper, result_route_key, BENCHMARK_ODS
+from connection_builder import get_tlv_timetable, TripView
+
+# RAPTOR by route patterns (see route_patterns.py).
+# TripScanner follows every connection that leaves a marked station, so a line with 100 trips a day is followed
+# from every marked station it passes, trip by trip. Here a pattern is scanned once per round, from its first marked stop,
+# riding the earliest trip we can catch, and hopping to an earlier trip if a later marked stop allows it.
+# Use it with raptor_route(..., scanner=PatternScanner) / run_ultra_wrapper(..., scanner=PatternScanner).
+
+
+class PatternScanner(TripScanner):
+    """
+    Round scan of raptor_route by route patterns.
+    Stations without patterns (the query's walking start station, car route stations) only have per query connections,
+    those are scanned trip by trip like TripScanner does.
+    """
+    def __init__(self, tt, start_time, end_station, counters=None):
+        super().__init__(tt, start_time, end_station, counters)
+        self.patterns = tt.get_route_patterns()
+
+    def scan(self, new_stations, visited_stations, next_round_new_stations, stations_to_end, max_time_threshold, target):
+        counters = self.counters
+        station_patterns = self.patterns.station_patterns
+        # station -> arrival time, for stations we can board at this round
+        marked_stations = {}
+        other_stations = {}
+        # pattern idx -> first marked stop in the pattern, the pattern is scanned from there
+        patterns_to_scan = {}
+        for station, st_arrival_time in new_stations.items():
+            if st_arrival_time > max_time_threshold or st_arrival_time < self.start_time:
+                continue
+            if station not in station_patterns:
+                other_stations[station] = st_arrival_time
+                continue
+            marked_stations[station] = st_arrival_time
+            counters.scanned_stations += 1
+            for p, i in station_patterns[station]:
+                if p not in patterns_to_scan or i < patterns_to_scan[p]:
+                    patterns_to_scan[p] = i
+
+        if len(other_stations) > 0:
+            super().scan(other_stations, visited_stations, next_round_new_stations, stations_to_end, max_time_threshold, target)
+
+        for p, first_stop in patterns_to_scan.items():
+            pattern = self.patterns[p]
+            departures_by_stop, arrivals_by_trip = pattern.scan_arrays()
+            stops = pattern.stops
+            last_stop = len(stops) - 1
+            # The trip we ride - its row in the pattern, where we boarded it and its arrival times
+            trip = len(pattern)
+            board_stop = -1
+            trip_arrivals = None
+            for i in range(first_stop, len(stops)):
+                station = stops[i]
+                if trip_arrivals is not None:
+                    arrival_time = trip_arrivals[i]
+                    if arrival_time >= target.arrival_time or arrival_time < self.start_time:
+                        # Can't improve anything with this trip from here on. An earlier trip might still be caught at a later stop.
+                        counters.pruned_labels += 1
+                        trip = len(pattern)
+                        trip_arrivals = None
+                    elif station not in visited_stations or arrival_time < visited_stations[station].arrival_time:
+                        leading_connections = TripView(self.tt.trip_connections[pattern.trip_ids[trip]], board_stop, i)
+                        visited_stations[station] = RVisidetStation(arrival_time, leading_connections, arrival_time + stations_to_end[station])
+                        next_round_new_stations[station] = arrival_time
+                        counters.improved_labels += 1
+                        target.improve(station, arrival_time)
+
+                # Can we catch an earlier trip here? trips are sorted, so it is a bisect on this stop's departures.
+                if i == last_stop or station not in marked_stations:
+                    continue
+                departures = departures_by_stop[i]
+                earliest_trip = bisect_left(departures, marked_stations[station], 0, trip)
+                if earliest_trip < trip and departures[earliest_trip] <= max_time_threshold:
+                    trip = earliest_trip
+                    board_stop = i
+                    counters.followed_trips += 1
+                    trip_arrivals = arrivals_by_trip[trip]
+
+
+############################################################
+### TEST PATTERN RAPTOR ####################################
+############################################################
+
+def _run_engine(start_loc, end_loc, start_time, scanner, service_date=None):
+    # A fresh timetable for every run, so both scanners start from the same cold caches (station departures, mapped connections).
+    # The query's walking stations go to its own overlay (run_ultra_wrapper's tt.for_query()), not to the timetable.
+    tt = get_tlv_timetable()
+    if service_date is not None:
+        tt = tt.for_service_date(service_date)
+    tt.get_route_patterns()
+    rr_start = time.perf_counter()
+    results = run_ultra_wrapper(start_loc, end_loc, start_time, tt, relax_footpaths=True, limit_walking_time=60*15, scanner=scanner)
+    return results, time.perf_counter() - rr_start
+
+def _best_arrivals(results):
+    # num_transfers -> earliest arrival time
+    best = {}
+    for r in results:
+        if r.num_transfers not in best or r.arrival_time < best[r.num_transfers]:
+            best[r.num_transfers] = r.arrival_time
+    return best
+
+def test_pattern_raptor_parity(ods=BENCHMARK_ODS, service_date=None):
+    """
+    Run every OD with TripScanner and PatternScanner and compare the results.
+    They don't have to be identical - TripScanner follows each trip once per query, from the first marked station it meets,
+    so it can miss boarding the same trip earlier (or at a stop reached in a later round). PatternScanner does the full round scan,
+    so for every number of transfers it should arrive at least as early, and it can find results TripScanner doesn't.
+    returns True if PatternScanner was never worse
+    """
+    never_worse = True
+    trips_total_time = 0
+    patterns_total_time = 0
+    for start_loc, end_loc, start_time in ods:
+        trips_results, trips_time = _run_engine(start_loc, end_loc, start_time, TripScanner, service_date)
+        patterns_results, patterns_time = _run_engine(start_loc, end_loc, start_time, PatternScanner, service_date)
+        trips_total_time += trips_time
+        patterns_total_time += patterns_time
+
+        print(f"[+] {start_time} - trips scan {trips_time:.4f} seconds, patterns scan {patterns_time:.4f} seconds")
+        if [result_route_key(r.result_route) for r in trips_results] == [result_route_key(r.result_route) for r in patterns_results]:
+            print(f"    identical - {len(trips_results)} results")
+            continue
+        trips_best = _best_arrivals(trips_results)
+        patterns_best = _best_arrivals(patterns_results)
+        if trips_best == patterns_best:
+            print("    same arrival times, different journeys:")
+        elif all(transfers in patterns_best and patterns_best[transfers] <= arrival for transfers, arrival in trips_best.items()):
+            print("    patterns scan found more / earlier results:")
+        else:
+            print("    [!] patterns scan is worse:")
+            never_worse = False
+        for r in trips_results:
+            print("    trips    -", r)
+        for r in patterns_results:
+            print("    patterns -", r)
+
+    print(f"[+] total - trips scan {trips_total_time:.4f} seconds, patterns scan {patterns_total_time:.4f} seconds")
+    if never_worse:
+        print("[+] pattern RAPTOR is never worse than the trips scan")
+    return never_worse
+
+def main():
+    test_pattern_raptor_parity()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+import bz2
+import csv
+import heapq
+import math
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+
+from station_index import SearchableStations, METERS_PER_DEGREE
+
+# Offline walking engine - a pedestrian street graph in CSR arrays and bounded Dijkstra on it, in process.
+# PedestrianGraph.matrix(query) takes and returns the same things as valhalla's actor.matrix with "costing": "pedestrian",
+# so it can be given wherever walking matrices are made (RaptorRouter(walking_engine=...), build_station_footpaths(walking_engine=...)).
+# Locations are snapped to the nearest graph node, the snap is walked in a straight line.
+#
+# A graph is loaded from an OSM extract (.osm / .osm.bz2 xml) or from node / edge csv files (tests, or graphs made elsewhere):
+#   nodes.csv - node_id,lat,lon
+#   edges.csv - from_node,to_node[,length][,oneway]   length in meters (straight line if missing), oneway 1/0 (default 0)
+# and saved to / loaded from a .npz file, which is what you want to keep around.
+
+DEFAULT_WALKING_SPEED = 5.1 / 3.6 # m/s, valhalla's pedestrian default
+DEFAULT_MAX_TIME = 60 * 60 # seconds, same as the default limit_walking_time
+DEFAULT_MAX_SNAP_DISTANCE = 500 # meters
+
+# highway values which are walkable (https://wiki.openstreetmap.org/wiki/Key:highway)
+PEDESTRIAN_HIGHWAYS = {"footway", "pedestrian", "path", "steps", "living_street", "residential", "service", "unclassified",
+                       "tertiary", "tertiary_link", "secondary", "secondary_link", "primary", "primary_link", "track",
+                       "cycleway", "corridor", "platform", "road", "crossing"}
+NOT_WALKABLE = {"no", "private"}
+
+
+def _meters(lat1, lon1, lat2, lon2):
+    dy = (lat2 - lat1) * METERS_PER_DEGREE
+    dx = (lon2 - lon1) * METERS_PER_DEGREE * np.cos(np.radians((lat1 + lat2) / 2))
+    return np.sqrt(dx * dx + dy * dy)
+
+
+def _csr(num_nodes, from_nodes, to_nodes, lengths):
+    order = np.lexsort((to_nodes, from_nodes))
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(from_nodes, minlength=num_nodes), out=offsets[1:])
+    return offsets, to_nodes[order].astype(np.int32), lengths[order].astype(np.float32)
+
+
+class PedestrianGraph(object):
+    """
+    @node_lat, node_lon - float64[N]
+    @offsets, targets, lengths - CSR of edges, edges of node n are [offsets[n], offsets[n+1]), lengths in meters
+    """
+    cache_tag = "pedestrian_graph" # walking results cached by RaptorRouter are kept apart from valhalla's
+
+    def __init__(self, node_lat, node_lon, offsets, targets, lengths, walking_speed=DEFAULT_WALKING_SPEED,
+                 max_time=DEFAULT_MAX_TIME, max_snap_distance=DEFAULT_MAX_SNAP_DISTANCE):
+        """
+        @walking_speed - m/s
+        @max_time - seconds, a search doesn't go further than this. Targets further away get None time and distance, like valhalla's unreachable ones.
+        @max_snap_distance - meters, locations further than this from the graph are unreachable
+        """
+        self.node_lat = np.asarray(node_lat, dtype=np.float64)
+        self.node_lon = np.asarray(node_lon, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.lengths = np.asarray(lengths, dtype=np.float32)
+        self.walking_speed = walking_speed
+        self.max_time = max_time
+        self.max_snap_distance = max_snap_distance
+        self._init_search()
+
+    def _init_search(self):
+        self._node_index = None
+        self._adjacency = None
+        self._reverse_adjacency = None
+
+    def __getstate__(self):
+        # indexes and python lists are rebuilt on first use (e.g. in a pool worker)
+        state = self.__dict__.copy()
+        state["_node_index"] = state["_adjacency"] = state["_reverse_adjacency"] = None
+        return state
+
+    def __len__(self):
+        return len(self.node_lat)
+
+    def num_edges(self):
+        return len(self.targets)
+
+    def __repr__(self):
+        return f"PedestrianGraph({len(self.node_lat)} nodes, {len(self.targets)} edges)"
+
+    ### Loading and saving ###
+
+    @classmethod
+    def from_edges(cls, node_lat, node_lon, from_nodes, to_nodes, lengths=None, oneway=None, **kwargs):
+        """
+        @from_nodes, to_nodes - node indices of the edges
+        @lengths - meters, None for straight lines
+        @oneway - bool per edge, None for all edges walkable both ways
+        """
+        node_lat = np.asarray(node_lat, dtype=np.float64)
+        node_lon = np.asarray(node_lon, dtype=np.float64)
+        from_nodes = np.asarray(from_nodes, dtype=np.int64)
+        to_nodes = np.asarray(to_nodes, dtype=np.int64)
+        if lengths is None:
+            lengths = _meters(node_lat[from_nodes], node_lon[from_nodes], node_lat[to_nodes], node_lon[to_nodes])
+        lengths = np.asarray(lengths, dtype=np.float64)
+        both_ways = np.ones(len(from_nodes), dtype=bool) if oneway is None else ~np.asarray(oneway, dtype=bool)
+        all_from = np.concatenate([from_nodes, to_nodes[both_ways]])
+        all_to = np.concatenate([to_nodes, from_nodes[both_ways]])
+        all_lengths = np.concatenate([lengths, lengths[both_ways]])
+        offsets, targets, csr_lengths = _csr(len(node_lat), all_from, all_to, all_lengths)
+        return cls(node_lat, node_lon, offsets, targets, csr_lengths, **kwargs)
+
+    @classmethod
+    def from_node_edge_files(cls, nodes_path, edges_path, **kwargs):
+        node_ids = {}
+        node_lat, node_lon = [], []
+        with open(nodes_path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                node_ids[row["node_id"]] = len(node_lat)
+                node_lat.append(float(row["lat"]))
+                node_lon.append(float(row["lon"]))
+        from_nodes, to_nodes, lengths, oneway = [], [], [], []
+        with open(edges_path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                from_nodes.append(node_ids[row["from_node"]])
+                to_nodes.append(node_ids[row["to_node"]])
+                lengths.append(float(row["length"]) if row.get("length") not in (None, "") else float("nan"))
+                oneway.append(row.get("oneway") in ("1", "true", "yes"))
+        lengths = np.array(lengths, dtype=np.float64)
+        node_lat, node_lon = np.array(node_lat), np.array(node_lon)
+        from_nodes, to_nodes = np.array(from_nodes, dtype=np.int64), np.array(to_nodes, dtype=np.int64)
+        missing = np.isnan(lengths)
+        lengths[missing] = _meters(node_lat[from_nodes[missing]], node_lon[from_nodes[missing]], node_lat[to_nodes[missing]], node_lon[to_nodes[missing]])
+        return cls.from_edges(node_lat, node_lon, from_nodes, to_nodes, lengths, oneway, **kwargs)
+
+    @classmethod
+    def from_osm_xml(cls, path, **kwargs):
+        """
+        Walkable ways of an OSM xml extract (.osm or .osm.bz2). Only nodes on walkable ways are kept.
+        """
+        opener = bz2.open if path.endswith(".bz2") else open
+        osm_nodes = {}
+        ways = []
+        with opener(path, "rb") as f:
+            for _, element in ET.iterparse(f, events=("end",)):
+                if element.tag == "node":
+                    osm_nodes[element.get("id")] = (float(element.get("lat")), float(element.get("lon")))
+                    element.clear()
+                elif element.tag == "way":
+                    tags = {tag.get("k"): tag.get("v") for tag in element.findall("tag")}
+                    if tags.get("highway") in PEDESTRIAN_HIGHWAYS and tags.get("foot") not in NOT_WALKABLE and tags.get("access") not in NOT_WALKABLE:
+                        ways.append(([nd.get("ref") for nd in element.findall("nd")], tags.get("oneway:foot") == "yes"))
+                    element.clear()
+        node_ids = {}
+        node_lat, node_lon = [], []
+        from_nodes, to_nodes, oneway = [], [], []
+        for refs, is_oneway in ways:
+            refs = [ref for ref in refs if ref in osm_nodes]
+            for ref in refs:
+                if ref not in node_ids:
+                    node_ids[ref] = len(node_lat)
+                    node_lat.append(osm_nodes[ref][0])
+                    node_lon.append(osm_nodes[ref][1])
+            for a, b in zip(refs, refs[1:]):
+                from_nodes.append(node_ids[a])
+                to_nodes.append(node_ids[b])
+                oneway.append(is_oneway)
+        return cls.from_edges(node_lat, node_lon, from_nodes, to_nodes, None, oneway, **kwargs)
+
+    def save(self, path):
+        np.savez(path, node_lat=self.node_lat, node_lon=self.node_lon, offsets=self.offsets, targets=self.targets, lengths=self.lengths)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with np.load(path) as arrays:
+            return cls(arrays["node_lat"], arrays["node_lon"], arrays["offsets"], arrays["targets"], arrays["lengths"], **kwargs)
+
+    ### Searching ###
+
+    def _adjacency_lists(self, reverse=False):
+        # python lists - indexing numpy arrays one item at a time in the dijkstra loop is much slower
+        if self._adjacency is None:
+            self._adjacency = (self.offsets.tolist(), self.targets.tolist(), self.lengths.tolist())
+        if not reverse:
+            return self._adjacency
+        if self._reverse_adjacency is None:
+            from_nodes = np.repeat(np.arange(len(self.node_lat)), np.diff(self.offsets))
+            offsets, targets, lengths = _csr(len(self.node_lat), self.targets.astype(np.int64), from_nodes, self.lengths)
+            self._reverse_adjacency = (offsets.tolist(), targets.tolist(), lengths.tolist())
+        return self._reverse_adjacency
+
+    def snap(self, locations):
+        """
+        @locations - list of {"lat", "lon"} (text or float)
+        returns a list of (node, meters to it), (None, None) for locations too far from the graph
+        """
+        if self._node_index is None:
+            self._node_index = SearchableStations.from_coordinates(self.node_lat, self.node_lon)
+        snapped = []
+        for location in locations:
+            nearest = self._node_index.nearest_stations(location, 1, max_radius=self.max_snap_distance)
+            snapped.append(nearest[0] if len(nearest) > 0 else (None, None))
+        return snapped
+
+    def shortest_distances(self, source, source_distance=0.0, max_distance=None, targets=None, reverse=False):
+        """
+        Bounded one-to-many dijkstra.
+        @source - node
+        @source_distance - meters already walked to source (the snap)
+        @max_distance - meters, don't search further
+        @targets - set of nodes, stop once all of them are settled (None - search everything in max_distance)
+        @reverse - walk edges backwards (distances to source instead of from it)
+        returns dict node -> meters
+        """
+        offsets, edge_targets, lengths = self._adjacency_lists(reverse)
+        if max_distance is None:
+            max_distance = self.max_time * self.walking_speed
+        remaining = None if targets is None else set(targets)
+        settled = {}
+        heap = [(source_distance, source)]
+        best = {source: source_distance}
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled[node] = distance
+            if remaining is not None:
+                remaining.discard(node)
+                if len(remaining) == 0:
+                    break
+            for e in range(offsets[node], offsets[node + 1]):
+                next_distance = distance + lengths[e]
+                next_node = edge_targets[e]
+                if next_distance > max_distance or next_node in settled:
+                    continue
+                if next_distance < best.get(next_node, math.inf):
+                    best[next_node] = next_distance
+                    heapq.heappush(heap, (next_distance, next_node))
+        return settled
+
+    def matrix(self, query):
+        """
+        Same as valhalla's actor.matrix for pedestrian costing -
+        @query - {"sources": [{"lat", "lon"}], "targets": [{"lat", "lon"}], "costing": "pedestrian"}
+        returns {"sources_to_targets": [[{"from_index", "to_index", "time" (seconds), "distance" (KM)}]]}
+        One search per source, or per target (on the reversed graph) if there are less targets than sources.
+        """
+        if query.get("costing", "pedestrian") != "pedestrian":
+            raise ValueError(f"PedestrianGraph only does pedestrian costing, got {query['costing']}")
+        sources = self.snap(query["sources"])
+        targets = self.snap(query["targets"])
+        max_distance = self.max_time * self.walking_speed
+        # distances[i][j] - meters from source i to target j, None if unreachable
+        distances = [[None] * len(targets) for _ in sources]
+        reverse = len(targets) < len(sources)
+        searches, others = (targets, sources) if reverse else (sources, targets)
+        search_points, other_points = [[(float(l["lat"]), float(l["lon"])) for l in query[key]]
+                                       for key in (("targets", "sources") if reverse else ("sources", "targets"))]
+        other_nodes = set(node for node, _ in others if node is not None)
+        for i, (node, snap_distance) in enumerate(searches):
+            if node is None:
+                continue
+            settled = self.shortest_distances(node, snap_distance, max_distance, other_nodes, reverse=reverse)
+            for j, (other_node, other_snap_distance) in enumerate(others):
+                if other_node is None or other_node not in settled:
+                    continue
+                if other_node == node and other_points[j] == search_points[i]:
+                    # the same point - no walk, like valhalla (not walking to the node and back)
+                    distance = 0.0
+                else:
+                    distance = settled[other_node] + other_snap_distance
+                if distance > max_distance:
+                    continue
+                if reverse:
+                    distances[j][i] = distance
+                else:
+                    distances[i][j] = distance
+
+        sources_to_targets = []
+        for i, row in enumerate(distances):
+            sources_to_targets.append([{"from_index": i, "to_index": j,
+                                        "time": None if d is None else int(round(d / self.walking_speed)),
+                                        "distance": None if d is None else d / 1000.0} for j, d in enumerate(row)])
+        return {"sources_to_targets": sources_to_targets}
+
+
+def load_pedestrian_graph(path, **kwargs):
+    """
+    @path - .npz (saved graph), .osm / .osm.bz2 (OSM extract) or a folder with nodes.csv and edges.csv
+    """
+    if os.path.isdir(path):
+        return PedestrianGraph.from_node_edge_files(os.path.join(path, "nodes.csv"), os.path.join(path, "edges.csv"), **kwargs)
+    if path.endswith(".npz"):
+        return PedestrianGraph.load(path, **kwargs)
+    if path.endswith(".osm") or path.endswith(".osm.bz2"):
+        return PedestrianGraph.from_osm_xml(path, **kwargs)
+    raise ValueError(f"don't know how to load a pedestrian graph from {path} (.pbf extracts need converting to .osm first)")
+
+
+############################################################
+### TEST PEDESTRIAN GRAPH ##################################
+############################################################
+
+def make_grid_graph_files(folder, min_lat, max_lat, min_lon, max_lon, spacing=100):
+    """
+    Write nodes.csv / edges.csv of a street grid with spacing meters between crossings - a stand in for an OSM extract in tests.
+    """
+    os.makedirs(folder, exist_ok=True)
+    lats = np.arange(min_lat, max_lat, spacing / METERS_PER_DEGREE)
+    lons = np.arange(min_lon, max_lon, spacing / (METERS_PER_DEGREE * math.cos(math.radians(max_lat))))
+    with open(os.path.join(folder, "nodes.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["node_id", "lat", "lon"])
+        for r, lat in enumerate(lats):
+            for c, lon in enumerate(lons):
+                writer.writerow([f"{r}_{c}", lat, lon])
+    with open(os.path.join(folder, "edges.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["from_node", "to_node"])
+        for r in range(len(lats)):
+            for c in range(len(lons)):
+                if c + 1 < len(lons):
+                    writer.writerow([f"{r}_{c}", f"{r}_{c + 1}"])
+                if r + 1 < len(lats):
+                    writer.writerow([f"{r}_{c}", f"{r + 1}_{c}"])
+
+
+def test_pedestrian_graph_vs_valhalla(graph_path=None):
+    """
+    Time the access / egress matrices of the benchmark queries with valhalla and with the pedestrian graph.
+    @graph_path - see load_pedestrian_graph, None to make a 100m street grid over the tlv stations
+    """
+    from codetiming import Timer
+    from connection_builder import get_tlv_timetable
+    from raptor_routing import BENCHMARK_ODS
+    from valhalla_interface import get_actor
+    from utils import ARTIFACTS_FOLDER, print_log
+    tt = get_tlv_timetable()
+    stations_as_locations = [{"lat": s["stop_lat"], "lon": s["stop_lon"]} for s in tt.stations.values()]
+    if graph_path is None:
+        graph_path = os.path.join(ARTIFACTS_FOLDER, "tlv_grid_pedestrian_graph")
+        lats = [float(s["stop_lat"]) for s in tt.stations.values()]
+        lons = [float(s["stop_lon"]) for s in tt.stations.values()]
+        make_grid_graph_files(graph_path, min(lats) - 0.01, max(lats) + 0.01, min(lons) - 0.01, max(lons) + 0.01)
+    with Timer(text="[+] loading pedestrian graph took {:.4f} seconds..."):
+        graph = load_pedestrian_graph(graph_path)
+    print_log(graph)
+    same_point = graph.matrix({"sources": stations_as_locations[:1], "targets": stations_as_locations[:1], "costing": "pedestrian"})
+    if same_point["sources_to_targets"][0][0]["time"] not in (None, 0):
+        raise AssertionError(f"walking from a station to itself took {same_point['sources_to_targets'][0][0]['time']} seconds")
+    actor = get_actor(tt)
+
+    times = {}
+    for name, engine in (("valhalla", actor), ("pedestrian graph", graph)):
+        engine_times = times[name] = []
+        with Timer(text="[+] " + name + " access / egress matrices took {:.4f} seconds..."):
+            for start_loc, end_loc, _ in BENCHMARK_ODS:
+                start = {"lat": start_loc["stop_lat"], "lon": start_loc["stop_lon"]}
+                end = {"lat": end_loc["stop_lat"], "lon": end_loc["stop_lon"]}
+                access = engine.matrix({"sources": [start], "targets": [end] + stations_as_locations, "costing": "pedestrian"})
+                egress = engine.matrix({"sources": stations_as_locations, "targets": [end], "costing": "pedestrian"})
+                engine_times += [f["time"] for f in access["sources_to_targets"][0]]
+                engine_times += [row[0]["time"] for row in egress["sources_to_targets"]]
+        print_log(f"{name} - {sum(1 for t in engine_times if t is not None)} of {len(engine_times)} pairs reachable")
+    both = [(v, g) for v, g in zip(times["valhalla"], times["pedestrian graph"]) if v is not None and g is not None]
+    if len(both) > 0:
+        differences = np.array([g - v for v, g in both])
+        print_log(f"{len(both)} pairs reachable by both - pedestrian graph minus valhalla time, "
+                  f"mean {differences.mean():.0f}s, median {np.median(differences):.0f}s, mean absolute {np.abs(differences).mean():.0f}s")
+
+
+def main():
+    test_pedestrian_graph_vs_valhalla()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+from bisect import bisect_left
+from dataclasses import dataclass
+import time
+
+from utils import time_to_int, time_int_to_text, FOOTPATH_ID, is_footpath, print_log
+from connection_builder import Connection, TripView, get_tlv_timetable
+from query_timetable import QueryTimetable
+from raptor_routing import RaptorRouter, RaptorResult_v2, run_ultra_wrapper, BENCHMARK_ODS, DEFAULT_WALKING_RADIUS
+from pattern_raptor_routing import PatternScanner
+
+# Profile queries - every journey worth taking in a departure window, not only the one leaving at start_time.
+# The result is the Pareto set of (departure time, arrival time, transfers) - leave later, arrive earlier, transfer less.
+#
+# Range RAPTOR (rRAPTOR, Delling et al. "Round-Based Public Transit Routing"):
+# the only departure times that matter are the ones that catch a trip - a trip departure from a station we can walk to,
+# minus the walk. Those are run latest first, and the labels of each round are kept from one departure to the next.
+# A later departure that got somewhere with k trips is as good as anything an earlier departure gets there with k trips,
+# so an earlier departure only scans what it improves - the whole window costs about one query per distinct departure.
+# Round 0 is walking from the start (the walks of RaptorRouter, and transfers from them like raptor_route relaxes),
+# rounds 1..max_trips are a pattern scan (like PatternScanner) followed by transfers.
+# Journeys which only walk are not part of the profile.
+
+DEFAULT_MAX_TRIPS = 3 # raptor_route's 4 rounds - walking from the start, then 3 trips
+DEFAULT_MAX_JOURNEY_TIME = 2 * 60 * 60 # seconds, from the departure
+INFINITY = 2**40 # no label / bound yet, later than any time
+
+
+@dataclass
+class ProfileJourney:
+    departure_time: int
+    arrival_time: int
+    num_transfers: int
+    result: RaptorResult_v2
+
+    def __str__(self):
+        return f"ProfileJourney: leave at {time_int_to_text(self.departure_time)}, arrive at {time_int_to_text(self.arrival_time)}, {self.num_transfers} transfers"
+
+
+def _dominates(first, second):
+    # leaves no earlier, arrives no later, no more transfers
+    return first.departure_time >= second.departure_time and first.arrival_time <= second.arrival_time and first.num_transfers <= second.num_transfers
+
+def pareto_journeys(journeys):
+    """
+    returns the journeys no other journey dominates (of equal ones the first), sorted by departure time
+    """
+    pareto = []
+    for journey in journeys:
+        if any(_dominates(other, journey) for other in pareto):
+            continue
+        pareto = [other for other in pareto if not _dominates(journey, other)]
+        pareto.append(journey)
+    return sorted(pareto, key=lambda j: (j.departure_time, j.num_transfers))
+
+
+class ProfileSearch(object):
+    """
+    rRAPTOR over route patterns, from the query's start station to its end station.
+    labels[k] - station -> earliest arrival with k trips, kept over all departures of the window.
+    parents[k] - station -> how labels[k] was reached:
+        ("start", departure time) in round 0, ("trip", trip_id, board stop, alight stop, board station),
+        ("walk", from station, walk departure, walk arrival, the "trip" parent of from station).
+    """
+    def __init__(self, tt, start_station, end_station, access, targets, transfers=None, limit_mid_walking_time=60*6,
+                 max_trips=DEFAULT_MAX_TRIPS, max_journey_time=DEFAULT_MAX_JOURNEY_TIME):
+        """
+        @access - station_id -> walking seconds from the start
+        @targets - station_id -> walking seconds to the end
+        @transfers - station_id -> footpaths sorted by time (tt.stations_footpaths, ultra_shortcuts.get_transfer_shortcuts), None for no transfers
+        @limit_mid_walking_time - longest transfer walk
+        """
+        self.tt = tt
+        self.patterns = tt.get_route_patterns()
+        self.start_station = start_station
+        self.end_station = end_station
+        self.access = access
+        self.targets = targets
+        # (time, station_id) tuples, read in the inner loop
+        self.transfers = {} if transfers is None else \
+            {station_id: [(f["time"], f["station_id"]) for f in footpaths if f["time"] <= limit_mid_walking_time] for station_id, footpaths in transfers.items()}
+        self.max_trips = max_trips
+        self.max_journey_time = max_journey_time
+        self.labels = [{} for _ in range(max_trips + 1)]
+        self.parents = [{} for _ in range(max_trips + 1)]
+        # best arrival at the end with k trips, over the departures run so far
+        self.target_best = [INFINITY] * (max_trips + 1)
+
+        # Round 0 is the same for every departure, only shifted - seconds from the departure to each station,
+        # walking there, or walking to a station and transferring from it (from station, walking time)
+        self.offsets = dict(access)
+        self.offset_parents = dict.fromkeys(access)
+        for station, walking_time in access.items():
+            for transfer_time, target in self.transfers.get(station, ()):
+                if walking_time + transfer_time < self.offsets.get(target, INFINITY):
+                    self.offsets[target] = walking_time + transfer_time
+                    self.offset_parents[target] = (station, transfer_time)
+
+    def departure_times(self, window_start, window_end):
+        """
+        returns [(departure time, stations to board at)] latest first - departures in the window that catch a trip,
+            and window_end from every station - leaving at the end of the window still catches the trips after it
+        """
+        departures = {}
+        station_patterns = self.patterns.station_patterns
+        departures[window_end] = {station for station in self.offsets if station in station_patterns}
+        for station, offset in self.offsets.items():
+            for p, i in station_patterns.get(station, ()):
+                pattern = self.patterns[p]
+                if i == len(pattern.stops) - 1:
+                    continue
+                stop_departures = pattern.scan_arrays()[0][i]
+                for t in range(bisect_left(stop_departures, window_start + offset), len(stop_departures)):
+                    departure_time = stop_departures[t] - offset
+                    if departure_time > window_end:
+                        break
+                    departures.setdefault(departure_time, set()).add(station)
+        return sorted(departures.items(), reverse=True)
+
+    def _improves(self, k, station, arrival_time):
+        # only if nothing with k trips or less got here as early, in this departure or a later one
+        for j in range(k + 1):
+            if arrival_time >= self.labels[j].get(station, INFINITY):
+                return False
+        return True
+
+    def _scan_patterns(self, k, marked, bound, max_arrival_time):
+        """
+        Round k - ride patterns from stations marked last round.
+        returns station -> arrival time, improved this round
+        """
+        station_patterns = self.patterns.station_patterns
+        previous_labels = self.labels[k - 1]
+        labels = self.labels[k]
+        parents = self.parents[k]
+        patterns_to_scan = {}
+        for station in marked:
+            for p, i in station_patterns.get(station, ()):
+                if p not in patterns_to_scan or i < patterns_to_scan[p]:
+                    patterns_to_scan[p] = i
+
+        improved = {}
+        for p, first_stop in patterns_to_scan.items():
+            pattern = self.patterns[p]
+            departures_by_stop, arrivals_by_trip = pattern.scan_arrays()
+            stops = pattern.stops
+            last_stop = len(stops) - 1
+            trip = len(pattern)
+            board_stop = -1
+            trip_arrivals = None
+            for i in range(first_stop, len(stops)):
+                station = stops[i]
+                if trip_arrivals is not None:
+                    arrival_time = trip_arrivals[i]
+                    if arrival_time < bound and arrival_time <= max_arrival_time and self._improves(k, station, arrival_time):
+                        labels[station] = arrival_time
+                        parents[station] = ("trip", pattern.trip_ids[trip], board_stop, i, stops[board_stop])
+                        improved[station] = arrival_time
+
+                if i == last_stop or station not in marked:
+                    continue
+                departures = departures_by_stop[i]
+                earliest_trip = bisect_left(departures, previous_labels[station], 0, trip)
+                if earliest_trip < trip and departures[earliest_trip] <= max_arrival_time:
+                    trip = earliest_trip
+                    board_stop = i
+                    trip_arrivals = arrivals_by_trip[trip]
+        return improved
+
+    def _relax_transfers(self, k, improved, bound, max_arrival_time):
+        """
+        Walk from stations improved by a trip this round.
+        returns improved, with the stations reached by walking added
+        """
+        labels = self.labels[k]
+        parents = self.parents[k]
+        result = dict(improved)
+        for station, arrival_time in improved.items():
+            if labels[station] < arrival_time:
+                continue
+            trip_parent = parents[station]
+            for transfer_time, target in self.transfers.get(station, ()):
+                new_time = arrival_time + transfer_time
+                if new_time >= bound or new_time > max_arrival_time:
+                    # sorted by time
+                    break
+                if self._improves(k, target, new_time):
+                    labels[target] = new_time
+                    parents[target] = ("walk", station, arrival_time, new_time, trip_parent)
+                    result[target] = new_time
+        return result
+
+    def _trace(self, k, station):
+        """
+        returns a RaptorResult_v2 of the journey to the end with k trips, getting off at station
+        """
+        arrival_time = self.labels[k][station]
+        route = [(self.end_station, [Connection(station, self.end_station, arrival_time, arrival_time + self.targets[station], FOOTPATH_ID)])]
+        parent = self.parents[k][station]
+        while k > 0:
+            if parent[0] == "walk":
+                _, from_station, walk_departure, walk_arrival, parent = parent
+                route.insert(0, (station, [Connection(from_station, station, walk_departure, walk_arrival, FOOTPATH_ID)]))
+                station = from_station
+            _, trip_id, board_stop, alight_stop, board_station = parent
+            route.insert(0, (station, TripView(self.tt.trip_connections[trip_id], board_stop, alight_stop)))
+            station = board_station
+            k -= 1
+            parent = self.parents[k][station]
+
+        departure_time = parent[1]
+        if self.offset_parents[station] is not None:
+            from_station, transfer_time = self.offset_parents[station]
+            walk_departure = departure_time + self.access[from_station]
+            route.insert(0, (station, [Connection(from_station, station, walk_departure, walk_departure + transfer_time, FOOTPATH_ID)]))
+            station = from_station
+        route.insert(0, (station, [Connection(self.start_station, station, departure_time, departure_time + self.access[station], FOOTPATH_ID)]))
+        return RaptorResult_v2(route, self.tt)
+
+    def run(self, window_start, window_end):
+        """
+        @window_start, window_end - int seconds, departures from the start between them
+        returns the Pareto set of ProfileJourney, sorted by departure time
+        """
+        journeys = []
+        for departure_time, stations in self.departure_times(window_start, window_end):
+            max_arrival_time = departure_time + self.max_journey_time
+            marked = {}
+            for station in stations:
+                arrival_time = departure_time + self.offsets[station]
+                if arrival_time < self.labels[0].get(station, INFINITY):
+                    self.labels[0][station] = arrival_time
+                    self.parents[0][station] = ("start", departure_time)
+                    marked[station] = arrival_time
+
+            for k in range(1, self.max_trips + 1):
+                if len(marked) == 0:
+                    break
+                bound = min(self.target_best[:k + 1])
+                improved = self._scan_patterns(k, marked, bound, max_arrival_time)
+                marked = self._relax_transfers(k, improved, bound, max_arrival_time)
+
+                best_station = None
+                for station in marked:
+                    if station in self.targets and self.labels[k][station] + self.targets[station] < bound:
+                        bound = self.labels[k][station] + self.targets[station]
+                        best_station = station
+                if best_station is not None:
+                    self.target_best[k] = bound
+                    result = self._trace(k, best_station)
+                    journeys.append(ProfileJourney(result.departure_time, result.arrival_time, k - 1, result))
+        return pareto_journeys(journeys)
+
+
+def profile_route(start_station, end_station, tt, window_start, window_end, access, targets, relax_footpaths=True, limit_mid_walking_time=60*6,
+                  transfer_shortcuts=None, max_trips=DEFAULT_MAX_TRIPS, max_journey_time=DEFAULT_MAX_JOURNEY_TIME):
+    """
+    Profile query from station to station.
+    @window_start, window_end - departures from start_station between them, int seconds (or "hh:mm:ss" text)
+    @access / targets - station_id -> walking seconds from start_station / to end_station (RaptorRouter._walking_sources_targets)
+    @transfer_shortcuts - like raptor_route, relaxed instead of tt.stations_footpaths and without limit_mid_walking_time
+    returns the Pareto set of ProfileJourney, sorted by departure time
+    """
+    transfers = None
+    if relax_footpaths:
+        transfers = tt.stations_footpaths if transfer_shortcuts is None else transfer_shortcuts
+        if transfer_shortcuts is not None:
+            limit_mid_walking_time = max_journey_time
+    search = ProfileSearch(tt, start_station, end_station, access, targets, transfers=transfers, limit_mid_walking_time=limit_mid_walking_time,
+                           max_trips=max_trips, max_journey_time=max_journey_time)
+    return search.run(time_to_int(window_start), time_to_int(window_end))
+
+
+def run_profile_wrapper(start_loc, end_loc, window_start, window_end, tt, relax_footpaths=True, limit_walking_time=60*60, service_date=None,
+                        walking_engine=None, transfer_shortcuts=None, walking_radius=DEFAULT_WALKING_RADIUS):
+    """
+    Like run_ultra_wrapper, for every departure between window_start and window_end ("hh:mm:ss" text or int seconds).
+    The walking radius doesn't grow - see RaptorRouter.semi_ultra_route for walking_radius.
+    returns the Pareto set of ProfileJourney, sorted by departure time
+    """
+    if service_date is not None:
+        tt = tt.for_service_date(service_date)
+    if not isinstance(tt, QueryTimetable):
+        tt = tt.for_query()
+    rr = RaptorRouter(tt, walking_engine=walking_engine)
+    start_lon_lat = {"lat": start_loc["stop_lat"], "lon": start_loc["stop_lon"]}
+    end_lon_lat = {"lat": end_loc["stop_lat"], "lon": end_loc["stop_lon"]}
+    start_station = tt._create_walking_station(start_lon_lat, name="Start")
+    end_station = tt._create_walking_station(end_lon_lat, name="End")
+    radius = None if walking_radius is None else min(walking_radius, limit_walking_time * rr.walking_speed)
+    access, targets = rr._walking_sources_targets(start_station, end_station, start_lon_lat, end_lon_lat, tt, radius, limit_walking_time=limit_walking_time)
+    # like raptor_route, only end with walks shorter than limit_walking_time
+    targets = {station_id: walking_time for station_id, walking_time in targets.items() if walking_time < limit_walking_time}
+    return profile_route(start_station["station_id"], end_station["station_id"], tt, window_start, window_end, access, targets,
+                         relax_footpaths=relax_footpaths, transfer_shortcuts=transfer_shortcuts)
+
+
+############################################################
+### TEST PROFILE RAPTOR ####################################
+############################################################
+
+def _num_trips(result):
+    return sum(1 for _, connections in result.result_route if not is_footpath(connections[0].trip_id))
+
+def test_profile_route(od=BENCHMARK_ODS[0], window=("10:00:00", "10:30:00"), limit_walking_time=60*15):
+    """
+    A profile query over window, against a query for every minute of it (PatternScanner).
+    Every minute's journey should be dominated by a profile journey - leaving at that minute or later, with no more trips, arriving as early.
+    returns True if it was
+    """
+    start_loc, end_loc, _ = od
+    tt = get_tlv_timetable()
+    tt.get_route_patterns()
+    # mapped timetables materialize stations on first use, don't time that
+    run_profile_wrapper(start_loc, end_loc, window[0], window[1], tt, limit_walking_time=limit_walking_time)
+
+    profile_start = time.perf_counter()
+    journeys = run_profile_wrapper(start_loc, end_loc, window[0], window[1], tt, limit_walking_time=limit_walking_time)
+    profile_time = time.perf_counter() - profile_start
+    for journey in journeys:
+        print("   ", journey)
+
+    window_start, window_end = time_to_int(window[0]), time_to_int(window[1])
+    minutes_start = time.perf_counter()
+    minute_results = []
+    for departure_time in range(window_start, window_end + 1, 60):
+        results = run_ultra_wrapper(start_loc, end_loc, time_int_to_text(departure_time), tt, limit_walking_time=limit_walking_time, scanner=PatternScanner) or []
+        minute_results += [(departure_time, r) for r in results if _num_trips(r) > 0]
+    minutes_time = time.perf_counter() - minutes_start
+
+    all_dominated = True
+    for departure_time, r in minute_results:
+        if not any(j.departure_time >= departure_time and j.num_transfers + 1 <= _num_trips(r) and j.arrival_time <= r.arrival_time for j in journeys):
+            print(f"    [!] leaving at {time_int_to_text(departure_time)} - {r} isn't dominated by the profile")
+            all_dominated = False
+    print_log(f"profile - {len(journeys)} journeys in {profile_time:.4f} seconds, "
+              f"a query per minute - {len(minute_results)} journeys in {minutes_time:.4f} seconds")
+    if all_dominated:
+        print_log("every per minute journey is dominated by the profile")
+    return all_dominated
+
+
+def main():
+    test_profile_route()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+from connection_builder import Timetable
+from station_index import DenseStations, StationsDict
+from gtfs_tables import MISSING_VALUE
+
+# Per query overlay of a timetable.
+# A query adds its own stations (start / end walking stations, car route stations), connections (walks from the start,
+# car legs) and trips (a FOOTPATH_ID_<n> / CAR_ROUTE_ID_<n> trip per walk) to the timetable it routes on.
+# Done on the shared timetable that grows with every query, shifts station indices between queries, and two queries
+# can't run at once. A QueryTimetable keeps all of those in dicts of its own, reads through to the base timetable for
+# everything else, and is dropped with the query - the base is only read, so it can be shared by threads and forked workers.
+# The base's caches built on first use (station departures, route patterns...) are built under connection_builder.SHARED_CACHES_LOCK.
+# Use tt.for_query() (run_ultra_wrapper and RaptorRouter.semi_ultra_route do it).
+
+
+class OverlayDict(object):
+    """
+    Dict-like - the query's own items first, then the base's. Writes only go to the query's own items.
+    """
+    def __init__(self, base, own=None):
+        """
+        @own - dict for the query's own items, None for a new dict
+        """
+        self.base = base
+        self.own = {} if own is None else own
+
+    def __getitem__(self, key):
+        if key in self.own:
+            return self.own[key]
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+
+    def get(self, key, default=None):
+        if key in self.own:
+            return self.own[key]
+        return self.base.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.own or key in self.base
+
+    def keys(self):
+        for key in self.base.keys():
+            yield key
+        for key in self.own.keys():
+            if key not in self.base:
+                yield key
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return len(self.base) + sum(1 for key in self.own if key not in self.base)
+
+    def values(self):
+        for key in self.keys():
+            yield self[key]
+
+    def items(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def __repr__(self):
+        return f"OverlayDict({len(self.own)} own items over {len(self.base)})"
+
+
+class QueryDenseStations(DenseStations):
+    """
+    Dense station ids of a QueryTimetable - the base timetable's ids, and after them the query's own stations.
+    """
+    def __init__(self, own_stations, base):
+        """
+        @own_stations - the query's station_id -> station dict
+        @base - DenseStations of the base timetable
+        """
+        self.base = base
+        self._merged_locations = None
+        super().__init__(own_stations)
+
+    def __len__(self):
+        return len(self.base) + len(self.ids)
+
+    def index(self, station_id):
+        idx = self.base.index(station_id)
+        if idx != MISSING_VALUE:
+            return idx
+        self.sync()
+        idx = self.ids.get(station_id)
+        return idx if idx == MISSING_VALUE else len(self.base) + idx
+
+    def station_id(self, idx):
+        if idx < len(self.base):
+            return self.base.station_id(idx)
+        return self.ids[idx - len(self.base)]
+
+    def station(self, idx):
+        if idx < len(self.base):
+            return self.base.station(idx)
+        return self._stations[self.ids[idx - len(self.base)]]
+
+    def locations(self):
+        self.sync()
+        base_locations = self.base.locations()
+        if self._merged_locations is None or self._merged_locations[0] != (self.version, self.base.version):
+            self._merged_locations = ((self.version, self.base.version), base_locations + self._locations)
+        return self._merged_locations[1]
+
+    def coordinates(self):
+        import numpy as np
+        own_lat, own_lon = super().coordinates()
+        base_lat, base_lon = self.base.coordinates()
+        return np.concatenate([base_lat, own_lat]), np.concatenate([base_lon, own_lon])
+
+
+class QueryTimetable(Timetable):
+    """
+    A Timetable for one query over a base timetable (Timetable, MappedTimetable or ServiceDayTimetable).
+    stations, trips and station_connections are OverlayDicts, anything else is the base's.
+    """
+    def __init__(self, tt):
+        self.base = tt
+        self.stations = OverlayDict(tt.stations, StationsDict())
+        self.trips = OverlayDict(tt.trips)
+        self.station_connections = OverlayDict(tt.station_connections)
+        self._walking_station_id = 0
+        self._dense_stations = None
+
+    def __getattr__(self, name):
+        # Everything which is not the query's comes from the base timetable
+        if name.startswith("__") or "base" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.base, name)
+
+    def get_station_departures(self, station_id):
+        # The base's arrays are built once and shared by all queries, only the query's own stations get arrays here
+        if station_id in self.station_connections.own:
+            return Timetable.get_station_departures(self, station_id)
+        return self.base.get_station_departures(station_id)
+
+    def get_route_patterns(self):
+        # query connections are walks / car legs, which aren't in patterns anyway
+        return self.base.get_route_patterns()
+
+    def get_dense_stations(self):
+        if self._dense_stations is None:
+            self._dense_stations = QueryDenseStations(self.stations.own, self.base.get_dense_stations())
+        return self._dense_stations.sync()
+
+    def for_service_date(self, service_date):
+        # a day of the base timetable, without this query's stations
+        return self.base.for_service_date(service_date)
+
+    def __repr__(self):
+        return f"QueryTimetable({len(self.stations.own)} stations, {len(self.trips.own)} trips of the query, over {self.base!r})"
+
+
+############################################################
+### TEST QUERY TIMETABLE ###################################
+############################################################
+
+def test_query_timetable(num_queries=8):
+    """
+    Run the benchmark queries over and over on one timetable, check the base doesn't grow and answers don't change.
+    """
+    from codetiming import Timer
+    from connection_builder import get_tlv_timetable
+    from raptor_routing import run_ultra_wrapper, BENCHMARK_ODS
+    from utils import print_log
+    tt = get_tlv_timetable()
+    sizes = (len(tt.stations), len(tt.trips), len(tt.station_connections))
+    answers = {}
+    with Timer(text="[+] " + str(num_queries) + " queries took {:.4f} seconds..."):
+        for q in range(num_queries):
+            start_loc, end_loc, start_time = BENCHMARK_ODS[q % len(BENCHMARK_ODS)]
+            results = run_ultra_wrapper(start_loc, end_loc, start_time, tt)
+            key = [[(c.departure_stop, c.arrival_stop, c.departure_time, c.arrival_time, c.trip_id) for c in r.result_connections] for r in results]
+            if q % len(BENCHMARK_ODS) in answers and answers[q % len(BENCHMARK_ODS)] != key:
+                raise AssertionError(f"query {q} changed its answer")
+            answers[q % len(BENCHMARK_ODS)] = key
+    if (len(tt.stations), len(tt.trips), len(tt.station_connections)) != sizes:
+        raise AssertionError(f"base timetable grew from {sizes} to {(len(tt.stations), len(tt.trips), len(tt.station_connections))}")
+    print_log(f"base timetable stayed at {sizes[0]} stations, {sizes[1]} trips, {sizes[2]} stations with connections")
+
+
+def main():
+    test_query_timetable()
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,30 @@
-from utils import BinarySearchIdx, time_text_to_int, get_some_items, time_int_to_text, FOOTPATH_ID, is_footpath, bus_line_from_trip_id, is_car_route
-from connection_builder import Connection, Timetable, get_tlv_timetable, SearchableStations
-from display import display_connections, display_visited_stations, display_RaptorResult
-from car_routing import build_connections_for_car_route
+from utils import time_text_to_int, time_to_int, time_int_to_text, FOOTPATH_ID, CAR_ROUTE_ID, is_footpath, bus_line_from_trip_id, is_car_route, print_log
+from connection_builder import Connection, Timetable, get_tlv_timetable
+from display import display_visited_stations, display_RaptorResult
+from car_routing import get_car_route_sources
 import time
-import utils
-import os
-import pickle
+from bisect import bisect_left, bisect_right
 from codetiming import Timer
 from dataclasses import dataclass
 from valhalla_interface import get_actor 
+from walking_cache import get_walking_caches
+from gtfs_tables import MISSING_VALUE
+from query_timetable import QueryTimetable
+
+# walking time of stations from which the end can't be walked to (walking engines give None time for them)
+UNREACHABLE_WALKING_TIME = 48 * 60 * 60
+# Access / egress walking is only asked for stations in a radius around the start / end. A walk is never shorter than the straight line,
+# so at WALKING_SPEED (valhalla's pedestrian default, 5.1 km/h) a station further than limit_walking_time * WALKING_SPEED can't be walked to in time.
+WALKING_SPEED = 5.1 / 3.6 # m/s
+DEFAULT_WALKING_RADIUS = 1500 # meters, the first radius tried
+WALKING_RADIUS_GROWTH = 2 # the radius grows by this while no journey is found, up to the limit_walking_time radius
+MAX_ROUNDS = 4 # rounds of raptor_route, a journey has at most this many trips
+INITIAL_ARRIVAL_TIME = time_text_to_int("47:59:59") + 1000 # arrival to the end before one is found - impossible time, GTFS times can go past 24:00:00
+
+class WalkingTimes(dict):
+    # station_id -> walking time to the end, stations which weren't asked (out of the egress radius) can't walk there
+    def __missing__(self, station_id):
+        return UNREACHABLE_WALKING_TIME
 
 class RaptorResult_v2():
     def __init__(self, result_route, tt):
@@ -17,7 +33,7 @@ class RaptorResult_v2():
         # Note - the first element in the list is the first station, and the last element is the last station
         @tt - timetable object
         """
-        # Departure time is the departure time from the first station
+        # Departure time is the departure time from the first station (int seconds, formatted only when displayed)
         self.departure_time = result_route[0][1][0].departure_time
         # Arrival time is the arrival time to the last station, should be walk connection
         self.arrival_time = result_route[-1][1][-1].arrival_time
@@ -28,7 +44,7 @@ class RaptorResult_v2():
             self.result_connections += connections
         self.num_stops = len(self.result_connections) - 2 # remove 2 because of walking...?
         self.num_transfers = len(result_route)-2 # if no transfers, the result route is of length 2 (start station, end station)
-        self.trip_time = (time_text_to_int(self.arrival_time) - time_text_to_int(self.departure_time)) / 60
+        self.trip_time = (self.arrival_time - self.departure_time) / 60
         self.bus_lines = []
         for r in self.result_route:
             line = bus_line_from_trip_id(self.tt, r[1][0].trip_id)
@@ -38,49 +54,176 @@ class RaptorResult_v2():
         display_RaptorResult(self)
 
     def __str__(self):
-        return f"RaptorResult: departure_time={self.departure_time}, arrival_time={self.arrival_time}, trip_time={self.trip_time}, num_stops={self.num_stops}, num_transfers={self.num_transfers}, bus_lines={self.bus_lines}"
+        return f"RaptorResult: departure_time={time_int_to_text(self.departure_time)}, arrival_time={time_int_to_text(self.arrival_time)}, trip_time={self.trip_time}, num_stops={self.num_stops}, num_transfers={self.num_transfers}, bus_lines={self.bus_lines}"
 
 
 class RaptorRouter(object):
-    def __init__(self, tt):
+    def __init__(self, tt, walking_engine=None, walking_caches=None):
         # All optimizations should be perforemd on the timetable object
         # This class should only be used to route and handle Valhalla API
-        self.actor = get_actor(tt)
+        # walking_engine - anything with a valhalla like matrix(query), e.g. an offline pedestrian_graph.PedestrianGraph. None for valhalla.
+        # walking_caches - walking_cache.WalkingCaches of access / egress walking, None for the process wide ones
+        self.walking_engine = walking_engine
+        self.actor = get_actor(tt) if walking_engine is None else walking_engine
+        self.walking_speed = getattr(walking_engine, "walking_speed", WALKING_SPEED)
+        self.engine_tag = "valhalla" if walking_engine is None else getattr(walking_engine, "cache_tag", type(walking_engine).__name__)
+        self.walking_caches = get_walking_caches() if walking_caches is None else walking_caches
         self.tt = tt
 
-    def _get_stations_as_locations(self):
-        # This was static, but as we dinamically add stations on the go we need to redo it. 
-        # TODO: cache this and only recalculate if stations where added or removed. 
-        return  [{"lat": s["stop_lat"], "lon": s["stop_lon"]} for s in self.tt.stations.values()]
-
-    def _get_walking_start_end_results(self, start_lon_lat, end_lon_lat, reparse=False):
-        # load from file if exists
-        file_path = os.path.join(utils.ARTIFACTS_FOLDER, f"walking_start_{'_'.join([str(i) for i in start_lon_lat.values()])}_end_{'_'.join([str(i) for i in end_lon_lat.values()])}_results.pkl")
-        if os.path.isfile(file_path) and not reparse:
-            with Timer(text="[+] loading from file paths from src to all stations took {:.4f} seconds..."):
-                sorted_start_to_st, end_footpath_connections = utils.load_artifact(file_path)
-        else:
-            stations_as_locations = self._get_stations_as_locations()
-            targets = [end_lon_lat] + stations_as_locations
-            query = {"sources" :[start_lon_lat], "targets": targets, "costing": "pedestrian"}
-            print(f"[+] parsing query - {len(stations_as_locations)}")
-            with Timer(text="[+] searching paths from src to all stations took {:.4f} seconds..."):
-                source_footpath_connections = self.actor.matrix(query)
-                sorted_start_to_st = sorted(source_footpath_connections["sources_to_targets"][0], key=lambda x: x["time"])
-            # Now in sorted_stt we have all the stations sorted by time to get there by foot from start station.
-            # Also the first index in source_footpath_connections["targets"] is the end location, so we already have walking time to it if we want :)
-
-            # Get paths from all other stations to end station
-            query = {"sources" : stations_as_locations, "targets": [end_lon_lat], "costing": "pedestrian"}
-            with Timer(text="[+] searching paths from all stations to dst took {:.4f} seconds..."):
-                end_footpath_connections = self.actor.matrix(query)
-                #sorted_st_to_end = sorted(source_footpath_connections["sources_to_targets"][0], key=lambda x: x["time"])     
-            utils.save_artifact((sorted_start_to_st, end_footpath_connections), file_path)
-        
-        return sorted_start_to_st, end_footpath_connections
+    def _walking_cache_key(self, cell, radius):
+        # walking of another engine, or to another set of stations, is kept apart
+        return (self.engine_tag, self.tt.searchable_stations.fingerprint(), cell, None if radius is None else int(radius))
+
+    def _indexed_stations(self, location, radius):
+        """
+        Stations of the station index in radius meters (straight line) of location, all of them if radius is None.
+        returns (station ids, their locations)
+        """
+        index = self.tt.searchable_stations
+        dense_stations = self.tt.get_dense_stations()
+        locations = dense_stations.locations()
+        if radius is None:
+            # the index has the timetable's stations from before queries added their own, which are the first dense ids
+            # (dense ids never change, removed stations are skipped)
+            indexed = [i for i in range(len(index)) if i not in dense_stations.removed]
+            return [dense_stations.station_id(i) for i in indexed], [locations[i] for i in indexed]
+        station_ids, station_locations = [], []
+        for s in index.search_nearby_stations({"stop_lat": location["lat"], "stop_lon": location["lon"]}, radius):
+            idx = dense_stations.index(s["station_id"])
+            if idx != MISSING_VALUE:
+                station_ids.append(s["station_id"])
+                station_locations.append(locations[idx])
+        return station_ids, station_locations
+
+    def _get_access(self, start_lon_lat, radius, reparse=False):
+        """
+        returns [(station_id, walking time, distance)] from the start's grid cell to indexed stations in radius, unreachable ones left out
+        """
+        cell, center = self.walking_caches.snap(start_lon_lat)
+        key = self._walking_cache_key(cell, radius)
+        access = None if reparse else self.walking_caches.access.get(key)
+        if access is None:
+            station_ids, locations = self._indexed_stations(center, radius)
+            access = []
+            if len(station_ids) > 0:
+                with Timer(text="[+] searching paths from src to all stations took {:.4f} seconds..."):
+                    result = self.actor.matrix({"sources": [center], "targets": locations, "costing": "pedestrian"})
+                access = [(station_ids[f["to_index"]], f["time"], f["distance"]) for f in result["sources_to_targets"][0] if f["time"] is not None]
+            self.walking_caches.access.put(key, access)
+        return access
+
+    def _get_egress(self, end_lon_lat, radius, reparse=False):
+        """
+        returns [(station_id, walking time, distance)] from indexed stations in radius to the end's grid cell, unreachable ones left out
+        """
+        cell, center = self.walking_caches.snap(end_lon_lat)
+        key = self._walking_cache_key(cell, radius)
+        egress = None if reparse else self.walking_caches.egress.get(key)
+        if egress is None:
+            station_ids, locations = self._indexed_stations(center, radius)
+            egress = []
+            if len(station_ids) > 0:
+                with Timer(text="[+] searching paths from all stations to dst took {:.4f} seconds..."):
+                    result = self.actor.matrix({"sources": locations, "targets": [center], "costing": "pedestrian"})
+                egress = [(station_ids[row[0]["from_index"]], row[0]["time"], row[0]["distance"]) for row in result["sources_to_targets"]
+                          if row[0]["time"] is not None]
+            self.walking_caches.egress.put(key, egress)
+        return egress
+
+    def _get_direct(self, start_lon_lat, end_lon_lat, extra_ids, extra_locations, reparse=False):
+        """
+        The direct walk from the start's grid cell to the end's, and walks from the start / to the end of extra_ids - stations which
+        aren't in the station index (walking / car route stations added to the timetable). Cached like access / egress.
+        returns ([(station_id, walking time, distance)] from the start - None for the end, [(station_id, walking time, distance)] to the end),
+            unreachable ones left out
+        """
+        start_cell, start_center = self.walking_caches.snap(start_lon_lat)
+        end_cell, end_center = self.walking_caches.snap(end_lon_lat)
+        extra_key = tuple((station_id, float(location["lat"]), float(location["lon"])) for station_id, location in zip(extra_ids, extra_locations))
+        key = (self.engine_tag, "direct", start_cell, end_cell, extra_key)
+        direct = None if reparse else self.walking_caches.access.get(key)
+        if direct is None:
+            result = self.actor.matrix({"sources": [start_center], "targets": [end_center] + extra_locations, "costing": "pedestrian"})
+            targets = [None] + extra_ids
+            direct = [(targets[f["to_index"]], f["time"], f["distance"]) for f in result["sources_to_targets"][0] if f["time"] is not None]
+            self.walking_caches.access.put(key, direct)
+        if len(extra_ids) == 0:
+            return direct, []
+        key = (self.engine_tag, "extra", end_cell, extra_key)
+        extra_egress = None if reparse else self.walking_caches.egress.get(key)
+        if extra_egress is None:
+            result = self.actor.matrix({"sources": extra_locations, "targets": [end_center], "costing": "pedestrian"})
+            extra_egress = [(extra_ids[row[0]["from_index"]], row[0]["time"], row[0]["distance"]) for row in result["sources_to_targets"]
+                            if row[0]["time"] is not None]
+            self.walking_caches.egress.put(key, extra_egress)
+        return direct, extra_egress
+
+    def _get_walking_start_end_results(self, start_lon_lat, end_lon_lat, reparse=False, radius=None, exclude_stations=()):
+        """
+        Walking from the start to stations and from stations to the end.
+        @reparse - don't read the walking caches (results are still written to them)
+        @radius - meters, only ask walking for stations this far from the start / end in a straight line. None for all stations.
+        @exclude_stations - station ids not to walk to / from, the query's own start and end stations
+        returns (walks from the start sorted by time - to_index 0 is the end, station with dense id i (tt.get_dense_stations) is i + 1,
+                 valhalla like matrix of walks to the end - from_index is the station's dense id)
+        """
+        access = self._get_access(start_lon_lat, radius, reparse)
+        egress = self._get_egress(end_lon_lat, radius, reparse)
+
+        # The direct walk, and stations added after the index was built (walking / car route stations) - those are the last dense ids
+        dense_stations = self.tt.get_dense_stations()
+        locations = dense_stations.locations()
+        extra = [i for i in range(len(self.tt.searchable_stations), len(dense_stations))
+                 if i not in dense_stations.removed and dense_stations.station_id(i) not in exclude_stations]
+        direct, extra_egress = self._get_direct(start_lon_lat, end_lon_lat, [dense_stations.station_id(i) for i in extra],
+                                                [locations[i] for i in extra], reparse)
+
+        start_to_st = []
+        for station_id, t, distance in access + direct:
+            idx = -1 if station_id is None else dense_stations.index(station_id)
+            if station_id is None or idx != MISSING_VALUE:
+                start_to_st.append({"from_index": 0, "to_index": idx + 1, "time": t, "distance": distance})
+        end_rows = []
+        for station_id, t, distance in egress + extra_egress:
+            idx = dense_stations.index(station_id)
+            if idx != MISSING_VALUE:
+                end_rows.append([{"from_index": idx, "to_index": 0, "time": t, "distance": distance}])
+
+        sorted_start_to_st = sorted(start_to_st, key=lambda x: x["time"])
+        return sorted_start_to_st, {"sources_to_targets": end_rows}
+
+    def _walking_sources_targets(self, start_station, end_station, start_lon_lat, end_lon_lat, tt, radius, limit_walking_time=60*60, reparse=False):
+        """
+        Walks from the start and to the end, as raptor_route sources / targets - no connections or trips are added for them.
+        @reparse - see _get_walking_start_end_results. If there is a car route then i need to rebuild footpaths to account the stations created by the car route.
+        returns (station_id -> walking seconds from the start, station_id -> walking seconds to the end).
+            end_station is in the first if the end can be walked to.
+        """
+        sorted_start_to_st, end_footpath_connections = self._get_walking_start_end_results(start_lon_lat, end_lon_lat, reparse=reparse, radius=radius,
+                                                                                            exclude_stations=(start_station["station_id"], end_station["station_id"]))
+
+        dense_stations = tt.get_dense_stations()
+        access = {}
+        for s_to_t in sorted_start_to_st:
+            if s_to_t["time"] > limit_walking_time:
+                break
+            if s_to_t["to_index"] == 0:
+                # found path to end location - considered exiting here, but idk if i want to actually. 
+                target_station = end_station
+            else:
+                # Note below, -1 because i also search a path to the end location.
+                target_station = dense_stations.station(s_to_t["to_index"]-1)
+            # sorted by time, so the first walk to a station is the fastest
+            access.setdefault(target_station["station_id"], s_to_t["time"])
 
+        targets = {}
+        for s_to_t in end_footpath_connections["sources_to_targets"]:
+            if s_to_t[0]["time"] is not None:
+                targets[dense_stations.station_id(s_to_t[0]["from_index"])] = s_to_t[0]["time"]
+        return access, targets
 
-    def semi_ultra_route(self, start_location, end_location, start_time, tt : Timetable, car_route=False, relax_footpaths=True,debug=False, limit_walking_time=60*60):        
+    def semi_ultra_route(self, start_location, end_location, start_time, tt : Timetable, car_route=False, relax_footpaths=True,debug=False, limit_walking_time=60*60, scanner=None,
+                         transfer_shortcuts=None, walking_radius=DEFAULT_WALKING_RADIUS, car_sources=None, engine=None):
         """
         # route using the ULTRA algorithm, but only for the first and last leg of the trip
         # for now we skip optimization for the middle part of the trip, because it requires alot of preprocessing on the graph.
@@ -88,46 +231,59 @@ class RaptorRouter(object):
         1. Relax footpaths at start and end (using one-to-many implemented in Valhalla)
             1.2 let's start by implementing it as added connections from the start and end stations to all other stations.
         2. Route from start to end using RAPTOR (for now still without relaxing middle footpaths)
+        @scanner - trips scan of raptor_route, None for the default TripScanner
+        @transfer_shortcuts - see raptor_route
+        @walking_radius - meters, walking at the start and end is only asked for stations this far away in a straight line.
+            If no journey is found the radius grows (WALKING_RADIUS_GROWTH) up to the radius limit_walking_time can walk.
+            None to ask every station, like before.
+        @car_sources - station_id -> arrival time (int seconds) of a car drop off there (car_routing.get_car_route_sources),
+            they are raptor_route sources next to the walks from the start.
+        @engine - function routing each query, with raptor_route's parameters and results (vector_raptor_routing.vector_raptor_route).
+            None for raptor_route.
+        @tt - the Start / End walking stations are added to it if it is a QueryTimetable, any other timetable is routed on its
+            tt.for_query() and left as it was. To read the results' Start / End stations pass a tt.for_query() (run_ultra_wrapper does).
         """
+        if not isinstance(tt, QueryTimetable):
+            # walking stations added to a shared timetable stay there and shift its station ids, see query_timetable.py
+            tt = tt.for_query()
         # {"sources":[{"lat":40.744014,"lon":-73.990508}],"targets":[{"lat":40.744014,"lon":-73.990508},{"lat":40.739735,"lon":-73.979713},{"lat":40.752522,"lon":-73.985015},{"lat":40.750117,"lon":-73.983704},{"lat":40.750552,"lon":-73.993519}],"costing":"pedestrian"}
         # Get paths from start to all other stations
+        start_time = time_to_int(start_time)
         start_lon_lat = {"lat": start_location["stop_lat"], "lon": start_location["stop_lon"]}
         end_lon_lat = {"lat": end_location["stop_lat"], "lon": end_location["stop_lon"]}
         start_station = tt._create_walking_station(start_lon_lat, name="Start")
         end_station = tt._create_walking_station(end_lon_lat, name="End")
-        
-        # If there is a car route then i need to rebuild footpaths to account the stations created by the car route.
-        # TODO: This can be done better - i can use the previous data for static station and only add new ones.
-        sorted_start_to_st, end_footpath_connections = self._get_walking_start_end_results(start_lon_lat, end_lon_lat, reparse=car_route)
-       
-        # Now we have all the stations sorted by time to get there by foot from end station, so insert it to the graph!
-        # TODO: optimization - it might be faster to search for stations 1 km from me, and only if the algorithm is not satisfied at the end i will search more.
-        for i, s_to_t in enumerate(sorted_start_to_st):
-            if s_to_t["time"] > limit_walking_time:
-                break
-            if s_to_t["to_index"] == 0:
-                # found path to end location - considered exiting here, but idk if i want to actually. 
-                target_station = end_station
-            else:
-                # Note below, -1 because i also search a path to the end location.
-                target_station = list(tt.stations.values())[s_to_t["to_index"]-1]
-            
-            # create a new trip for this walk
-            trip_id = FOOTPATH_ID + "_" + str(i)
-            tt.trips[trip_id] = tt.trips[FOOTPATH_ID]  
 
-            # create a connection from start location to this station
-            c = Connection(start_station["station_id"], target_station["station_id"], start_time,
-             time_int_to_text(time_text_to_int(start_time) + s_to_t["time"]), trip_id)
-            
-            # TODO: there is an issue here, i can't just append this, i need to insert this at start_time!
-            # Because the start station is one we just created, and this for loop is run on a sorted list by time,
-            # The station_connections for this station will also be sorted by time and there is no issue here. 
-            tt.station_connections[start_station["station_id"]].append(c)
+        # limit_walking_time is enforced before asking for walks - nothing out of this radius can be walked to in time
+        max_radius = limit_walking_time * self.walking_speed
+        radius = None if walking_radius is None else min(walking_radius, max_radius)
+        while True:
+            result_routes = self._route_with_walking_radius(start_station, end_station, start_lon_lat, end_lon_lat, start_time, tt, radius, car_route=car_route,
+                                                            relax_footpaths=relax_footpaths, debug=debug, limit_walking_time=limit_walking_time, scanner=scanner,
+                                                            transfer_shortcuts=transfer_shortcuts, car_sources=car_sources, engine=engine)
+            if radius is None or radius >= max_radius or any(len(round_res) > 0 for round_res in result_routes):
+                return result_routes
+            radius = min(radius * WALKING_RADIUS_GROWTH, max_radius)
+            print_log(f"no journey found, growing the walking radius to {radius:.0f}m")
+
+    def _route_with_walking_radius(self, start_station, end_station, start_lon_lat, end_lon_lat, start_time, tt, radius, car_route=False, relax_footpaths=True,
+                                   debug=False, limit_walking_time=60*60, scanner=None, transfer_shortcuts=None, car_sources=None, engine=None):
+        access, targets = self._walking_sources_targets(start_station, end_station, start_lon_lat, end_lon_lat, tt, radius,
+                                                        limit_walking_time=limit_walking_time, reparse=car_route)
+        sources = {station_id: start_time + walking_time for station_id, walking_time in access.items()}
+        source_trip_ids = {}
+        if car_sources is not None:
+            for station_id, arrival_time in car_sources.items():
+                if station_id not in sources or arrival_time < sources[station_id]:
+                    sources[station_id] = arrival_time
+                    source_trip_ids[station_id] = CAR_ROUTE_ID
 
         # Call normal raptor_route, with the exception that now we can relax end footpaths
-        return raptor_route(start_station["station_id"], end_station["station_id"], start_time, tt,
-                             end_footpath_connections=end_footpath_connections, relax_footpaths=relax_footpaths, limit_walking_time=limit_walking_time, debug=debug)
+        if engine is None:
+            engine = raptor_route
+        return engine(start_station["station_id"], end_station["station_id"], start_time, tt,
+                             relax_footpaths=relax_footpaths, limit_walking_time=limit_walking_time, debug=debug, scanner=scanner,
+                             transfer_shortcuts=transfer_shortcuts, sources=sources, targets=targets, source_trip_ids=source_trip_ids)
 
     
 @dataclass
@@ -136,30 +292,185 @@ class RVisidetStation:
     leading_connections : list[Connection]
     walking_arrival_time_to_end: int # This is the hour at which we will arrive at the target station if we start walking at `arrival_time`
 
-def _traverse_station(station_to_traverse : str, visited_stations : dict[str: RVisidetStation], end_station : str, start_station : str):
+def _traverse_station(station_to_traverse : str, visited_stations : dict[str: RVisidetStation], end_station : str, start_station : str, start_time=None,
+                      source_trip_ids=None, target_trip_ids=None):
     # I got here if the station_to_traverse was a good option to get to the end station.
     # Now i need to iterate through visited_stations, and find the path to this station from the start station
     #end_arrival_time, prev_station, end_connection, prev_connection = visited_stations[end_station]
     result_route = []
-    final_walk_connection = Connection(station_to_traverse, end_station, time_int_to_text(visited_stations[station_to_traverse].arrival_time),
-             time_int_to_text(visited_stations[station_to_traverse].walking_arrival_time_to_end), FOOTPATH_ID)
+    # Sources of raptor_route have no leading connections - their leg from the start is only built here, for the stations of a result.
+    source_trip_ids = source_trip_ids or {}
+    target_trip_ids = target_trip_ids or {}
+    final_walk_connection = Connection(station_to_traverse, end_station, visited_stations[station_to_traverse].arrival_time,
+             visited_stations[station_to_traverse].walking_arrival_time_to_end, target_trip_ids.get(station_to_traverse, FOOTPATH_ID))
     result_route.insert(0, (end_station, [final_walk_connection]))
     prev_station = station_to_traverse
     while prev_station != start_station:
-        result_route.insert(0, (prev_station,  visited_stations[prev_station].leading_connections))
-        prev_station = visited_stations[prev_station].leading_connections[0].departure_stop
+        leading_connections = visited_stations[prev_station].leading_connections
+        if len(leading_connections) == 0:
+            leading_connections = [Connection(start_station, prev_station, start_time, visited_stations[prev_station].arrival_time,
+                                              source_trip_ids.get(prev_station, FOOTPATH_ID))]
+        result_route.insert(0, (prev_station, leading_connections))
+        prev_station = leading_connections[0].departure_stop
     
     # Insert the first station as well
     # result_route.insert(0, (prev_station, []))
     return result_route
 
-def raptor_route(start_station, end_station, start_time, tt, end_footpath_connections=None, relax_footpaths=True, limit_walking_time=1* 60 * 60, limit_mid_walking_time= 60*6, debug=False):
+@dataclass
+class RaptorCounters:
+    # How much work raptor_route queries did, raptor_route(..., counters=RaptorCounters()) adds each query to it
+    queries: int = 0
+    rounds: int = 0
+    scanned_stations: int = 0 # marked stations whose leaving trips were scanned
+    followed_trips: int = 0 # trips boarded by the scans
+    improved_labels: int = 0 # stations a trip got to earlier
+    pruned_labels: int = 0 # trip arrivals dropped since they are not before the best arrival to the end
+    walked_labels: int = 0 # stations a footpath got to earlier
+    target_updates: int = 0 # times the best arrival to the end got earlier
+
+class RaptorTarget(object):
+    """
+    The best known arrival to the end of a raptor_route query - getting off at a station and walking stations_to_end from it.
+    Labels which are not before arrival_time can't get us to the end earlier, so the scans prune them.
+    """
+    def __init__(self, stations_to_end, limit_walking_time, counters, immediate=True):
+        """
+        @immediate - update arrival_time as soon as a station improves it. If False it only moves at end_round (the bound of a whole round).
+        """
+        self.stations_to_end = stations_to_end
+        self.limit_walking_time = limit_walking_time
+        self.counters = counters
+        self.immediate = immediate
+        # the bound labels are pruned with
+        self.arrival_time = INITIAL_ARRIVAL_TIME
+        # best arrival to the end so far, and the station we walk to the end from
+        self.best_arrival_time = INITIAL_ARRIVAL_TIME
+        self.station = None
+
+    def improve(self, station, arrival_time):
+        # called with every station improved by a trip, arrival_time is the new arrival time to the station
+        egress_time = self.stations_to_end[station]
+        if egress_time < self.limit_walking_time and arrival_time + egress_time < self.best_arrival_time:
+            self.best_arrival_time = arrival_time + egress_time
+            self.station = station
+            self.counters.target_updates += 1
+            if self.immediate:
+                self.arrival_time = self.best_arrival_time
+
+    def end_round(self):
+        self.arrival_time = self.best_arrival_time
+
+class TripScanner(object):
+    """
+    The trips scan of a RAPTOR round - every connection leaving a marked station (departing after our arrival to it)
+    is followed with tt.follow_trip, and every trip is followed at most once per query.
+    raptor_route creates one per query, see pattern_raptor_routing.PatternScanner for a scan by route patterns.
+    """
+    def __init__(self, tt, start_time, end_station, counters=None):
+        """
+        @start_time - int seconds
+        @counters - RaptorCounters to count the scans in
+        """
+        self.tt = tt
+        self.start_time = start_time
+        self.end_station = end_station
+        self.counters = counters if counters is not None else RaptorCounters()
+        # visited_routes is a dict of routes - Do not iterate the same route twice
+        self.visited_routes = {}
+
+    def scan(self, new_stations, visited_stations, next_round_new_stations, stations_to_end, max_time_threshold, target):
+        """
+        Improve visited_stations with trips leaving new_stations (station -> arrival time marked last round),
+        and put improved stations in next_round_new_stations.
+        @target - RaptorTarget of the query, improved with every improved station
+        """
+        counters = self.counters
+        for station, st_arrival_time in new_stations.items():
+            # iterate connections starting from the start_time
+            # TODO: think about what to do regarding day-night transitions...
+            if station not in self.tt.station_connections:
+                # if station has no connections leaving from it.
+                continue
+            
+            # Nothing leaving after max_time_threshold (the best arrival to the end once we have one) can get us there earlier.
+            if st_arrival_time > max_time_threshold or \
+                st_arrival_time < self.start_time: # check wrap around of 24h clock  TODO: wraparound problem
+                continue
+            counters.scanned_stations += 1
+
+            connections = self.tt.station_connections[station]
+            departures = self.tt.get_station_departures(station)
+            # Iterate all connections from station which depart after our arrival time to it (and not after max_time_threshold).
+            for station_conn_idx in range(bisect_left(departures, st_arrival_time), bisect_right(departures, max_time_threshold)):
+                origin_c = connections[station_conn_idx]
+                # Check if we already visited this route
+                #if self.tt.trips[origin_c.trip_id]["route_id"] in self.visited_routes:
+                #    continue
+                if origin_c.trip_id in self.visited_routes:
+                   continue
+
+                # Again here i need to check if the arrival time is later than the current best arrival time
+                # Break here if not, since connections are sorted by departure time from the station
+                if origin_c.departure_time > max_time_threshold or\
+                    origin_c.departure_time < self.start_time: # TODO:  wraparound problem
+                    break
+
+                self.visited_routes[origin_c.trip_id] = True
+                counters.followed_trips += 1
+                # Check if we can improve the arrival time to the arrival station
+                trip_connections = self.tt.follow_trip(origin_c)
+
+                for conn_idx, following_c in enumerate(trip_connections):
+                    curr_arrival_time = following_c.arrival_time
+                    if curr_arrival_time >= target.arrival_time or\
+                        curr_arrival_time < self.start_time: # TODO: wraparound problem
+
+                        # We can't improve the arrival time to this station, so we can stop searching this trip
+                        counters.pruned_labels += 1
+                        break
+                    if following_c.arrival_stop not in visited_stations or \
+                        curr_arrival_time < visited_stations[following_c.arrival_stop].arrival_time:
+                        # It is not enough to save station, because if a trip has circles we need to know.
+                        # So if this is the best connection to bring us to the station, set the arrival stop of this station to this connection.
+                        # TODO: implement walking to the end stations. i need to approach this with a fresher mind, but what i think
+                        # is possible is instead of comparing arrival time, we will compare arrival time + walking time to the end station.
+                        
+                        # 
+                        # V2 - in visited stations, i will save entire connections for this trip, to avoid needing traversing the trip again.
+                        # V2 - also calculate walking distance from the end station.
+                        visited_stations[following_c.arrival_stop] = RVisidetStation(curr_arrival_time, trip_connections[:conn_idx+1], curr_arrival_time + stations_to_end[following_c.arrival_stop])
+                        next_round_new_stations[following_c.arrival_stop] = curr_arrival_time
+                        counters.improved_labels += 1
+                        # the rest of this trip (and the rest of the round) is pruned with it right away
+                        target.improve(following_c.arrival_stop, curr_arrival_time)
+
+                    if following_c.arrival_stop == self.end_station:
+                        # We found a route !
+                        # There is no point further persuing this trip...
+                        break
+
+def raptor_route(start_station, end_station, start_time, tt, end_footpath_connections=None, relax_footpaths=True, limit_walking_time=1* 60 * 60, limit_mid_walking_time= 60*6, debug=False, scanner=None,
+                 transfer_shortcuts=None, sources=None, targets=None, source_trip_ids=None, target_trip_ids=None, counters=None, target_pruning=True):
     """
     Route from station to station
     @start_station - the station to start from
     @end_station - the station to end at
-    @start_time - the time to start from
+    @start_time - the time to start from, int seconds from the start of the service day (or "hh:mm:ss" text)
     @tt - a timetable object
+    @scanner - class of the trips scan of each round (TripScanner, pattern_raptor_routing.PatternScanner), None for TripScanner
+    @transfer_shortcuts - ULTRA shortcuts (ultra_shortcuts.get_transfer_shortcuts) to relax between rounds instead of tt.stations_footpaths.
+        They are only the walks optimal journeys need, so they are relaxed without limit_mid_walking_time.
+    @sources - station_id -> earliest arrival time (int seconds) there, for a query from several stations (walks / car drop offs from the start).
+        Round 0 starts at them instead of scanning start_station's connections, and their leg from start_station is only built for results.
+        None to start from start_station at start_time.
+    @targets - station_id -> seconds from the station to end_station (walks / car pick ups to the end), on top of end_footpath_connections.
+    @source_trip_ids / target_trip_ids - station_id -> trip id of its leg from the start / to the end, FOOTPATH_ID if not given
+    @counters - RaptorCounters to add the work of this query to
+    @target_pruning - prune labels with the best arrival to the end as soon as it is found, and stop once a round marks no stations.
+        False for the older bounds (for comparing) - the best arrival only prunes from the next round, trips may leave up to
+        limit_walking_time after it and all MAX_ROUNDS are run.
+    returns a list of results for every round - the journey with that many trips, if it gets to the end earlier than the previous rounds.
     """
     # The algorithm is as follows:
     # 1. Initialize a set of stations that we know we can reach from the start station
@@ -177,11 +488,11 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
  
 
     # stations_to_end - This is a dict of station -> time to the end station. Initialise it with the walking time to the end station.
-    stations_to_end = {}
+    stations_to_end = WalkingTimes()
     if end_footpath_connections is not None:
-        source_stations = list(tt.stations.values())
+        dense_stations = tt.get_dense_stations()
         for s_to_t in end_footpath_connections["sources_to_targets"]:
-            st = source_stations[s_to_t[0]["from_index"]]
+            station_id = dense_stations.station_id(s_to_t[0]["from_index"])
             # if s_to_t[0]["time"] > limit_walking_time:
             #     continue
             # Here i can not make a connection, because i don't know the arrival time to the end station.
@@ -191,112 +502,58 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
             """
             # This will only work if i traverse the first walking connections before this one... this is not very good
             # shouldn't be thinking of algorithms at 1 AM i guess...
-            stations_to_end[st["station_id"]] = s_to_t[0]["time"]
+            stations_to_end[station_id] = s_to_t[0]["time"] if s_to_t[0]["time"] is not None else UNREACHABLE_WALKING_TIME
+    if targets is not None:
+        for station_id, egress_time in targets.items():
+            stations_to_end[station_id] = min(egress_time, stations_to_end[station_id])
     
    
-    # visited_routes is a dict of routes - Do not iterate the same route twice
-    visited_routes = {}
-    start_time_int = time_text_to_int(start_time)
+    start_time_int = time_to_int(start_time)
+    if scanner is None:
+        scanner = TripScanner
+    if counters is None:
+        counters = RaptorCounters()
+    counters.queries += 1
+    scanner = scanner(tt, start_time_int, end_station, counters)
+    target = RaptorTarget(stations_to_end, limit_walking_time, counters, immediate=target_pruning)
     # visited_stations is a dict of station_id -> RVisidetStation(arrival_time, leading_connections, walking_arrival_time_to_end)
     visited_stations = {start_station : RVisidetStation(start_time_int, [], start_time_int + stations_to_end[start_station])}
 
     new_stations = {start_station: start_time_int}
     next_round_new_stations = {}
+    if sources is not None:
+        # Round 0 has nothing to scan, the sources are the stations it reached
+        new_stations = {}
+        for station, arrival_time in sources.items():
+            if arrival_time < start_time_int:
+                continue
+            if station not in visited_stations or arrival_time < visited_stations[station].arrival_time:
+                visited_stations[station] = RVisidetStation(arrival_time, [], arrival_time + stations_to_end[station])
+                next_round_new_stations[station] = arrival_time
     total_result_routes = []
-    MAX_ROUNDS = 4
-    INITIAL_ARRIVAL_TIME = time_text_to_int("23:59:59") + 1000 # initiate to impossible time
-    current_target_arrival_time = INITIAL_ARRIVAL_TIME 
-
 
     for r in range(MAX_ROUNDS):
-        # if end_station in visited_stations:
-        #     current_target_arrival_time = visited_stations[end_station].arrival_time
+        counters.rounds += 1
         # TODO: Make the threashold time before finding taregt_arrival time as walking distance from start to end + some factor. 
-        if current_target_arrival_time != INITIAL_ARRIVAL_TIME:
-            MAX_TIME_THRESHOLD = current_target_arrival_time + limit_walking_time
-        else:
+        if target.arrival_time == INITIAL_ARRIVAL_TIME:
             MAX_TIME_THRESHOLD = stations_to_end[start_station] + start_time_int + limit_walking_time
-        
-        for station, st_arrival_time in new_stations.items():
-            # iterate connections starting from the start_time
-            # TODO: think about what to do regarding day-night transitions...
-            if station not in tt.station_connections:
-                # if station has no connections leaving from it.
-                continue
-            
-            # Check if the arrival time here is later in a significant amount than the current best arrival time
-            # (use limit_walking_time as an approximation for flexibility, TODO: maybe i should use a different value here...)
-            # Do not simply check if it is later, because maybe we will prefer more transfers and a slightly later arrival time.
-            # Note that i will get many like these at the second/third round usually. I've been thinking if there is a way to not get them at all,
-            # But it would be difficult because i only calculate current_target_arrival_time at the end of each round. if i'll build it dynamically i might save some time.
-            # Maybe a greedy approach for each round will improve this, but for now it's good enough. 
-            if st_arrival_time > MAX_TIME_THRESHOLD or \
-                st_arrival_time < start_time_int: # check wrap around of 24h clock  TODO: wraparound problem
-                continue
-
-            first_connection = BinarySearchIdx(tt.station_connections[station], st_arrival_time, key=lambda x: time_text_to_int(x.departure_time))
-            connections =  tt.station_connections[station][first_connection:]
-            # Iterate all connections from station which depart after our arrival time to it.
-            for origin_c in connections:
-                # Check if we already visited this route
-                #if tt.trips[origin_c.trip_id]["route_id"] in visited_routes:
-                #    continue
-                if origin_c.trip_id in visited_routes:
-                   continue
-
-                # Again here i need to check if the arrival time is later than the current best arrival time
-                # Break here if not, since connections are sorted by departure time from the station
-                if time_text_to_int(origin_c.departure_time) > MAX_TIME_THRESHOLD or\
-                    time_text_to_int(origin_c.departure_time) < start_time_int: # TODO:  wraparound problem
-                    break
-
-                visited_routes[origin_c.trip_id] = True
-                # Check if we can improve the arrival time to the arrival station
-                trip_connections = tt.follow_trip(origin_c)
-
-                for conn_idx, following_c in enumerate(trip_connections):
-                    curr_arrival_time = time_text_to_int(following_c.arrival_time) 
-                    if curr_arrival_time >= current_target_arrival_time or\
-                        curr_arrival_time < start_time_int: # TODO: wraparound problem
+        elif target_pruning:
+            MAX_TIME_THRESHOLD = target.arrival_time
+        else:
+            MAX_TIME_THRESHOLD = target.arrival_time + limit_walking_time
 
-                        # We can't improve the arrival time to this station, so we can stop searching this trip
-                        break
-                    if following_c.arrival_stop not in visited_stations or \
-                        curr_arrival_time < visited_stations[following_c.arrival_stop].arrival_time:
-                        # It is not enough to save station, because if a trip has circles we need to know.
-                        # So if this is the best connection to bring us to the station, set the arrival stop of this station to this connection.
-                        # TODO: implement walking to the end stations. i need to approach this with a fresher mind, but what i think
-                        # is possible is instead of comparing arrival time, we will compare arrival time + walking time to the end station.
-                        
-                        # 
-                        # V2 - in visited stations, i will save entire connections for this trip, to avoid needing traversing the trip again.
-                        # V2 - also calculate walking distance from the end station.
-                        visited_stations[following_c.arrival_stop] = RVisidetStation(curr_arrival_time, trip_connections[:conn_idx+1], curr_arrival_time + stations_to_end[following_c.arrival_stop])
-                        next_round_new_stations[following_c.arrival_stop] = curr_arrival_time 
-                    
-                    if following_c.arrival_stop == end_station:
-                        # We found a route !
-                        # There is no point further persuing this trip...
-                        break
-        
-        # For new stations, find candidates for best walking
-        best_walking_time = -1
-        best_walking_station = None
-        # TODO: get several best stations instead of one - e.g. limit walking time...
+        round_start_arrival_time = target.best_arrival_time
+        # stations marked before the scan - the sources of round 0
         for station, st_arrival_time in next_round_new_stations.items():
-            # walking_arrival_time_to_end is relative - it's time of day in which we will arrive at the end if we leave at arrival_time to that station.
-            # stations_to_end[station] is the absolute time the walk takes
-            if  (best_walking_time == -1 or best_walking_time > visited_stations[station].walking_arrival_time_to_end) \
-                and stations_to_end[station] < limit_walking_time:
-
-                best_walking_time = visited_stations[station].walking_arrival_time_to_end 
-                best_walking_station = station
-       
+            target.improve(station, st_arrival_time)
+        scanner.scan(new_stations, visited_stations, next_round_new_stations, stations_to_end, MAX_TIME_THRESHOLD, target)
+
         round_res_routes = [] # results which where best this round.
-        if best_walking_station is not None:
-            round_res_routes.append(_traverse_station(best_walking_station, visited_stations, end_station, start_station))
-            current_target_arrival_time = best_walking_time
+        if target.best_arrival_time < round_start_arrival_time:
             # Add walking connection to the end station
+            round_res_routes.append(_traverse_station(target.station, visited_stations, end_station, start_station, start_time_int,
+                                                      source_trip_ids, target_trip_ids))
+        target.end_round()
         
         # for round_res_station in round_res_routes:
         #     res_route = _traverse_station(round_res_station, visited_stations, end_station, start_station)
@@ -307,25 +564,26 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
             # print("new stations - ", next_round_new_stations)
             # # Disply visited stations. 
             print(round_res_routes)
-            print(f"best walking time for round {r} - {time_int_to_text(current_target_arrival_time)}")
+            print(f"best walking time for round {r} - {time_int_to_text(target.arrival_time)}")
             print(f"len of visited stations - {len(visited_stations)}, len of new stations - {len(next_round_new_stations)}")
             display_visited_stations(tt, visited_stations, start_station=tt.stations[start_station], end_station=tt.stations[end_station])
             print("break")
-        # TODO: Relax footpaths from each new station to nearby stations, thus allowing transitions to other stations.
-        # This requires calculating shortcuts, which is heavy precomputation, so for now i'll skip it :)))
+        # Relax footpaths (or ULTRA transfer_shortcuts) from each new station to nearby stations, thus allowing transitions to other stations.
         # Note that it is ok to relax footpaths after getting this rounds result, because this won't affect the result. 
         if relax_footpaths:
             # Essentially for each new station
             tmp_new_stations = {}
+            transfers = tt.stations_footpaths if transfer_shortcuts is None else transfer_shortcuts
+            mid_walking_limit = limit_mid_walking_time if transfer_shortcuts is None else INITIAL_ARRIVAL_TIME
             for station in next_round_new_stations.keys():
-                if station not in tt.stations_footpaths:
+                if station not in transfers:
                     # if not is_car_route(station):
                     #     raise AssertionError(f"Station {station} has no footpaths, and is not a car route")
                     continue
-                for arrival_stop in tt.stations_footpaths[station]:
+                for arrival_stop in transfers[station]:
                     new_time = next_round_new_stations[station] + arrival_stop["time"]
-                    if  arrival_stop["time"] > limit_mid_walking_time or \
-                        new_time > current_target_arrival_time or \
+                    if  arrival_stop["time"] > mid_walking_limit or \
+                        new_time >= target.arrival_time or \
                         new_time > MAX_TIME_THRESHOLD:
                         # footpaths are sorted by time, so if this is too much no point looking at more.
                         break
@@ -333,13 +591,12 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
                     if arrival_stop["station_id"] not in visited_stations or \
                         new_time < visited_stations[arrival_stop["station_id"]].arrival_time:
                         # It is possible to improve the arrival time with walking.
-                        # Insert a new Walking connection here. 
-                        trip_id = FOOTPATH_ID + "_" + station + "_" + arrival_stop["station_id"]
-                        tt.trips[trip_id] = tt.trips[FOOTPATH_ID]  
-                        c = Connection(station, arrival_stop["station_id"], time_int_to_text(next_round_new_stations[station]),
-                            time_int_to_text(new_time), trip_id)  
+                        # Insert a new Walking connection here, on the feed's footpath trip - nothing is added to tt.trips.
+                        c = Connection(station, arrival_stop["station_id"], next_round_new_stations[station],
+                            new_time, FOOTPATH_ID)
                         visited_stations[arrival_stop["station_id"]] = RVisidetStation(new_time, [c], new_time + stations_to_end[arrival_stop["station_id"]])
                         tmp_new_stations[arrival_stop["station_id"]] = new_time
+                        counters.walked_labels += 1
             next_round_new_stations.update(tmp_new_stations)
 
             if debug:
@@ -349,6 +606,10 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
 
         new_stations = next_round_new_stations
         next_round_new_stations = {}
+        if target_pruning and len(new_stations) == 0:
+            # Nothing is marked, so no later round can get anywhere - they have no results
+            total_result_routes.extend([] for _ in range(r + 1, MAX_ROUNDS))
+            break
 
     # # Now we need to trace back the route
     # if end_station not in visited_stations.keys():
@@ -370,26 +631,161 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
 # target_stop = 29462? 14003?
 # base_stop = 44420
 # base_stop = 44420
-def run_ultra_wrapper(start_loc, end_loc, start_time, tt, car_route=False, relax_footpaths=True, limit_walking_time=60*60, debug=False):
+
+# glilot base - {"stop_lat": 32.145549, "stop_lon": 34.819354}
+# my home - {"stop_lat": 32.111850, "stop_lon": 34.831520}
+# (start location, end location, start time) - the queries used to compare routing engines against each other
+BENCHMARK_ODS = [
+    ({"stop_lat": 32.145549, "stop_lon": 34.819354}, {"stop_lat": 32.111850, "stop_lon": 34.831520}, "10:00:00"),
+    ({"stop_lat": 32.145549, "stop_lon": 34.819354}, {"stop_lat": 32.111850, "stop_lon": 34.831520}, "10:20:00"),
+    ({"stop_lat": 32.145549, "stop_lon": 34.819354}, {"stop_lat": 32.111850, "stop_lon": 34.831520}, "10:30:00"),
+    ({"stop_lat": 32.111850, "stop_lon": 34.831520}, {"stop_lat": 32.145549, "stop_lon": 34.819354}, "18:00:00"),
+]
+
+def result_route_key(result_route):
+    # Comparable form of a raptor result route - [(station, [(departure_stop, arrival_stop, departure_time, arrival_time, trip_id)])]
+    # Walking station ids and walk / car trip ids are numbered per query, so they are replaced with their name
+    def station_key(station_id):
+        return station_id.split("_")[0] if station_id.startswith("Start_") or station_id.startswith("End_") else station_id
+    def trip_key(trip_id):
+        if is_car_route(trip_id):
+            return CAR_ROUTE_ID
+        return FOOTPATH_ID if is_footpath(trip_id) else trip_id
+    return [(station_key(station), [(station_key(c.departure_stop), station_key(c.arrival_stop), c.departure_time, c.arrival_time, trip_key(c.trip_id))
+                                    for c in connections]) for station, connections in result_route]
+
+def run_ultra_wrapper(start_loc, end_loc, start_time, tt, car_route=False, relax_footpaths=True, limit_walking_time=60*60, debug=False, service_date=None, scanner=None,
+                      walking_engine=None, transfer_shortcuts=None, walking_radius=DEFAULT_WALKING_RADIUS, car_sources=None, engine=None):
+    """
+    @service_date - datetime.date or "YYYYMMDD" text. If given, route only with trips which run on that day.
+        If None all trips of the feed are used, no matter on which day they run.
+    @scanner - trips scan of raptor_route (TripScanner / pattern_raptor_routing.PatternScanner), None for TripScanner
+    @walking_engine - access / egress walking matrices (see RaptorRouter), None for valhalla
+    @transfer_shortcuts - see raptor_route
+    @walking_radius - see RaptorRouter.semi_ultra_route
+    @car_sources - see RaptorRouter.semi_ultra_route
+    @engine - see RaptorRouter.semi_ultra_route
+    """
+    if service_date is not None:
+        tt = tt.for_service_date(service_date)
+    if not isinstance(tt, QueryTimetable):
+        # the query's stations / connections go to an overlay, tt itself is left as it was
+        tt = tt.for_query()
     final_results = []
-    rr = RaptorRouter(tt)  
-    result_routes = rr.semi_ultra_route(start_loc, end_loc, start_time, tt, car_route=car_route, relax_footpaths=relax_footpaths, limit_walking_time=limit_walking_time, debug=debug)
+    rr = RaptorRouter(tt, walking_engine=walking_engine)
+    result_routes = rr.semi_ultra_route(start_loc, end_loc, start_time, tt, car_route=car_route, relax_footpaths=relax_footpaths, limit_walking_time=limit_walking_time, debug=debug, scanner=scanner,
+                                      transfer_shortcuts=transfer_shortcuts, walking_radius=walking_radius, car_sources=car_sources, engine=engine)
     if result_routes is None:
         return None
     
-    last_res_connections = []
+    # compared by value - a mapped timetable may hand out new objects for the same connections once it dropped its cache
+    last_res_key = None
     for i, round_res in enumerate(result_routes):
         for res in round_res:
             if len(res) == 0:
                 continue
             raptor_res = RaptorResult_v2(res, tt)
-            res_connections = raptor_res.result_connections
-            if len(res_connections) == len(last_res_connections) and all([res_connections[i] == last_res_connections[i] for i in range(len(res_connections))]):
+            res_key = [(c.departure_stop, c.arrival_stop, c.departure_time, c.arrival_time, c.trip_id) for c in raptor_res.result_connections]
+            if res_key == last_res_key:
                 continue
             final_results.append(raptor_res)
-            last_res_connections = res_connections
+            last_res_key = res_key
     return final_results
 
+def test_raptor_sources(num_sources=300, seed=0):
+    """
+    A car like query which can start from num_sources stations - once as connections from a start station (like build_connections_for_car_route),
+    and once as raptor_route sources. Checks both find the same journeys and prints how long each took.
+    """
+    import random
+    rng = random.Random(seed)
+    tt = get_tlv_timetable()
+    start_loc, end_loc, start_time = BENCHMARK_ODS[0]
+    start_time = time_to_int(start_time)
+    end_lon_lat = {"lat": end_loc["stop_lat"], "lon": end_loc["stop_lon"]}
+    targets = {station_id: t for station_id, t, _ in RaptorRouter(tt)._get_egress(end_lon_lat, DEFAULT_WALKING_RADIUS)}
+    station_ids = rng.sample(list(tt.stations.keys()), min(num_sources, len(tt.stations)))
+    sources = dict(sorted(((station_id, start_time + rng.randint(60, 20 * 60)) for station_id in station_ids), key=lambda x: x[1]))
+
+    def route(with_sources):
+        qt = tt.for_query()
+        start_station = qt._create_walking_station({"lat": start_loc["stop_lat"], "lon": start_loc["stop_lon"]}, name="Start")["station_id"]
+        end_station = qt._create_walking_station(end_lon_lat, name="End")["station_id"]
+        if with_sources:
+            return raptor_route(start_station, end_station, start_time, qt, sources=sources, targets=targets,
+                                source_trip_ids=dict.fromkeys(sources, CAR_ROUTE_ID))
+        for i, (station_id, arrival_time) in enumerate(sources.items()):
+            trip_id = CAR_ROUTE_ID + "_" + str(i)
+            qt.trips[trip_id] = qt.trips[CAR_ROUTE_ID]
+            qt.station_connections[start_station].append(Connection(start_station, station_id, start_time, arrival_time, trip_id))
+        return raptor_route(start_station, end_station, start_time, qt, targets=targets)
+
+    # stations of a mapped timetable get their connections on first use, don't time that
+    route(True)
+    with Timer(text="[+] " + str(len(sources)) + " start connections took {:.4f} seconds...") as connections_timer:
+        connection_routes = route(False)
+    with Timer(text="[+] " + str(len(sources)) + " sources took {:.4f} seconds...") as sources_timer:
+        source_routes = route(True)
+    for r, (connection_round, source_round) in enumerate(zip(connection_routes, source_routes)):
+        if [result_route_key(route) for route in connection_round] != [result_route_key(route) for route in source_round]:
+            raise AssertionError(f"round {r} - sources found a different journey than start connections")
+    print_log(f"same journeys, sources are {connections_timer.last / max(sources_timer.last, 1e-9):.1f} times faster")
+
+def _improving_arrivals(result_routes):
+    # [(round, arrival to the end)] of the rounds which got to the end earlier than the rounds before them
+    arrivals = []
+    for r, round_res in enumerate(result_routes):
+        for res in round_res:
+            arrival_time = res[-1][1][-1].arrival_time
+            if len(arrivals) == 0 or arrival_time < arrivals[-1][1]:
+                arrivals.append((r, arrival_time))
+    return arrivals
+
+def test_target_pruning(num_queries=200, start_time="08:00:00", seed=0, scanner=None):
+    """
+    Random station to station queries with target pruning and with the older round bounds (target_pruning=False), prints the counters of both.
+    With PatternScanner both should get to the end at the same times for every number of trips. TripScanner follows a trip once per query,
+    so with pruning it can ride trips in later rounds which the older bounds used up, and get to the end earlier.
+    returns True if target pruning was never worse
+    """
+    import random
+    rng = random.Random(seed)
+    tt = get_tlv_timetable()
+    station_ids = [station_id for station_id in tt.stations if station_id in tt.station_connections]
+    never_worse = True
+    num_earlier = 0
+    pruned_time = bounded_time = 0
+    pruned_counters = RaptorCounters()
+    bounded_counters = RaptorCounters()
+    for _ in range(num_queries):
+        start_station, end_station = rng.sample(station_ids, 2)
+        # stations of a mapped timetable get their connections on first use, don't time that
+        raptor_route(start_station, end_station, start_time, tt, scanner=scanner, targets={end_station: 0})
+        query_start = time.perf_counter()
+        pruned_results = raptor_route(start_station, end_station, start_time, tt, scanner=scanner, targets={end_station: 0}, counters=pruned_counters)
+        pruned_time += time.perf_counter() - query_start
+        query_start = time.perf_counter()
+        bounded_results = raptor_route(start_station, end_station, start_time, tt, scanner=scanner, targets={end_station: 0}, counters=bounded_counters,
+                                       target_pruning=False)
+        bounded_time += time.perf_counter() - query_start
+        pruned_arrivals, bounded_arrivals = _improving_arrivals(pruned_results), _improving_arrivals(bounded_results)
+        if pruned_arrivals == bounded_arrivals:
+            continue
+        if all(any(pr <= br and pt <= bt for pr, pt in pruned_arrivals) for br, bt in bounded_arrivals):
+            num_earlier += 1
+        else:
+            never_worse = False
+            print(f"    [!] {start_station} -> {end_station} - {pruned_arrivals} / {bounded_arrivals}")
+
+    print_log(f"{num_queries} station queries - target pruning {pruned_time / num_queries * 1000:.2f} ms, "
+              f"round bounds {bounded_time / num_queries * 1000:.2f} ms per query, {num_earlier} got to the end earlier with pruning")
+    for name in RaptorCounters.__dataclass_fields__:
+        pruned, bounded = getattr(pruned_counters, name), getattr(bounded_counters, name)
+        print_log(f"    {name:<17} {pruned / num_queries:>10.1f} / {bounded / num_queries:>10.1f} per query")
+    if never_worse:
+        print_log("target pruning is never worse than the round bounds")
+    return never_worse
+
 def test_ultra_route():
     tt = get_tlv_timetable()
     print("[+] starting ultra test!")
@@ -425,16 +821,15 @@ def test_ultra_route_with_car(reparse=False, full_reparse=False):
     # Some random address in ramash
     end_car = {"lat": 32.14188, "lon": 34.84082}
 
-    with Timer(text="[+] Building connections for car route {:.4f} seconds..."):
+    with Timer(text="[+] Getting car route sources {:.4f} seconds..."):
         # Note - this takes 2.5-3.5 seconds for me for a 15 min trip with 5 min deviation, not so good.
         # Initial pruning with isochrones takes 0.7 seconds, then one-to-many takes 2 seconds.
         # Maybe i can prune more stations after i have initial raptor results - it might be so that some stations won't be optimal and can be dropped.
-        valid_stations = build_connections_for_car_route(tt, start_car, end_car, "10:05:00", deviation=60*2)
+        car_sources = get_car_route_sources(tt, start_car, end_car, "10:05:00", deviation=60*2)
 
     with Timer(text="[+] running semi ULTRA took {:.4f} seconds..."):
         result_routes = run_ultra_wrapper({"stop_lat": 32.145549, "stop_lon": 34.819354}, {"stop_lat": 32.111850, "stop_lon": 34.831520}, "10:00:00", 
-                                            tt, car_route=True, relax_footpaths=True, limit_walking_time=60*15, debug=False)
-
+                                            tt, car_sources=car_sources, relax_footpaths=True, limit_walking_time=60*15, debug=False)
     
     for r in result_routes:
         print(r)
@@ -1,4 +1,4 @@
-from utils import BinarySearchIdx, time_text_to_int, get_some_items, time_int_to_text, FOOTPATH_ID, is_footpath, bus_line_from_trip_id
+from utils import BinarySearchIdx, time_text_to_int, time_to_int, get_some_items, time_int_to_text, FOOTPATH_ID, is_footpath, bus_line_from_trip_id
 from connection_builder import Connection, Timetable, get_tlv_timetable
 from display import display_connections, display_visited_stations, display_RaptorResult
 import time
@@ -27,7 +27,7 @@ class RaptorResult_v2():
             self.result_connections += connections
         self.num_stops = len(self.result_connections) - 2 # remove 2 because of walking...?
         self.num_transfers = len(result_route)-2 # if no transfers, the result route is of length 2 (start station, end station)
-        self.trip_time = (time_text_to_int(self.arrival_time) - time_text_to_int(self.departure_time)) / 60
+        self.trip_time = (self.arrival_time - self.departure_time) / 60
         self.bus_lines = []
         for r in self.result_route:
             line = bus_line_from_trip_id(r[1][0].trip_id)
@@ -37,7 +37,7 @@ class RaptorResult_v2():
         display_RaptorResult(self)
 
     def __str__(self):
-        return f"RaptorResult: departure_time={self.departure_time}, arrival_time={self.arrival_time}, trip_time={self.trip_time}, num_stops={self.num_stops}, num_transfers={self.num_transfers}, bus_lines={self.bus_lines}"
+        return f"RaptorResult: departure_time={time_int_to_text(self.departure_time)}, arrival_time={time_int_to_text(self.arrival_time)}, trip_time={self.trip_time}, num_stops={self.num_stops}, num_transfers={self.num_transfers}, bus_lines={self.bus_lines}"
 
 class RaptorResult():
     def __init__(self, result_route, tt):
@@ -55,7 +55,7 @@ class RaptorResult():
         self.result_connections = self._get_result_connections()
         self.num_stops = len(self.result_connections) - 1
         self.num_transfers = len(result_route)-2 # if no transfers, the result route is of length 2 (start station, end station)
-        self.trip_time = (time_text_to_int(self.arrival_time) - time_text_to_int(self.departure_time)) / 60
+        self.trip_time = (self.arrival_time - self.departure_time) / 60
         self.bus_lines = []
         for r in self.result_route[1:]:
             line = tt.gtfs_instance.routes[tt.trips[r[1].trip_id]["route_id"]]["route_short_name"]
@@ -93,7 +93,7 @@ class RaptorResult():
         return connections
     
     def __str__(self):
-        return f"RaptorResult: departure_time={self.departure_time}, arrival_time={self.arrival_time}, trip_time={self.trip_time}, num_stops={self.num_stops}, num_transfers={self.num_transfers}, bus_lines={self.bus_lines}"
+        return f"RaptorResult: departure_time={time_int_to_text(self.departure_time)}, arrival_time={time_int_to_text(self.arrival_time)}, trip_time={self.trip_time}, num_stops={self.num_stops}, num_transfers={self.num_transfers}, bus_lines={self.bus_lines}"
 
     
 
@@ -168,6 +168,7 @@ class RaptorRouter(object):
         """
         # {"sources":[{"lat":40.744014,"lon":-73.990508}],"targets":[{"lat":40.744014,"lon":-73.990508},{"lat":40.739735,"lon":-73.979713},{"lat":40.752522,"lon":-73.985015},{"lat":40.750117,"lon":-73.983704},{"lat":40.750552,"lon":-73.993519}],"costing":"pedestrian"}
         # Get paths from start to all other stations
+        start_time = time_to_int(start_time)
         start_lon_lat = {"lat": start_location["stop_lat"], "lon": start_location["stop_lon"]}
         end_lon_lat = {"lat": end_location["stop_lat"], "lon": end_location["stop_lon"]}
         start_station = tt._create_walking_station(start_lon_lat, name="Start")
@@ -209,7 +210,7 @@ class RaptorRouter(object):
 
             # create a connection from start location to this station
             c = Connection(start_station["station_id"], target_station["station_id"], start_time,
-             time_int_to_text(time_text_to_int(start_time) + s_to_t["time"]), trip_id)
+             start_time + s_to_t["time"], trip_id)
             
             # TODO: there is an issue here, i can't just append this, i need to insert this at start_time!
             # Because the start station is one we just created, and this for loop is run on a sorted list by time,
@@ -257,8 +258,8 @@ def _traverse_station_v2(station_to_traverse : str, visited_stations : dict[str:
     # Now i need to iterate through visited_stations, and find the path to this station from the start station
     #end_arrival_time, prev_station, end_connection, prev_connection = visited_stations[end_station]
     result_route = []
-    final_walk_connection = Connection(station_to_traverse, end_station, time_int_to_text(visited_stations[station_to_traverse].arrival_time),
-             time_int_to_text(visited_stations[station_to_traverse].walking_arrival_time_to_end), FOOTPATH_ID)
+    final_walk_connection = Connection(station_to_traverse, end_station, visited_stations[station_to_traverse].arrival_time,
+             visited_stations[station_to_traverse].walking_arrival_time_to_end, FOOTPATH_ID)
     result_route.insert(0, (end_station, [final_walk_connection]))
     prev_station = station_to_traverse
     while prev_station != start_station:
@@ -315,13 +316,14 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
     visited_routes = {}
    
     # visited_stations is a dict of station_id -> (arrival_time, prev_station, connection, prev_connection) / RVisidetStation(arrival_time, leading_connections, walking_arrival_time_to_end)
-    visited_stations = {start_station : RVisidetStation(time_text_to_int(start_time), [], time_text_to_int(start_time) + stations_to_end[start_station])}
+    start_time = time_to_int(start_time)
+    visited_stations = {start_station : RVisidetStation(start_time, [], start_time + stations_to_end[start_station])}
 
-    new_stations = {start_station: time_text_to_int(start_time)}
+    new_stations = {start_station: start_time}
     next_round_new_stations = {}
     total_result_routes = []
     MAX_ROUNDS = 4
-    current_target_arrival_time = time_text_to_int("23:59:59") + 1000 # initiate to impossible time
+    current_target_arrival_time = time_text_to_int("47:59:59") + 1000 # initiate to impossible time
     for r in range(MAX_ROUNDS):
         if end_station in visited_stations:
             current_target_arrival_time = visited_stations[end_station].arrival_time
@@ -332,7 +334,7 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
             if station not in tt.station_connections:
                 # if station has no connections leaving from it.
                 continue
-            first_connection = BinarySearchIdx(tt.station_connections[station], st_arrival_time, key=lambda x: time_text_to_int(x.departure_time))
+            first_connection = BinarySearchIdx(tt.station_connections[station], st_arrival_time, key=lambda x: x.departure_time)
             connections =  tt.station_connections[station][first_connection:]
             # Iterate all connections from station which depart after our arrival time to it.
             for origin_c in connections:
@@ -348,7 +350,7 @@ def raptor_route(start_station, end_station, start_time, tt, end_footpath_connec
                 trip_connections = tt.follow_trip(origin_c)
 
                 for conn_idx, following_c in enumerate(trip_connections):
-                    curr_arrival_time = time_text_to_int(following_c.arrival_time) 
+                    curr_arrival_time = following_c.arrival_time
                     if curr_arrival_time >= current_target_arrival_time:
                         # We can't improve the arrival time to this station, so we can stop searching this trip
                         break
@@ -433,6 +435,7 @@ def raptor_route_from_station_no_walking(start_station, end_station, start_time,
     # 
     # The algorithm is described in the paper "Raptor: Routing with Transit Hubs and Intermediate Stops" by Peter Sanders and Dominik Schultes.
     # 
+    start_time = time_to_int(start_time)
     visited_stations = {start_station : (start_time, start_station, None, None)}
     # visited_stations is a dict of station_id -> (arrival_time, prev_station, connection, prev_connection)
     #
@@ -442,10 +445,10 @@ def raptor_route_from_station_no_walking(start_station, end_station, start_time,
     next_round_new_stations = {}
     result_routes = []
     MAX_ROUNDS = 4
-    current_target_arrival_time = time_text_to_int("23:59:59") + 1000
+    current_target_arrival_time = time_text_to_int("47:59:59") + 1000
     for r in range(MAX_ROUNDS):
         if end_station in visited_stations:
-            current_target_arrival_time = time_text_to_int(visited_stations[end_station][0])
+            current_target_arrival_time = visited_stations[end_station][0]
 
         for station, st_arrival_time in new_stations.items():
             # iterate cho nnections starting from the start_time
@@ -453,7 +456,7 @@ def raptor_route_from_station_no_walking(start_station, end_station, start_time,
             if station not in tt.station_connections:
                 # TODO: i don't think this should happen tbh
                 continue
-            first_connection = BinarySearchIdx(tt.station_connections[station], time_text_to_int(st_arrival_time), key=lambda x: time_text_to_int(x.departure_time))
+            first_connection = BinarySearchIdx(tt.station_connections[station], st_arrival_time, key=lambda x: x.departure_time)
             connections =  tt.station_connections[station][first_connection:]
             for origin_c in connections:
                 # Check if we already visited this route
@@ -468,11 +471,11 @@ def raptor_route_from_station_no_walking(start_station, end_station, start_time,
                     trip_connections = tt.follow_trip(origin_c)
 
                 for following_c in trip_connections:
-                    if time_text_to_int(following_c.arrival_time) >= current_target_arrival_time:
+                    if following_c.arrival_time >= current_target_arrival_time:
                         # We can't improve the arrival time to this station, so we can stop searching this trip
                         break
                     if (following_c.arrival_stop not in visited_stations or \
-                        time_text_to_int(following_c.arrival_time) < time_text_to_int(visited_stations[following_c.arrival_stop][0])):
+                        following_c.arrival_time < visited_stations[following_c.arrival_stop][0]):
                         # It is not enough to save station, because if a trip has circles we need to know.
                         # So if this is the best connection to bring us to the station, set the arrival stop of this station to this connection.
                         # TODO: implement walking to the end stations. i need to aproach this with a fresher mind, but what i think
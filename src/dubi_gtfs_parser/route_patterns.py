@@ -0,0 +1,124 @@
+from array import array
+import numpy as np
+
+# Route patterns - trips grouped by their exact stop sequence, the "routes" of the RAPTOR paper.
+# GTFS route_id is not good enough for this, a bus line has several variants (short turns, night versions), each its own pattern here.
+# A pattern keeps its trips as a trips x stops matrix of departure and arrival times, trips sorted earliest first.
+# RAPTOR scans a pattern once per round and only needs the earliest trip it can catch, which is a bisect on a stop's column.
+# That only works if trips don't overtake each other, so trips that do are split into another pattern with the same stops.
+
+NO_DEPARTURE = np.iinfo(np.int32).max # departure from the last stop of a trip
+NO_ARRIVAL = -1 # arrival to the first stop of a trip
+
+
+class RoutePattern(object):
+    """
+    @stops - list of station ids, a station can show up more than once (circular lines)
+    @trip_ids - list of trip ids, earliest first. No trip overtakes an earlier one, at any stop.
+    @departures - int32 [trips x stops] departure of trip t from stop i (NO_DEPARTURE at the last stop)
+    @arrivals - int32 [trips x stops] arrival of trip t to stop i (NO_ARRIVAL at the first stop)
+    """
+    def __init__(self, stops, trip_ids, departures, arrivals):
+        self.stops = stops
+        self.trip_ids = trip_ids
+        self.departures = departures
+        self.arrivals = arrivals
+        self._scan_arrays = None
+
+    def scan_arrays(self):
+        """
+        returns (departures_by_stop, arrivals_by_trip) - the matrices as int arrays per stop / per trip,
+        indexing numpy scalars one at a time in a python loop is much slower than array.array.
+        """
+        if self._scan_arrays is None:
+            departures_by_stop = [array("i", column.tobytes()) for column in np.ascontiguousarray(self.departures.T)]
+            arrivals_by_trip = [array("i", row.tobytes()) for row in self.arrivals]
+            self._scan_arrays = (departures_by_stop, arrivals_by_trip)
+        return self._scan_arrays
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+    def __repr__(self):
+        return f"RoutePattern({len(self.stops)} stops, {len(self.trip_ids)} trips, {self.stops[0]} -> {self.stops[-1]})"
+
+
+class RoutePatterns(object):
+    """
+    @patterns - list of RoutePattern
+    @station_patterns - station_id -> list of (pattern idx, stop position in the pattern)
+    @trip_patterns - trip_id -> (pattern idx, trip row in the pattern)
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.station_patterns = {}
+        self.trip_patterns = {}
+        for p, pattern in enumerate(patterns):
+            for i, station_id in enumerate(pattern.stops):
+                self.station_patterns.setdefault(station_id, []).append((p, i))
+            for t, trip_id in enumerate(pattern.trip_ids):
+                self.trip_patterns[trip_id] = (p, t)
+
+    def __getitem__(self, p):
+        return self.patterns[p]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def num_trips(self):
+        return len(self.trip_patterns)
+
+    def nbytes(self):
+        return sum(pattern.departures.nbytes + pattern.arrivals.nbytes for pattern in self.patterns)
+
+    def __repr__(self):
+        return f"RoutePatterns({len(self.patterns)} patterns, {len(self.trip_patterns)} trips)"
+
+
+def _dominates(first, second):
+    # first trip is never later than second trip
+    return all(a <= b for a, b in zip(first, second))
+
+def _split_overtaking_trips(trips):
+    """
+    @trips - list of (trip_id, departures, arrivals) with the same stops
+    returns a list of trip lists, in each no trip overtakes the trip before it
+    """
+    trips = sorted(trips, key=lambda t: (t[1][0], t[2][-1]))
+    groups = []
+    for trip in trips:
+        for group in groups:
+            last = group[-1]
+            if _dominates(last[1], trip[1]) and _dominates(last[2], trip[2]):
+                group.append(trip)
+                break
+        else:
+            groups.append([trip])
+    return groups
+
+
+def build_route_patterns(trip_connections, trip_ids=None):
+    """
+    @trip_connections - tt.trip_connections, trip_id -> list of the trip's connections
+    @trip_ids - the trips to group, None for all of them (a service day only passes the trips which run on it)
+    returns RoutePatterns
+    """
+    if trip_ids is None:
+        trip_ids = trip_connections.keys()
+    trips_by_stops = {}
+    for trip_id in trip_ids:
+        connections = trip_connections[trip_id]
+        if len(connections) == 0:
+            continue
+        stops = tuple([c.departure_stop for c in connections] + [connections[-1].arrival_stop])
+        departures = [c.departure_time for c in connections] + [NO_DEPARTURE]
+        arrivals = [NO_ARRIVAL] + [c.arrival_time for c in connections]
+        trips_by_stops.setdefault(stops, []).append((trip_id, departures, arrivals))
+
+    patterns = []
+    for stops, trips in trips_by_stops.items():
+        for group in _split_overtaking_trips(trips):
+            patterns.append(RoutePattern(list(stops), [t[0] for t in group],
+                                         np.array([t[1] for t in group], dtype=np.int32),
+                                         np.array([t[2] for t in group], dtype=np.int32)))
+    return RoutePatterns(patterns)
@@ -0,0 +1,234 @@
+import datetime
+from collections import OrderedDict
+from codetiming import Timer
+
+from utils import is_footpath, is_car_route, print_log
+from connection_builder import Timetable, SHARED_CACHES_LOCK
+from route_patterns import build_route_patterns
+
+# Per service day timetables.
+# The timetable holds every trip of the feed, no matter on which days it runs, so a tuesday query used to scan (and return)
+# friday and saturday trips too. A ServiceDayTimetable is a Timetable filtered to the trips which run on one service date,
+# according to calendar.txt (and calendar_dates.txt exceptions if the feed has them).
+# Slices are built lazily per station, and the recently used ones are kept in a ServiceDayCache.
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+DEFAULT_MAX_CACHED_DAYS = 7
+
+CALENDAR_DATE_ADDED = "1"
+CALENDAR_DATE_REMOVED = "2"
+
+
+def parse_service_date(service_date):
+    """
+    @service_date - datetime.date / datetime.datetime / "YYYYMMDD" text (GTFS format)
+    returns a datetime.date
+    """
+    if isinstance(service_date, datetime.datetime):
+        return service_date.date()
+    if isinstance(service_date, datetime.date):
+        return service_date
+    if type(service_date) == str:
+        return datetime.datetime.strptime(service_date, "%Y%m%d").date()
+    raise ValueError(f"bad service date {service_date}")
+
+
+def active_service_ids(calendar, calendar_dates, service_date):
+    """
+    @calendar - GTFS.calendar, service_id -> calendar row
+    @calendar_dates - GTFS.calendar_dates, service_id -> list of exception rows
+    @service_date - see parse_service_date
+    returns a set of service_ids which run on service_date
+    """
+    service_date = parse_service_date(service_date)
+    date_text = service_date.strftime("%Y%m%d")
+    weekday = WEEKDAYS[service_date.weekday()]
+    service_ids = set()
+    for service_id, service in calendar.items():
+        # GTFS dates are YYYYMMDD, so text comparison is date comparison
+        if service[weekday] == "1" and service["start_date"] <= date_text <= service["end_date"]:
+            service_ids.add(service_id)
+    for service_id, exceptions in calendar_dates.items():
+        for exception in exceptions:
+            if exception["date"] != date_text:
+                continue
+            if exception["exception_type"] == CALENDAR_DATE_ADDED:
+                service_ids.add(service_id)
+            elif exception["exception_type"] == CALENDAR_DATE_REMOVED:
+                service_ids.discard(service_id)
+    return service_ids
+
+
+class ServiceDayConnections(object):
+    """
+    Dict-like station_id -> connections of the base timetable, without connections of trips which don't run on the day.
+    Stations are filtered on first access and kept. Lists are sorted by departure time like the base ones.
+    """
+    def __init__(self, day_tt):
+        self.day_tt = day_tt
+        self.base_connections = day_tt.base.station_connections
+        self._filtered = {}
+
+    def __getitem__(self, station_id):
+        connections = self._filtered.get(station_id)
+        if connections is None:
+            with SHARED_CACHES_LOCK:
+                connections = self._filtered.get(station_id)
+                if connections is None:
+                    is_active = self.day_tt.is_trip_active
+                    connections = self._filtered[station_id] = [c for c in self.base_connections[station_id] if is_active(c.trip_id)]
+        return connections
+
+    def __setitem__(self, station_id, connections):
+        self._filtered[station_id] = connections
+
+    def get(self, station_id, default=None):
+        try:
+            return self[station_id]
+        except KeyError:
+            return default
+
+    def __contains__(self, station_id):
+        return station_id in self._filtered or station_id in self.base_connections
+
+    def keys(self):
+        for station_id in self.base_connections.keys():
+            yield station_id
+        for station_id in self._filtered.keys():
+            if station_id not in self.base_connections:
+                yield station_id
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return sum(1 for _ in self.keys())
+
+    def values(self):
+        for station_id in self.keys():
+            yield self[station_id]
+
+    def items(self):
+        for station_id in self.keys():
+            yield station_id, self[station_id]
+
+
+class ServiceDayTimetable(Timetable):
+    """
+    A Timetable with only the trips that run on service_date. Anything not related to the day (stations, trips, footpaths,
+    gtfs_instance...) is the base timetable's, so walking stations and trips added to a day land in the base - query a day through
+    its for_query() (run_ultra_wrapper does it).
+    Note - times are still from the start of this service day, trips of the day before which run past midnight are not included.
+    """
+    def __init__(self, tt, service_date):
+        """
+        @tt - the base timetable (Timetable or MappedTimetable)
+        @service_date - see parse_service_date
+        """
+        self.base = tt
+        self.service_date = parse_service_date(service_date)
+        gtfs = tt.gtfs_instance
+        self.service_ids = active_service_ids(gtfs.calendar, getattr(gtfs, "calendar_dates", {}), self.service_date)
+        self._active_trips = {}
+        self._route_patterns = None
+        self.station_connections = ServiceDayConnections(self)
+
+    def __getattr__(self, name):
+        # Everything which is not per day comes from the base timetable
+        if name.startswith("__") or "base" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.base, name)
+
+    def is_trip_active(self, trip_id):
+        active = self._active_trips.get(trip_id)
+        if active is None:
+            if is_footpath(trip_id) or is_car_route(trip_id) or trip_id not in self.base.trips:
+                # footpaths and car routes are created per query, they run every day
+                active = True
+            else:
+                active = self.base.trips[trip_id]["service_id"] in self.service_ids
+            self._active_trips[trip_id] = active
+        return active
+
+    def for_service_date(self, service_date):
+        return self.base.for_service_date(service_date)
+
+    def get_route_patterns(self):
+        # Only the trips of the day, so the patterns don't have other days' trips to skip
+        if self._route_patterns is None:
+            with SHARED_CACHES_LOCK:
+                if self._route_patterns is None:
+                    trip_ids = [trip_id for trip_id in self.base.trip_connections.keys() if self.is_trip_active(trip_id)]
+                    self._route_patterns = build_route_patterns(self.base.trip_connections, trip_ids)
+        return self._route_patterns
+
+    def get_dense_stations(self):
+        # stations are the base's, so are their ids
+        return self.base.get_dense_stations()
+
+    def _create_walking_station(self, station_lon_lat, name="Walking"):
+        # The walking station id counter is the base's, so stations of different days don't collide
+        new_station = self.base._create_walking_station(station_lon_lat, name)
+        self.station_connections[new_station["station_id"]] = self.base.station_connections[new_station["station_id"]]
+        return new_station
+
+    def __repr__(self):
+        return f"ServiceDayTimetable({self.service_date}, {len(self.service_ids)} services)"
+
+
+class ServiceDayCache(object):
+    """
+    LRU cache of ServiceDayTimetables of one base timetable, by date.
+    """
+    def __init__(self, tt, max_days=DEFAULT_MAX_CACHED_DAYS):
+        self.tt = tt
+        self.max_days = max_days
+        self._days = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, service_date):
+        service_date = parse_service_date(service_date)
+        day_tt = self._days.get(service_date)
+        if day_tt is not None:
+            self.hits += 1
+            self._days.move_to_end(service_date)
+            return day_tt
+        self.misses += 1
+        day_tt = self._days[service_date] = ServiceDayTimetable(self.tt, service_date)
+        if len(self._days) > self.max_days:
+            self._days.popitem(last=False)
+        return day_tt
+
+    def clear(self):
+        self._days.clear()
+
+    def __len__(self):
+        return len(self._days)
+
+    def __repr__(self):
+        return f"ServiceDayCache({len(self._days)}/{self.max_days} days, hits={self.hits}, misses={self.misses})"
+
+
+def count_connections(tt):
+    return sum(len(tt.station_connections[station_id]) for station_id in list(tt.station_connections.keys()))
+
+def test_service_day_timetable(service_date="20240102"):
+    from connection_builder import get_tlv_timetable
+    tt = get_tlv_timetable()
+    with Timer(text="[+] slicing timetable for " + str(service_date) + " took {:.4f} seconds..."):
+        day_tt = tt.for_service_date(service_date)
+        day_connections = count_connections(day_tt)
+    all_connections = count_connections(tt)
+    print_log(f"{day_tt} - {day_connections} connections out of {all_connections} ({day_connections / all_connections:.1%})")
+
+    with Timer(text="[+] second lookup of the same day took {:.6f} seconds..."):
+        tt.for_service_date(service_date)
+    print_log(tt._service_days)
+
+
+def main():
+    test_service_day_timetable()
+
+if __name__ == '__main__':
+    main()
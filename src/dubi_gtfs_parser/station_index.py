@@ -0,0 +1,478 @@
+import hashlib
+import math
+from array import array
+from itertools import islice
+import numpy as np
+
+from gtfs_tables import IdInterner, MISSING_VALUE
+
+# Spatial index of stations - a uniform grid over lat/lon.
+# Stations are sorted by grid cell, cell = lat row * number of lon columns + lon column, so a row of cells is a contiguous range
+# of the sorted array and a radius query is one searchsorted per row, then a vectorized distance check of the candidates.
+# Distances are equirectangular (lon scaled by cos of the latitude), which is well under a meter off at 10 km.
+
+METERS_PER_DEGREE = 111320.0 # same as utils.degrees_to_meters
+DEFAULT_CELL_SIZE = 250 # meters
+
+
+def _location_lat_lon(location):
+    """
+    @location - a station, or any dict with stop_lat / stop_lon (text or float), or with lat / lon (valhalla locations)
+    """
+    if "stop_lat" in location:
+        return float(location["stop_lat"]), float(location["stop_lon"])
+    return float(location["lat"]), float(location["lon"])
+
+
+class SearchableStations(object):
+    """
+    Grid index of stations for radius, k nearest and batch queries.
+    Query results are station dicts (the same objects which were given), nearest first.
+    """
+    def __init__(self, stations, cell_size=DEFAULT_CELL_SIZE):
+        """
+        @stations - iterable of stations (dicts with stop_lat / stop_lon)
+        @cell_size - grid cell size in meters
+        """
+        stations = list(stations)
+        self._build(stations, [float(s["stop_lat"]) for s in stations], [float(s["stop_lon"]) for s in stations], cell_size)
+
+    @classmethod
+    def from_coordinates(cls, lat, lon, items=None, cell_size=DEFAULT_CELL_SIZE):
+        """
+        Index of points which are not station dicts (e.g. graph nodes), queries return their items.
+        @lat, @lon - arrays of degrees
+        @items - what queries return for each point, None for the point's index
+        """
+        index = cls.__new__(cls)
+        index._build(list(range(len(lat))) if items is None else list(items), lat, lon, cell_size)
+        return index
+
+    def _build(self, stations, lat, lon, cell_size):
+        self.cell_size = cell_size
+        self.stations = stations
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        if len(stations) == 0:
+            self.lat0, self.lon0, self.max_abs_lat = 0.0, 0.0, 0.0
+        else:
+            self.lat0, self.lon0 = float(self.lat.min()), float(self.lon.min())
+            self.max_abs_lat = float(np.abs(self.lat).max())
+        # Cells are cell_size meters at the station furthest from the equator, so they are never narrower than cell_size.
+        self.cell_dlat = cell_size / METERS_PER_DEGREE
+        self.cell_dlon = cell_size / (METERS_PER_DEGREE * math.cos(math.radians(self.max_abs_lat)))
+        rows = self._rows(self.lat)
+        cols = self._cols(self.lon)
+        self.num_cols = int(cols.max()) + 1 if len(stations) > 0 else 1
+        cells = rows * self.num_cols + cols
+        self.order = np.argsort(cells, kind="stable")
+        self.cells = cells[self.order]
+        self.sorted_lat = self.lat[self.order]
+        self.sorted_lon = self.lon[self.order]
+        # stations by sorted position, so results are built by one fancy index instead of a python loop
+        self.sorted_stations = np.empty(len(stations), dtype=object)
+        self.sorted_stations[:] = [stations[i] for i in self.order.tolist()]
+
+    # True for an index unpickled from the old bucket index, which doesn't have all the stations
+    incomplete = False
+
+    def __setstate__(self, state):
+        # Old bucket index pickles (BucketSearchableStations) have BUCKET_SIZE - new ones have sorted_stations too, so don't look at that.
+        if "BUCKET_SIZE" in state:
+            # The first item of each bucket is the bucket's lon, and the bucket index dropped the first station of every bucket
+            # but the first one. Index what it has, the timetable it was pickled with indexes all of its stations again
+            # (Timetable.__setstate__).
+            self.__init__([s for bucket in state["sorted_stations"] for s in bucket[1:]])
+            self.incomplete = True
+        else:
+            self.__dict__.update(state)
+
+    def _rows(self, lat):
+        return np.floor((lat - self.lat0) / self.cell_dlat).astype(np.int64)
+
+    def _cols(self, lon):
+        return np.floor((lon - self.lon0) / self.cell_dlon).astype(np.int64)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def _candidates(self, lat, lon, radius):
+        """
+        positions (in the cell sorted arrays) of stations in the cells which a radius around (lat, lon) touches
+        """
+        if len(self.stations) == 0:
+            return np.zeros(0, dtype=np.int64)
+        dlat = radius / METERS_PER_DEGREE
+        dlon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + dlat, 90))), 1e-6))
+        first_row = max(math.floor((lat - dlat - self.lat0) / self.cell_dlat), 0)
+        last_row = math.floor((lat + dlat - self.lat0) / self.cell_dlat)
+        first_col = max(math.floor((lon - dlon - self.lon0) / self.cell_dlon), 0)
+        last_col = min(math.floor((lon + dlon - self.lon0) / self.cell_dlon), self.num_cols - 1)
+        if first_col > last_col or first_row > last_row:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.arange(first_row, last_row + 1, dtype=np.int64) * self.num_cols
+        starts = np.searchsorted(self.cells, rows + first_col, side="left")
+        lengths = np.searchsorted(self.cells, rows + last_col, side="right") - starts
+        # concatenate the ranges [start, start + length) without a python loop
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int64)
+        range_offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - range_offsets, lengths) + np.arange(total)
+
+    def _distances(self, lat, lon, positions):
+        # meters from (lat, lon) to the stations at positions
+        station_lat = self.sorted_lat[positions]
+        dy = (station_lat - lat) * METERS_PER_DEGREE
+        dx = (self.sorted_lon[positions] - lon) * METERS_PER_DEGREE * np.cos(np.radians((station_lat + lat) / 2))
+        return np.sqrt(dx * dx + dy * dy)
+
+    def _query_radius(self, lat, lon, radius):
+        positions = self._candidates(lat, lon, radius)
+        distances = self._distances(lat, lon, positions)
+        inside = distances <= radius
+        positions, distances = positions[inside], distances[inside]
+        by_distance = np.argsort(distances, kind="stable")
+        return positions[by_distance], distances[by_distance]
+
+    def query_radius(self, location, radius=1000):
+        """
+        @location - see _location_lat_lon
+        @radius - meters
+        returns (station indices in self.stations, distances in meters), nearest first
+        """
+        lat, lon = _location_lat_lon(location)
+        positions, distances = self._query_radius(lat, lon, radius)
+        return self.order[positions], distances
+
+    def search_nearby_stations(self, station, radius=1000):
+        """
+        @station - a station object (or any location, see _location_lat_lon)
+        @radius - the radius in meters to search for stations
+        returns a list of stations within radius, nearest first
+        """
+        lat, lon = _location_lat_lon(station)
+        positions, _ = self._query_radius(lat, lon, radius)
+        return self.sorted_stations[positions].tolist()
+
+    def nearest_stations(self, station, k=1, max_radius=None):
+        """
+        @k - number of stations
+        @max_radius - meters, don't look further than this (None - no limit)
+        returns a list of (station, distance in meters) of the k nearest stations, nearest first
+        """
+        if len(self.stations) == 0 or k <= 0:
+            return []
+        lat, lon = _location_lat_lon(station)
+        # Grow the radius until it has k stations in it - the k nearest are then inside it too.
+        # Once it covers the furthest corner of the grid every station is in it.
+        corners_lat = np.array([self.lat0, self.lat0, float(self.lat.max()), float(self.lat.max())])
+        corners_lon = np.array([self.lon0, float(self.lon.max()), self.lon0, float(self.lon.max())])
+        dy = (corners_lat - lat) * METERS_PER_DEGREE
+        dx = (corners_lon - lon) * METERS_PER_DEGREE # without cos - an upper bound
+        furthest_corner = float(np.sqrt(dx * dx + dy * dy).max()) + self.cell_size
+        radius = self.cell_size
+        while True:
+            if max_radius is not None:
+                radius = min(radius, max_radius)
+            positions, distances = self._query_radius(lat, lon, radius)
+            if len(positions) >= k or radius >= furthest_corner or radius == max_radius:
+                break
+            radius *= 2
+        return list(zip(self.sorted_stations[positions[:k]].tolist(), distances[:k].tolist()))
+
+    def search_nearby_stations_batch(self, locations, radius=1000):
+        """
+        Radius query for many locations at once. Locations in the same grid cell share one candidates lookup and one
+        vectorized distance matrix.
+        @locations - list of locations (see _location_lat_lon)
+        returns a list of station lists (nearest first), one per location
+        """
+        results = [None] * len(locations)
+        if len(locations) == 0:
+            return results
+        lat_lon = np.array([_location_lat_lon(location) for location in locations], dtype=np.float64)
+        # Group by blocks of about radius x radius - a group's candidates are the radius around the block.
+        # Locations can be outside the grid, so don't use self.cells numbering.
+        block_size = max(radius, self.cell_size)
+        block_dlat = block_size / METERS_PER_DEGREE
+        block_dlon = block_size / (METERS_PER_DEGREE * math.cos(math.radians(self.max_abs_lat)))
+        query_blocks = np.floor((lat_lon[:, 0] - self.lat0) / block_dlat).astype(np.int64) * (1 << 32) + \
+            np.floor((lat_lon[:, 1] - self.lon0) / block_dlon).astype(np.int64)
+        query_order = np.argsort(query_blocks, kind="stable")
+        sorted_blocks = query_blocks[query_order]
+        group_starts = np.flatnonzero(np.diff(sorted_blocks, prepend=sorted_blocks[0] - 1))
+        group_ends = np.append(group_starts[1:], len(query_order))
+        for group_start, group_end in zip(group_starts.tolist(), group_ends.tolist()):
+            queries = query_order[group_start:group_end]
+            if len(queries) == 1:
+                query = int(queries[0])
+                positions, _ = self._query_radius(lat_lon[query, 0], lat_lon[query, 1], radius)
+                results[query] = self.sorted_stations[positions].tolist()
+                continue
+            group_lat = lat_lon[queries, 0]
+            group_lon = lat_lon[queries, 1]
+            # candidates around the middle of the group, the radius grown by the group's spread
+            center_lat, center_lon = float(group_lat.mean()), float(group_lon.mean())
+            spread = float(np.max(np.hypot((group_lat - center_lat) * METERS_PER_DEGREE, (group_lon - center_lon) * METERS_PER_DEGREE)))
+            positions = self._candidates(center_lat, center_lon, radius + spread + 1)
+            station_lat = self.sorted_lat[positions][None, :]
+            dy = (station_lat - group_lat[:, None]) * METERS_PER_DEGREE
+            dx = (self.sorted_lon[positions][None, :] - group_lon[:, None]) * METERS_PER_DEGREE * np.cos(np.radians((station_lat + group_lat[:, None]) / 2))
+            distances = np.sqrt(dx * dx + dy * dy)
+            for row, query in enumerate(queries.tolist()):
+                inside = np.flatnonzero(distances[row] <= radius)
+                inside = inside[np.argsort(distances[row][inside], kind="stable")]
+                results[query] = self.sorted_stations[positions[inside]].tolist()
+        return results
+
+    def fingerprint(self):
+        """
+        Hash of the indexed stations and their locations, kept with results computed for them (walking caches)
+        """
+        if getattr(self, "_fingerprint", None) is None:
+            h = hashlib.sha1()
+            h.update(self.sorted_lat.tobytes())
+            h.update(self.sorted_lon.tobytes())
+            for s in self.sorted_stations:
+                h.update(str(s["station_id"] if isinstance(s, dict) else s).encode())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def __repr__(self):
+        return f"SearchableStations({len(self.stations)} stations, {self.cell_size}m cells)"
+
+
+class StationsDict(dict):
+    """
+    station_id -> station dict of a timetable, which counts its changes.
+    version goes up with every change, removals only when a station is removed or replaced (dense ids built before can't stay).
+    """
+    # class defaults - unpickling sets the items before the instance's attributes
+    version = 0
+    removals = 0
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.removals += 1
+        self.version += 1
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.removals += 1
+        self.version += 1
+
+    def pop(self, key, *default):
+        if key in self:
+            self.removals += 1
+            self.version += 1
+        return super().pop(key, *default)
+
+    def popitem(self):
+        item = super().popitem()
+        self.removals += 1
+        self.version += 1
+        return item
+
+    def clear(self):
+        super().clear()
+        self.removals += 1
+        self.version += 1
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class DenseStations(object):
+    """
+    Stable dense int ids of a timetable's stations (tt.get_dense_stations()), in the order they were added to tt.stations.
+    An id never changes, so arrays by dense id (vector patterns, connection arrays, matrix rows) stay valid. New stations are
+    picked up by sync() - a check of the StationsDict version when nothing changed. A removed station keeps its id as a
+    tombstone - index() doesn't find it, and it gets the same id back if it is added again. A replaced station keeps its id
+    with the new coordinates. With a plain dict sync() can only compare the number of stations.
+    Coordinates and valhalla locations are cached per version, version goes up whenever ids or coordinates change.
+    """
+    def __init__(self, stations):
+        """
+        @stations - the timetable's station_id -> station dict (kept, not copied)
+        """
+        self._stations = stations
+        self.ids = IdInterner()
+        # dense ids of removed stations
+        self.removed = set()
+        self.version = 0
+        # stations.version / removals when the ids were last synced
+        self._stations_version = None
+        self._stations_removals = getattr(stations, "removals", None)
+        self._lat = array("d")
+        self._lon = array("d")
+        self._locations = []
+        self._coordinates = None
+        self.sync()
+
+    def sync(self):
+        stations_version = getattr(self._stations, "version", None)
+        if stations_version is not None and stations_version == self._stations_version:
+            return self
+        stations_removals = getattr(self._stations, "removals", None)
+        new_count = len(self._stations) - (len(self.ids) - len(self.removed))
+        if new_count < 0 or stations_removals != self._stations_removals:
+            # stations were removed or replaced - look at all of them, ids stay as they are
+            self._stations_removals = stations_removals
+            changed = self._sync_all()
+        elif new_count == 0:
+            changed = False
+        elif len(self.ids) == 0:
+            changed = self._add(list(self._stations.keys()))
+        else:
+            # only the added stations - they are at the end of the dict
+            changed = self._add(list(islice(reversed(self._stations.keys()), new_count))[::-1])
+        self._stations_version = stations_version
+        if changed:
+            self.version += 1
+            self._coordinates = None
+        return self
+
+    def _add(self, station_ids):
+        # new stations, or ones which were removed and are back - they get their id again
+        for station_id in station_ids:
+            station = self._stations[station_id]
+            idx = self.ids.get(station_id)
+            if idx == MISSING_VALUE:
+                self.ids.intern(station_id)
+                self._lat.append(float(station["stop_lat"]))
+                self._lon.append(float(station["stop_lon"]))
+                self._locations.append({"lat": station["stop_lat"], "lon": station["stop_lon"]})
+            else:
+                self.removed.discard(idx)
+                self._set_location(idx, station)
+        return len(station_ids) > 0
+
+    def _set_location(self, idx, station):
+        self._lat[idx] = float(station["stop_lat"])
+        self._lon[idx] = float(station["stop_lon"])
+        self._locations[idx] = {"lat": station["stop_lat"], "lon": station["stop_lon"]}
+
+    def _sync_all(self):
+        # tombstones for removed stations, new coordinates for replaced ones, ids for added ones
+        for idx, station_id in enumerate(self.ids.ids):
+            station = self._stations.get(station_id)
+            if station is None:
+                self.removed.add(idx)
+            elif idx not in self.removed:
+                self._set_location(idx, station)
+        self._add([station_id for station_id in self._stations.keys()
+                   if station_id not in self.ids or self.ids.get(station_id) in self.removed])
+        return True
+
+    def __len__(self):
+        # ids given out, removed stations included - arrays by dense id are this long
+        return len(self.ids)
+
+    def index(self, station_id):
+        """
+        returns the dense id of station_id, MISSING_VALUE if it isn't a station (or was removed)
+        """
+        self.sync()
+        idx = self.ids.get(station_id)
+        return MISSING_VALUE if idx in self.removed else idx
+
+    def station_id(self, idx):
+        return self.ids[idx]
+
+    def station(self, idx):
+        return self._stations[self.ids[idx]]
+
+    def locations(self):
+        """
+        returns the list of {"lat", "lon"} of all stations by dense id, for matrix queries. Don't change it.
+        """
+        self.sync()
+        return self._locations
+
+    def coordinates(self):
+        """
+        returns (lat, lon) float64 arrays by dense id
+        """
+        self.sync()
+        if self._coordinates is None:
+            self._coordinates = (np.frombuffer(self._lat, dtype=np.float64).copy(), np.frombuffer(self._lon, dtype=np.float64).copy())
+        return self._coordinates
+
+    def __repr__(self):
+        return f"DenseStations({len(self.ids)} stations, version {self.version})"
+
+
+############################################################
+### TEST STATION INDEX #####################################
+############################################################
+
+def _brute_force_radius(index, location, radius):
+    lat, lon = _location_lat_lon(location)
+    distances = index._distances(lat, lon, np.arange(len(index.stations)))
+    return set(index.order[np.flatnonzero(distances <= radius)].tolist())
+
+def random_stations(num_stations, num_cities=20, seed=0):
+    # Stations around random city centers in israel, plus some spread all over - about the size of the nationwide feed for 30000
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform([31.0, 34.6], [32.9, 35.2], (num_cities, 2))
+    in_cities = int(num_stations * 0.85)
+    points = np.concatenate([centers[rng.integers(0, num_cities, in_cities)] + rng.normal(0, 0.03, (in_cities, 2)),
+                             rng.uniform([29.5, 34.2], [33.3, 35.9], (num_stations - in_cities, 2))])
+    return [{"station_id": str(i), "stop_lat": str(lat), "stop_lon": str(lon)} for i, (lat, lon) in enumerate(points.tolist())]
+
+def test_station_index_benchmark(radii=(200, 1000, 10000), num_queries=None, num_random_stations=None):
+    """
+    Bucket index (BucketSearchableStations) vs the grid index, one query at a time and batched,
+    querying around stations. Also counts stations each index misses / adds compared to a brute force search.
+    @num_queries - query around the first num_queries stations, None for all of them
+    @num_random_stations - use random_stations instead of the tlv timetable's stations
+    """
+    from codetiming import Timer
+    from connection_builder import get_tlv_timetable, BucketSearchableStations
+    if num_random_stations is None:
+        stations = list(get_tlv_timetable().stations.values())
+    else:
+        stations = random_stations(num_random_stations)
+    queries = stations if num_queries is None else stations[::max(len(stations) // num_queries, 1)][:num_queries]
+    with Timer(text="[+] building bucket index took {:.4f} seconds..."):
+        bucket_index = BucketSearchableStations(stations)
+    with Timer(text="[+] building grid index took {:.4f} seconds..."):
+        grid_index = SearchableStations(stations)
+
+    for radius in radii:
+        print(f"[+] radius {radius}m, {len(queries)} queries")
+        with Timer(text="    bucket index took {:.4f} seconds..."):
+            bucket_results = [bucket_index.search_nearby_stations(station, radius) for station in queries]
+        with Timer(text="    grid index took {:.4f} seconds..."):
+            grid_results = [grid_index.search_nearby_stations(station, radius) for station in queries]
+        with Timer(text="    grid index batch took {:.4f} seconds..."):
+            batch_results = grid_index.search_nearby_stations_batch(queries, radius)
+
+        bucket_missed = bucket_extra = grid_wrong = 0
+        for station, bucket_result, grid_result, batch_result in zip(queries, bucket_results, grid_results, batch_results):
+            expected = set(grid_index.stations[i]["station_id"] for i in _brute_force_radius(grid_index, station, radius))
+            bucket_ids = set(s["station_id"] for s in bucket_result)
+            bucket_missed += len(expected - bucket_ids)
+            bucket_extra += len(bucket_ids - expected)
+            if set(s["station_id"] for s in grid_result) != expected or [s["station_id"] for s in batch_result] != [s["station_id"] for s in grid_result]:
+                grid_wrong += 1
+        print(f"    bucket index missed {bucket_missed} and added {bucket_extra} stations, grid index wrong on {grid_wrong} queries")
+
+    with Timer(text="[+] 5 nearest stations for " + str(len(queries)) + " queries took {:.4f} seconds..."):
+        nearest = [grid_index.nearest_stations(station, 5) for station in queries]
+    print(f"[+] average distance to the 5th nearest station - {np.mean([n[-1][1] for n in nearest if len(n) > 0]):.0f}m")
+
+
+def main():
+    test_station_index_benchmark()
+
+if __name__ == "__main__":
+    main()
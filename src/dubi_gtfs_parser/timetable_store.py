@@ -0,0 +1,505 @@
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+import numpy as np
+from codetiming import Timer
+
+from utils import ARTIFACTS_FOLDER, print_log, load_artifact
+from gtfs_tables import IdInterner, MISSING_VALUE
+from connection_builder import Connection, SharedInts, Timetable, SearchableStations, TLV_TIMETABLE_OBJ, SHARED_CACHES_LOCK
+from station_index import StationsDict
+
+# On-disk timetable made of flat arrays, instead of pickling the whole Timetable object graph.
+# A store is a folder with a manifest.json, a raw .bin file per array and a few small json tables (stations, trips, routes, calendar).
+# Arrays are opened with np.memmap, so loading only reads the manifest and the json tables, and the OS page cache
+# shares the array pages between processes (forked workers don't each pay for their own copy).
+#
+# Arrays (S = stations, T = trips with connections, C = connections):
+#   station_lat, station_lon                    - float64[S], in tt.stations order
+#   station_has_connections, station_has_footpaths - uint8[S], is the station a key of station_connections / stations_footpaths
+#   conn_departure_station, conn_arrival_station - int32[C], station idx
+#   conn_departure_time, conn_arrival_time       - int32[C], seconds from the start of the service day
+#   conn_trip                                    - int32[C], trip idx
+#   trip_offsets                                 - int64[T+1], connections of trip t are [trip_offsets[t], trip_offsets[t+1])
+#                                                  (connections are stored ordered by trip, so a trip is a contiguous range)
+#   station_conn_offsets, station_conn_index     - CSR of connections leaving each station, sorted by departure time
+#   footpath_offsets, footpath_station, footpath_time, footpath_distance - CSR of station footpaths, sorted by time
+
+TIMETABLE_STORE_VERSION = 2
+TIMETABLE_STORE_FORMAT = "tremp-timetable"
+MANIFEST_FILE = "manifest.json"
+TLV_TIMETABLE_STORE = os.path.join(ARTIFACTS_FOLDER, "tlv_timetable_store")
+# Connection objects are not in the shared pages - every process builds its own for the connections it touches (~90 bytes each),
+# so a long running worker which touches the whole feed ends up with a private copy of it. Past this many the cache is dropped and rebuilt.
+MAX_CACHED_CONNECTIONS = 1000000
+
+
+def _save_array(folder, name, arr):
+    arr = np.ascontiguousarray(arr)
+    file_name = name + ".bin"
+    arr.tofile(os.path.join(folder, file_name))
+    return {"file": file_name, "dtype": arr.dtype.str, "shape": list(arr.shape)}
+
+def _open_array(folder, desc):
+    shape = tuple(desc["shape"])
+    if 0 in shape:
+        # mmap of an empty file is not allowed
+        return np.zeros(shape, dtype=desc["dtype"])
+    return np.memmap(os.path.join(folder, desc["file"]), dtype=desc["dtype"], mode="r", shape=shape)
+
+def _save_json(folder, name, obj):
+    file_name = name + ".json"
+    with open(os.path.join(folder, file_name), "w") as f:
+        json.dump(obj, f)
+    return file_name
+
+def _load_json(folder, file_name):
+    with open(os.path.join(folder, file_name), "r") as f:
+        return json.load(f)
+
+def _footpath_number_array(values):
+    # Valhalla gives whole seconds for time, keep them as ints so loaded footpaths are exactly what was saved.
+    if all(type(v) == int for v in values):
+        return np.array(values, dtype=np.int32)
+    return np.array(values, dtype=np.float64)
+
+
+def save_timetable_store(tt, folder):
+    """
+    Write a timetable as a store folder (see top of file for the layout).
+    @tt - a Timetable (or a MappedTimetable)
+    @folder - the store folder, created if needed. An existing store in it is overwritten.
+    """
+    os.makedirs(folder, exist_ok=True)
+    # Remove the manifest first, so a half written store is never loaded.
+    if os.path.isfile(os.path.join(folder, MANIFEST_FILE)):
+        os.remove(os.path.join(folder, MANIFEST_FILE))
+
+    station_keys = list(tt.stations.keys())
+    station_ids = IdInterner(station_keys)
+    trip_keys = list(tt.trip_connections.keys())
+    trip_ids = IdInterner(trip_keys)
+
+    # Connections are saved once, by trip order. station_connections refer to the same Connection objects,
+    # so map them by identity. Connections which are not in any trip (e.g. walking connections of a saved query) go at the end.
+    connections = []
+    connection_index = {}
+    trip_offsets = [0]
+    for trip_id in trip_keys:
+        for c in tt.trip_connections[trip_id]:
+            connection_index[id(c)] = len(connections)
+            connections.append(c)
+        trip_offsets.append(len(connections))
+
+    station_has_connections = np.zeros(len(station_keys), dtype=np.uint8)
+    station_conn_offsets = [0]
+    station_conn_index = []
+    for i, station_id in enumerate(station_keys):
+        if station_id in tt.station_connections:
+            station_has_connections[i] = 1
+            for c in tt.station_connections[station_id]:
+                if id(c) not in connection_index:
+                    connection_index[id(c)] = len(connections)
+                    connections.append(c)
+                station_conn_index.append(connection_index[id(c)])
+        station_conn_offsets.append(len(station_conn_index))
+
+    def station_idx(station_id):
+        idx = station_ids.get(station_id)
+        if idx == MISSING_VALUE:
+            raise ValueError(f"connection references station {station_id} which is not in tt.stations")
+        return idx
+
+    station_has_footpaths = np.zeros(len(station_keys), dtype=np.uint8)
+    footpath_offsets = [0]
+    footpath_station = []
+    footpath_time = []
+    footpath_distance = []
+    for i, station_id in enumerate(station_keys):
+        if station_id in tt.stations_footpaths:
+            station_has_footpaths[i] = 1
+            for footpath in tt.stations_footpaths[station_id]:
+                footpath_station.append(station_idx(footpath["station_id"]))
+                footpath_time.append(footpath["time"])
+                footpath_distance.append(footpath["distance"])
+        footpath_offsets.append(len(footpath_station))
+
+    arrays = {
+        "station_lat": np.array([float(s["stop_lat"]) for s in tt.stations.values()], dtype=np.float64),
+        "station_lon": np.array([float(s["stop_lon"]) for s in tt.stations.values()], dtype=np.float64),
+        "station_has_connections": station_has_connections,
+        "station_has_footpaths": station_has_footpaths,
+        "conn_departure_station": np.array([station_idx(c.departure_stop) for c in connections], dtype=np.int32),
+        "conn_arrival_station": np.array([station_idx(c.arrival_stop) for c in connections], dtype=np.int32),
+        "conn_departure_time": np.array([c.departure_time for c in connections], dtype=np.int32),
+        "conn_arrival_time": np.array([c.arrival_time for c in connections], dtype=np.int32),
+        "conn_trip": np.array([trip_ids.intern(c.trip_id) for c in connections], dtype=np.int32),
+        "trip_offsets": np.array(trip_offsets, dtype=np.int64),
+        "station_conn_offsets": np.array(station_conn_offsets, dtype=np.int64),
+        "station_conn_index": np.array(station_conn_index, dtype=np.int32),
+        "footpath_offsets": np.array(footpath_offsets, dtype=np.int64),
+        "footpath_station": np.array(footpath_station, dtype=np.int32),
+        "footpath_time": _footpath_number_array(footpath_time),
+        "footpath_distance": np.array(footpath_distance, dtype=np.float64),
+    }
+
+    manifest = {
+        "format": TIMETABLE_STORE_FORMAT,
+        "version": TIMETABLE_STORE_VERSION,
+        "created": int(time.time()),
+        "num_stations": len(station_keys),
+        "num_trips": len(trip_keys),
+        "num_connections": len(connections),
+        "walking_station_id": tt._walking_station_id,
+        "arrays": {name: _save_array(folder, name, arr) for name, arr in arrays.items()},
+        "tables": {
+            # stations are saved as (key, station) pairs to keep the dict order, RAPTOR indexes stations by it.
+            "stations": _save_json(folder, "stations", list(tt.stations.items())),
+            "trips": _save_json(folder, "trips", tt.trips),
+            "routes": _save_json(folder, "routes", tt.gtfs_instance.routes),
+            "calendar": _save_json(folder, "calendar", tt.gtfs_instance.calendar),
+            "calendar_dates": _save_json(folder, "calendar_dates", getattr(tt.gtfs_instance, "calendar_dates", {})),
+            "trip_ids": _save_json(folder, "trip_ids", trip_ids.ids),
+        },
+    }
+    # Manifest goes last, it marks the store as complete.
+    with open(os.path.join(folder, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=1)
+    print_log(f"saved timetable store to {folder} - {len(station_keys)} stations, {len(trip_keys)} trips, {len(connections)} connections")
+
+
+def is_timetable_store(folder):
+    """
+    True if folder has a complete store of the current version.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return False
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    return manifest.get("format") == TIMETABLE_STORE_FORMAT and manifest.get("version") == TIMETABLE_STORE_VERSION
+
+
+class TimetableStore(object):
+    """
+    The arrays and tables of a store folder. Arrays are memory mapped and read only.
+    Connections are created on demand, and while they are cached every connection index gets a single Connection object,
+    so station_connections and trip_connections hand out the same objects.
+    The cache is private to the process, and is dropped once it has more than max_cached_connections (see MAX_CACHED_CONNECTIONS).
+    """
+    def __init__(self, folder, max_cached_connections=MAX_CACHED_CONNECTIONS):
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST_FILE), "r") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format") != TIMETABLE_STORE_FORMAT:
+            raise ValueError(f"{folder} is not a timetable store")
+        if self.manifest.get("version") != TIMETABLE_STORE_VERSION:
+            raise ValueError(f"timetable store {folder} is version {self.manifest.get('version')}, expected {TIMETABLE_STORE_VERSION}, rebuild it")
+
+        self.arrays = {name: _open_array(folder, desc) for name, desc in self.manifest["arrays"].items()}
+        tables = self.manifest["tables"]
+        self.stations = StationsDict(_load_json(folder, tables["stations"]))
+        self.trips = _load_json(folder, tables["trips"])
+        self.routes = _load_json(folder, tables["routes"])
+        self.calendar = _load_json(folder, tables["calendar"])
+        self.calendar_dates = _load_json(folder, tables["calendar_dates"])
+        self.station_ids = IdInterner(self.stations.keys())
+        self.trip_ids = IdInterner(_load_json(folder, tables["trip_ids"]))
+        self.max_cached_connections = max_cached_connections
+        self._connections = {}
+        # bumped whenever _connections is dropped, the views drop the lists they built from it
+        self.cache_generation = 0
+        self._times = SharedInts()
+
+    def __getattr__(self, name):
+        # store.conn_departure_time etc.
+        arrays = self.__dict__.get("arrays")
+        if arrays is not None and name in arrays:
+            return arrays[name]
+        raise AttributeError(name)
+
+    def connections(self, conn_idx):
+        """
+        @conn_idx - array of connection indices
+        returns a list of Connection objects
+        """
+        with SHARED_CACHES_LOCK:
+            return self._connections_locked(conn_idx.tolist())
+
+    def _connections_locked(self, conn_idx):
+        cache = self._connections
+        missing = [i for i in conn_idx if i not in cache]
+        if len(missing) > 0 and len(cache) + len(missing) > self.max_cached_connections:
+            # Lists handed out before keep their objects, follow_trip finds a connection in a rebuilt trip by its trip_index.
+            cache = self._connections = {}
+            self.cache_generation += 1
+            missing = conn_idx
+        if len(missing) > 0:
+            m = np.array(missing, dtype=np.int64)
+            station_ids = self.station_ids.ids
+            trip_ids = self.trip_ids.ids
+            # connections are saved by trip order, so the position in the trip is the offset from the trip's first connection.
+            # Connections after the last trip are not part of any trip.
+            trip_offsets = self.trip_offsets
+            times = self._times
+            num_trip_connections = int(trip_offsets[-1])
+            for i, dep, arr, dep_time, arr_time, trip in zip(missing,
+                    self.conn_departure_station[m].tolist(), self.conn_arrival_station[m].tolist(),
+                    self.conn_departure_time[m].tolist(), self.conn_arrival_time[m].tolist(), self.conn_trip[m].tolist()):
+                trip_index = i - int(trip_offsets[trip]) if i < num_trip_connections else None
+                cache[i] = Connection(station_ids[dep], station_ids[arr], times[dep_time], times[arr_time], trip_ids[trip], trip_index)
+        return [cache[i] for i in conn_idx]
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays.values())
+
+
+class StoreMappingView(ABC):
+    """
+    Dict-like view of per-station / per-trip lists in a store.
+    A value is built on first access and kept until the store drops its connections cache, so changes to it are not kept -
+    set the key instead. Set keys (e.g. walking stations of a query) live only in memory and are never dropped.
+    """
+    def __init__(self, store, ids, present):
+        self.store = store
+        self.ids = ids
+        self.present = present
+        self._materialized = {}
+        self._generation = store.cache_generation
+        self._assigned = {}
+
+    @abstractmethod
+    def _materialize(self, idx):
+        # the value of the store's key idx
+        pass
+
+    def _idx(self, key):
+        idx = self.ids.get(key)
+        if idx == MISSING_VALUE or idx >= len(self.present) or not self.present[idx]:
+            return MISSING_VALUE
+        return idx
+
+    def __getitem__(self, key):
+        value = self._assigned.get(key)
+        if value is not None:
+            return value
+        if self._generation == self.store.cache_generation:
+            value = self._materialized.get(key)
+            if value is not None:
+                return value
+        with SHARED_CACHES_LOCK:
+            if self._generation != self.store.cache_generation:
+                self._materialized = {}
+                self._generation = self.store.cache_generation
+            value = self._materialized.get(key)
+            if value is None:
+                idx = self._idx(key)
+                if idx == MISSING_VALUE:
+                    raise KeyError(key)
+                value = self._materialized[key] = self._materialize(idx)
+        return value
+
+    def __setitem__(self, key, value):
+        self._assigned[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._assigned or self._idx(key) != MISSING_VALUE
+
+    def keys(self):
+        for idx in np.flatnonzero(self.present).tolist():
+            yield self.ids[idx]
+        for key in self._assigned.keys():
+            if self._idx(key) == MISSING_VALUE:
+                yield key
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return sum(1 for _ in self.keys())
+
+    def values(self):
+        for key in self.keys():
+            yield self[key]
+
+    def items(self):
+        for key in self.keys():
+            yield key, self[key]
+
+
+class StationConnectionsView(StoreMappingView):
+    # station_id -> list of Connections leaving the station, sorted by departure time
+    def __init__(self, store):
+        super().__init__(store, store.station_ids, store.station_has_connections)
+
+    def _materialize(self, idx):
+        start, end = self.store.station_conn_offsets[idx], self.store.station_conn_offsets[idx + 1]
+        return self.store.connections(self.store.station_conn_index[start:end])
+
+
+class TripConnectionsView(StoreMappingView):
+    # trip_id -> list of the trip's Connections
+    def __init__(self, store):
+        super().__init__(store, store.trip_ids, np.ones(len(store.trip_offsets) - 1, dtype=np.uint8))
+
+    def _materialize(self, idx):
+        return self.store.connections(np.arange(self.store.trip_offsets[idx], self.store.trip_offsets[idx + 1]))
+
+
+class FootpathsView(StoreMappingView):
+    # station_id -> list of {"station_id", "distance", "time"} sorted by time
+    def __init__(self, store):
+        super().__init__(store, store.station_ids, store.station_has_footpaths)
+
+    def _materialize(self, idx):
+        start, end = self.store.footpath_offsets[idx], self.store.footpath_offsets[idx + 1]
+        station_ids = self.store.station_ids.ids
+        return [{"station_id": station_ids[st], "distance": distance, "time": t} for st, distance, t in
+                zip(self.store.footpath_station[start:end].tolist(), self.store.footpath_distance[start:end].tolist(),
+                    self.store.footpath_time[start:end].tolist())]
+
+
+class LazyGTFS(object):
+    """
+    Stands in for tt.gtfs_instance. routes (needed for every result's bus lines) and calendar (service day slicing)
+    are saved in the store, anything else (shapes matching for display) loads the full GTFS artifact on first use.
+    """
+    def __init__(self, routes, calendar, calendar_dates, gtfs_loader):
+        self.routes = routes
+        self.calendar = calendar
+        self.calendar_dates = calendar_dates
+        self._gtfs_loader = gtfs_loader
+        self._gtfs = None
+
+    def __getattr__(self, name):
+        if name.startswith("__") or "_gtfs_loader" not in self.__dict__:
+            raise AttributeError(name)
+        if self._gtfs is None:
+            if self._gtfs_loader is None:
+                raise AttributeError(f"{name} is not in the timetable store, and no gtfs loader was given")
+            print_log(f"loading full gtfs for {name}...")
+            self._gtfs = self._gtfs_loader()
+        return getattr(self._gtfs, name)
+
+
+class MappedTimetable(Timetable):
+    """
+    A Timetable backed by a TimetableStore. It has the same attributes as Timetable, but station_connections,
+    trip_connections and stations_footpaths are views over the memory mapped arrays.
+    """
+    def __init__(self, store, gtfs_loader=None):
+        """
+        @store - a TimetableStore
+        @gtfs_loader - function returning the GTFS object, used only for things that are not in the store (display)
+        """
+        self.store = store
+        self._walking_station_id = store.manifest["walking_station_id"]
+        self.stations = store.stations
+        self.trips = store.trips
+        self.gtfs_instance = LazyGTFS(store.routes, store.calendar, store.calendar_dates, gtfs_loader)
+        self.station_connections = StationConnectionsView(store)
+        self.trip_connections = TripConnectionsView(store)
+        self.stations_footpaths = FootpathsView(store)
+        self._searchable_stations = None
+
+    @property
+    def searchable_stations(self):
+        # Only build the buckets if someone searches
+        if self._searchable_stations is None:
+            with SHARED_CACHES_LOCK:
+                if self._searchable_stations is None:
+                    self._searchable_stations = SearchableStations(self.stations.values())
+        return self._searchable_stations
+
+    @searchable_stations.setter
+    def searchable_stations(self, value):
+        self._searchable_stations = value
+
+    @property
+    def shapes(self):
+        return self.gtfs_instance.shapes
+
+
+def load_timetable_store(folder, gtfs_loader=None, max_cached_connections=MAX_CACHED_CONNECTIONS):
+    return MappedTimetable(TimetableStore(folder, max_cached_connections), gtfs_loader)
+
+
+def convert_timetable_pickle(pickle_path, folder):
+    """
+    Convert a pickled Timetable (the old artifact) to a store.
+    """
+    print_log(f"converting {pickle_path} to a timetable store...")
+    tt = load_artifact(pickle_path)
+    save_timetable_store(tt, folder)
+    return tt
+
+
+def _materialize_all(tt):
+    # Touch every list, like a long running server would end up doing.
+    n = 0
+    for station_id in list(tt.station_connections.keys()):
+        n += len(tt.station_connections[station_id])
+    for station_id in list(tt.stations_footpaths.keys()):
+        n += len(tt.stations_footpaths[station_id])
+    return n
+
+def test_timetable_store_load(pickle_path=TLV_TIMETABLE_OBJ, folder=TLV_TIMETABLE_STORE):
+    """
+    Benchmark loading the timetable pickle against loading the store.
+    """
+    if not is_timetable_store(folder):
+        convert_timetable_pickle(pickle_path, folder)
+
+    with Timer(text="[+] loading timetable pickle took {:.4f} seconds..."):
+        tt = load_artifact(pickle_path)
+    with Timer(text="[+] loading timetable store took {:.4f} seconds..."):
+        mtt = load_timetable_store(folder)
+    print(f"[+] store arrays are {mtt.store.nbytes() / 1024 / 1024:.1f} MB on disk (memory mapped)")
+
+    # One station lookup, about what a query touches first
+    some_station = next(iter(tt.station_connections.keys()))
+    with Timer(text="[+] first station_connections lookup from store took {:.6f} seconds..."):
+        mtt.station_connections[some_station]
+    with Timer(text="[+] materializing all station connections and footpaths from store took {:.4f} seconds..."):
+        _materialize_all(mtt)
+
+    # Sanity - the store gives back the same timetable
+    for station_id, connections in tt.station_connections.items():
+        stored = mtt.station_connections[station_id]
+        if [(c.departure_stop, c.arrival_stop, c.departure_time, c.arrival_time, c.trip_id) for c in connections] != \
+            [(c.departure_stop, c.arrival_stop, c.departure_time, c.arrival_time, c.trip_id) for c in stored]:
+            raise AssertionError(f"station {station_id} connections differ between pickle and store")
+    for station_id, footpaths in tt.stations_footpaths.items():
+        if footpaths != mtt.stations_footpaths[station_id]:
+            raise AssertionError(f"station {station_id} footpaths differ between pickle and store")
+    print("[+] store matches pickle")
+
+def test_connection_cache_bound(folder=TLV_TIMETABLE_STORE, max_cached_connections=5000):
+    """
+    Follow every trip from every station of a store with a small connections cache, against one which keeps all of them.
+    """
+    mtt = load_timetable_store(folder)
+    bounded = load_timetable_store(folder, max_cached_connections=max_cached_connections)
+    def follow_all(tt):
+        return [[(c.arrival_stop, c.arrival_time) for c in tt.follow_trip(origin_c)]
+                for station_id in list(tt.station_connections.keys()) for origin_c in tt.station_connections[station_id]]
+    if follow_all(mtt) != follow_all(bounded):
+        raise AssertionError("a bounded connections cache followed trips differently")
+    print_log(f"same trips with at most {max_cached_connections} cached connections ({bounded.store.cache_generation} cache drops), "
+              f"{len(mtt.store._connections)} connections cached without a bound")
+
+
+def main():
+    # convert_timetable_pickle(TLV_TIMETABLE_OBJ, TLV_TIMETABLE_STORE)
+    test_timetable_store_load()
+    test_connection_cache_bound()
+
+if __name__ == '__main__':
+    main()
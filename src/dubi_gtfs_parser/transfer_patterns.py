@@ -0,0 +1,523 @@
+import json
+import os
+import random
+import shutil
+import time
+from bisect import bisect_left
+from multiprocessing import Pool
+
+from utils import ARTIFACTS_FOLDER, FOOTPATH_ID, time_to_int, time_text_to_int, print_log
+from parse_gtfs import TEL_AVIV_AREA
+from footpath_pipeline import _stations_fingerprint
+from connection_builder import Connection, TripView, get_tlv_timetable
+from profile_raptor import ProfileSearch
+from trip_based_routing import _trips_fingerprint
+from raptor_routing import raptor_route, run_ultra_wrapper, BENCHMARK_ODS, MAX_ROUNDS
+from pattern_raptor_routing import PatternScanner
+
+# Transfer Patterns (Bast et al., "Fast Routing in Very Large Public Transportation Networks using Transfer Patterns").
+# Select it with run_ultra_wrapper(..., engine=transfer_patterns_route).
+# A transfer pattern is the stations of a journey where we board and get off - (b1, a1, b2, a2, ..., bk, ak), ride b_i -> a_i,
+# then walk a_i -> b_i+1 (or stay, if they are the same station). Journeys worth taking between two stations at any time of day
+# use very few distinct patterns, so they are computed once:
+#   for every source station, a profile search (profile_raptor.ProfileSearch) over the whole day, and the pattern of every
+#   label a trip improves - the optimal journeys to every station, for every departure and number of trips.
+# A query only evaluates the patterns from its sources to its targets - the union of them is a DAG (patterns with the same prefix
+# share it), and every edge is a ride on a direct line (earliest trip of the patterns going b -> a) or a transfer walk.
+# Like raptor_route, nothing walks from a source before the first trip (access walking makes the sources), or after the last one.
+# These are full transfer patterns, every station is a source - fine for TEL_AVIV_AREA, nationwide needs hub stations.
+#
+# Transfer patterns store folder:
+#   manifest.json         - format, version, the parameters and fingerprints of the stations / trips. A run with other ones starts over.
+#   source_<idx>.json     - {target station_id: [[b1, a1, ..., bk, ak], ...]} of the source station with dense id idx.
+#                           Written to a temp file and renamed, so a source file is always complete - an interrupted run resumes.
+
+TRANSFER_PATTERNS_FORMAT = "tremp-transfer-patterns"
+TRANSFER_PATTERNS_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+TLV_TRANSFER_PATTERNS_STORE = os.path.join(ARTIFACTS_FOLDER, "tlv_transfer_patterns_store")
+
+DEFAULT_MAX_TRIPS = 4 # raptor_route's 4 rounds from a station
+DEFAULT_MAX_JOURNEY_TIME = 2 * 60 * 60 # seconds
+DEFAULT_LIMIT_MID_WALKING_TIME = 60 * 6 # seconds, like raptor_route's limit_mid_walking_time
+DAY_END = time_text_to_int("47:59:59")
+
+INFINITY = 2**40
+
+# precomputation state of this process - set by the pool initializer in workers, or by compute_transfer_patterns when running inline
+_patterns = None
+_transfers = None
+_folder = None
+_max_trips = DEFAULT_MAX_TRIPS
+_max_journey_time = DEFAULT_MAX_JOURNEY_TIME
+
+
+def _init_worker(patterns, transfers, folder, max_trips, max_journey_time):
+    global _patterns, _transfers, _folder, _max_trips, _max_journey_time
+    _patterns = patterns
+    _transfers = transfers
+    _folder = folder
+    _max_trips = max_trips
+    _max_journey_time = max_journey_time
+
+
+class TransferPatternSearch(ProfileSearch):
+    """
+    ProfileSearch from one station over the whole day, without an end - it collects the transfer pattern of every label a trip improves.
+    """
+    def __init__(self, patterns, source, transfers, max_trips=DEFAULT_MAX_TRIPS, max_journey_time=DEFAULT_MAX_JOURNEY_TIME):
+        """
+        @transfers - station_id -> list of (walking time, station_id) sorted by time, already cut by limit_mid_walking_time
+        """
+        self.tt = None
+        self.patterns = patterns
+        self.start_station = source
+        self.end_station = None
+        self.access = {source: 0}
+        self.targets = {}
+        self.transfers = transfers
+        self.max_trips = max_trips
+        self.max_journey_time = max_journey_time
+        self.labels = [{} for _ in range(max_trips + 1)]
+        self.parents = [{} for _ in range(max_trips + 1)]
+        self.target_best = [INFINITY] * (max_trips + 1)
+        # boarding at the source only - walking from the start makes sources of their own
+        self.offsets = {source: 0}
+        self.offset_parents = {source: None}
+
+    def _pattern(self, k, station):
+        # (b1, a1, ..., bk, ak) of the label of station with k trips
+        pattern = []
+        parent = self.parents[k][station]
+        while k > 0:
+            if parent[0] == "walk":
+                _, station, _, _, parent = parent
+            _, _, _, _, board_station = parent
+            pattern += [station, board_station]
+            station = board_station
+            k -= 1
+            parent = self.parents[k][station]
+        return tuple(reversed(pattern))
+
+    def run(self, window_start=0, window_end=DAY_END):
+        """
+        returns target station_id -> set of transfer patterns
+        """
+        transfer_patterns = {}
+        for departure_time, stations in self.departure_times(window_start, window_end):
+            max_arrival_time = departure_time + self.max_journey_time
+            marked = {}
+            for station in stations:
+                if departure_time < self.labels[0].get(station, INFINITY):
+                    self.labels[0][station] = departure_time
+                    self.parents[0][station] = ("start", departure_time)
+                    marked[station] = departure_time
+            for k in range(1, self.max_trips + 1):
+                if len(marked) == 0:
+                    break
+                improved = self._scan_patterns(k, marked, INFINITY, max_arrival_time)
+                marked = self._relax_transfers(k, improved, INFINITY, max_arrival_time)
+                for station, arrival_time in improved.items():
+                    # still the trip's label, not a walk from another station
+                    if self.labels[k][station] == arrival_time and self.parents[k][station][0] == "trip":
+                        transfer_patterns.setdefault(station, set()).add(self._pattern(k, station))
+        return transfer_patterns
+
+
+def _source_file(folder, source_idx):
+    return os.path.join(folder, f"source_{source_idx}.json")
+
+
+def run_source(task):
+    """
+    Transfer patterns of one source station, written to its file in the store (or returned without a store).
+    returns (source_idx, number of patterns, number of stations in them, seconds, patterns or None)
+    """
+    source_idx, source = task
+    start = time.perf_counter()
+    transfer_patterns = TransferPatternSearch(_patterns, source, _transfers, _max_trips, _max_journey_time).run()
+    transfer_patterns = {target: sorted(list(pattern) for pattern in target_patterns) for target, target_patterns in transfer_patterns.items()}
+    num_patterns = sum(len(target_patterns) for target_patterns in transfer_patterns.values())
+    num_stations = sum(len(pattern) for target_patterns in transfer_patterns.values() for pattern in target_patterns)
+    if _folder is not None:
+        path = _source_file(_folder, source_idx)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(transfer_patterns, f)
+        os.replace(tmp_path, path)
+        transfer_patterns = None
+    return source_idx, num_patterns, num_stations, time.perf_counter() - start, transfer_patterns
+
+
+def _in_area(station, area):
+    min_lon, max_lon, min_lat, max_lat = area
+    return min_lon <= float(station["stop_lon"]) <= max_lon and min_lat <= float(station["stop_lat"]) <= max_lat
+
+
+def _transfer_patterns_manifest(tt, area, limit_mid_walking_time, max_trips, max_journey_time):
+    return {"format": TRANSFER_PATTERNS_FORMAT, "version": TRANSFER_PATTERNS_VERSION, "area": list(area),
+            "limit_mid_walking_time": limit_mid_walking_time, "max_trips": max_trips, "max_journey_time": max_journey_time,
+            "stations": _stations_fingerprint(tt.stations.values()), "trips": _trips_fingerprint(tt.get_route_patterns())}
+
+
+def _prepare_store(folder, manifest):
+    """
+    Create the store folder, or check the existing one was made with the same parameters.
+    returns the set of finished sources
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            existing = json.load(f)
+        if existing == manifest:
+            return set(int(name[len("source_"):-len(".json")]) for name in os.listdir(folder)
+                       if name.startswith("source_") and name.endswith(".json"))
+        print_log(f"transfer patterns store {folder} was made with other parameters or timetable, starting over")
+        shutil.rmtree(folder)
+    os.makedirs(folder, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return set()
+
+
+def compute_transfer_patterns(tt, folder=None, area=TEL_AVIV_AREA, limit_mid_walking_time=DEFAULT_LIMIT_MID_WALKING_TIME, max_trips=DEFAULT_MAX_TRIPS,
+                              max_journey_time=DEFAULT_MAX_JOURNEY_TIME, workers=1, max_sources=None):
+    """
+    @folder - transfer patterns store folder, sources already in it are skipped. None to keep the results in memory only.
+    @area - (min_lon, max_lon, min_lat, max_lat), the source stations
+    @workers - number of processes, a source station is a unit of work
+    @max_sources - stop after this many sources of this run (None - all), for building the index in parts
+    returns source station_id -> {target station_id: [pattern, ...]} when there is no folder, otherwise None (see TransferPatternIndex)
+    """
+    patterns = tt.get_route_patterns()
+    dense_stations = tt.get_dense_stations()
+    transfers = {station_id: [(f["time"], f["station_id"]) for f in footpaths if f["time"] <= limit_mid_walking_time]
+                 for station_id, footpaths in tt.stations_footpaths.items()}
+    done = set()
+    if folder is not None:
+        done = _prepare_store(folder, _transfer_patterns_manifest(tt, area, limit_mid_walking_time, max_trips, max_journey_time))
+        if len(done) > 0:
+            print_log(f"resuming transfer patterns - {len(done)} sources already done")
+    sources = [(dense_stations.index(station_id), station_id) for station_id, station in tt.stations.items()
+               if station_id in patterns.station_patterns and _in_area(station, area)]
+    tasks = [task for task in sources if task[0] not in done][:max_sources]
+
+    results = {}
+    num_patterns = 0
+    num_stations = 0
+    finished = 0
+    start = time.perf_counter()
+    def source_done(result):
+        nonlocal num_patterns, num_stations, finished
+        source_idx, source_patterns, source_stations, _, transfer_patterns = result
+        num_patterns += source_patterns
+        num_stations += source_stations
+        finished += 1
+        if transfer_patterns is not None:
+            results[dense_stations.station_id(source_idx)] = transfer_patterns
+        if finished % 100 == 0 or finished == len(tasks):
+            print_log(f"transfer patterns - {finished}/{len(tasks)} sources, {num_patterns} patterns, {time.perf_counter() - start:.1f} seconds")
+
+    if workers is None or workers <= 1:
+        global _patterns, _transfers, _folder, _max_trips, _max_journey_time
+        previous = (_patterns, _transfers, _folder, _max_trips, _max_journey_time)
+        _init_worker(patterns, transfers, folder, max_trips, max_journey_time)
+        try:
+            for task in tasks:
+                source_done(run_source(task))
+        finally:
+            _patterns, _transfers, _folder, _max_trips, _max_journey_time = previous
+    else:
+        with Pool(workers, initializer=_init_worker, initargs=(patterns, transfers, folder, max_trips, max_journey_time)) as pool:
+            for result in pool.imap_unordered(run_source, tasks):
+                source_done(result)
+    print_log(f"finished transfer patterns of {finished} sources - {num_patterns} patterns ({num_stations} stations) in {time.perf_counter() - start:.2f} seconds, "
+              f"{workers or 1} workers")
+    return results if folder is None else None
+
+
+class TransferPatternIndex(object):
+    """
+    Transfer patterns of a timetable, and what evaluating them needs - direct lines between stations and transfer walks.
+    Sources are loaded from the store on first use.
+    """
+    def __init__(self, tt, folder=None, transfer_patterns=None):
+        """
+        @folder - transfer patterns store folder
+        @transfer_patterns - or the result of compute_transfer_patterns without a folder
+        """
+        self.tt = tt
+        self.folder = folder
+        self.patterns = tt.get_route_patterns()
+        self.dense_stations = tt.get_dense_stations()
+        self.manifest = None
+        if folder is not None:
+            with open(os.path.join(folder, MANIFEST_FILE), "r") as f:
+                self.manifest = json.load(f)
+        limit_mid_walking_time = self.manifest["limit_mid_walking_time"] if self.manifest is not None else DEFAULT_LIMIT_MID_WALKING_TIME
+        self.walks = {station_id: {f["station_id"]: f["time"] for f in footpaths if f["time"] <= limit_mid_walking_time}
+                      for station_id, footpaths in tt.stations_footpaths.items()}
+        self._sources = dict(transfer_patterns or {})
+        # (from station, to station) -> [(pattern, from stop, to stop)]
+        self._direct = {}
+
+    def source_patterns(self, source):
+        """
+        returns target station_id -> [pattern, ...] of source
+        """
+        if source not in self._sources:
+            source_idx = self.dense_stations.index(source)
+            path = None if self.folder is None or source_idx < 0 else _source_file(self.folder, source_idx)
+            if path is not None and os.path.isfile(path):
+                with open(path, "r") as f:
+                    self._sources[source] = json.load(f)
+            else:
+                self._sources[source] = {}
+        return self._sources[source]
+
+    def direct(self, from_station, to_station):
+        key = (from_station, to_station)
+        if key not in self._direct:
+            lines = []
+            to_stops = {}
+            for p, j in self.patterns.station_patterns.get(to_station, ()):
+                to_stops.setdefault(p, []).append(j)
+            for p, i in self.patterns.station_patterns.get(from_station, ()):
+                for j in to_stops.get(p, ()):
+                    if j > i:
+                        lines.append((p, i, j))
+            self._direct[key] = lines
+        return self._direct[key]
+
+    def ride(self, from_station, to_station, departure_time):
+        """
+        returns (arrival time, trip_id, from stop, to stop) of the earliest arrival riding from_station -> to_station without changing,
+            leaving at departure_time or later. None if there is no such trip.
+        """
+        best = None
+        for p, i, j in self.direct(from_station, to_station):
+            pattern = self.patterns[p]
+            departures_by_stop, arrivals_by_trip = pattern.scan_arrays()
+            u = bisect_left(departures_by_stop[i], departure_time)
+            if u < len(pattern) and (best is None or arrivals_by_trip[u][j] < best[0]):
+                best = (arrivals_by_trip[u][j], pattern.trip_ids[u], i, j)
+        return best
+
+    def num_sources(self):
+        if self.folder is None:
+            return len(self._sources)
+        return sum(1 for name in os.listdir(self.folder) if name.startswith("source_") and name.endswith(".json"))
+
+    def size(self):
+        """
+        returns (number of sources, bytes on disk) of the store
+        """
+        if self.folder is None:
+            return len(self._sources), len(json.dumps(self._sources))
+        names = [name for name in os.listdir(self.folder) if name.startswith("source_") and name.endswith(".json")]
+        return len(names), sum(os.path.getsize(os.path.join(self.folder, name)) for name in names)
+
+    def __repr__(self):
+        num_sources, num_bytes = self.size()
+        return f"TransferPatternIndex({num_sources} sources, {num_bytes / 2**20:.1f}MB)"
+
+
+def get_transfer_pattern_index(tt, folder=None):
+    """
+    The index of tt, kept on its route patterns. The first call should give the store folder (e.g. TLV_TRANSFER_PATTERNS_STORE).
+    """
+    patterns = tt.get_route_patterns()
+    index = getattr(patterns, "_transfer_pattern_index", None)
+    if index is None or (folder is not None and index.folder != folder):
+        if folder is None:
+            raise AssertionError("no transfer patterns index for this timetable, call get_transfer_pattern_index(tt, folder) first")
+        index = TransferPatternIndex(tt, folder)
+        patterns._transfer_pattern_index = index
+    return index
+
+
+def transfer_patterns_route(start_station, end_station, start_time, tt, end_footpath_connections=None, relax_footpaths=True, limit_walking_time=1* 60 * 60,
+                            limit_mid_walking_time= 60*6, debug=False, scanner=None, transfer_shortcuts=None, sources=None, targets=None,
+                            source_trip_ids=None, target_trip_ids=None):
+    """
+    raptor_route's parameters and results (a round per number of trips), by evaluating the transfer patterns of get_transfer_pattern_index(tt).
+    Walks longer than limit_mid_walking_time are skipped, and all of them if not relax_footpaths. scanner and transfer_shortcuts are ignored.
+    A round only has a result if it arrives earlier than the rounds before it.
+    """
+    source_trip_ids = source_trip_ids or {}
+    target_trip_ids = target_trip_ids or {}
+    index = get_transfer_pattern_index(tt)
+    start_time_int = time_to_int(start_time)
+    walking_limit = limit_mid_walking_time if relax_footpaths else -1
+
+    stations_to_end = {}
+    if end_footpath_connections is not None:
+        for s_to_t in end_footpath_connections["sources_to_targets"]:
+            if s_to_t[0]["time"] is not None:
+                stations_to_end[index.dense_stations.station_id(s_to_t[0]["from_index"])] = s_to_t[0]["time"]
+    for station_id, egress_time in (targets or {}).items():
+        stations_to_end[station_id] = min(egress_time, stations_to_end.get(station_id, egress_time))
+    stations_to_end = {station_id: egress_time for station_id, egress_time in stations_to_end.items() if egress_time < limit_walking_time}
+
+    if sources is None:
+        source_arrivals = {start_station: start_time_int}
+    else:
+        source_arrivals = {station_id: arrival_time for station_id, arrival_time in sources.items() if arrival_time >= start_time_int}
+
+    # number of trips -> (arrival at the end, source, pattern, egress). 0 trips are sources we can walk to the end from
+    best = {}
+    # (source, pattern prefix) -> (arrival time, walk departure, ride) - the DAG, patterns with the same prefix share it
+    nodes = {}
+    num_evaluated = 0
+    def evaluate(source, pattern):
+        nonlocal num_evaluated
+        key = (source, pattern)
+        if key in nodes:
+            return nodes[key]
+        if len(pattern) == 2:
+            arrival_time, walk_departure = source_arrivals[source], None
+        else:
+            previous = evaluate(source, pattern[:-2])
+            if previous is None:
+                nodes[key] = None
+                return None
+            walk_departure = previous[0]
+            if pattern[-3] == pattern[-2]:
+                arrival_time = walk_departure
+            else:
+                walking_time = index.walks.get(pattern[-3], {}).get(pattern[-2])
+                if walking_time is None or walking_time > walking_limit:
+                    nodes[key] = None
+                    return None
+                arrival_time = walk_departure + walking_time
+        num_evaluated += 1
+        ride = index.ride(pattern[-2], pattern[-1], arrival_time)
+        nodes[key] = None if ride is None else (ride[0], walk_departure, ride)
+        return nodes[key]
+
+    for source, arrival_time in source_arrivals.items():
+        if source in stations_to_end and (0 not in best or arrival_time + stations_to_end[source] < best[0][0]):
+            best[0] = (arrival_time + stations_to_end[source], source, (), stations_to_end[source])
+        source_patterns = index.source_patterns(source)
+        for target, egress_time in stations_to_end.items():
+            for pattern in source_patterns.get(target, ()):
+                node = evaluate(source, tuple(pattern))
+                k = len(pattern) // 2
+                if node is not None and (k not in best or node[0] + egress_time < best[k][0]):
+                    best[k] = (node[0] + egress_time, source, tuple(pattern), egress_time)
+
+    def trace(source, pattern, egress_time):
+        result_route = []
+        if source != start_station:
+            result_route.append((source, [Connection(start_station, source, start_time_int, source_arrivals[source], source_trip_ids.get(source, FOOTPATH_ID))]))
+        arrival_time = source_arrivals[source]
+        for m in range(2, len(pattern) + 1, 2):
+            arrival_time, walk_departure, (_, trip_id, from_stop, to_stop) = nodes[(source, pattern[:m])]
+            if m > 2 and pattern[m - 3] != pattern[m - 2]:
+                walk_arrival = walk_departure + index.walks[pattern[m - 3]][pattern[m - 2]]
+                result_route.append((pattern[m - 2], [Connection(pattern[m - 3], pattern[m - 2], walk_departure, walk_arrival, FOOTPATH_ID)]))
+            result_route.append((pattern[m - 1], TripView(tt.trip_connections[trip_id], from_stop, to_stop)))
+        last_station = pattern[-1] if len(pattern) > 0 else source
+        result_route.append((end_station, [Connection(last_station, end_station, arrival_time, arrival_time + egress_time,
+                                                      target_trip_ids.get(last_station, FOOTPATH_ID))]))
+        return result_route
+
+    total_result_routes = []
+    best_arrival = INFINITY
+    # rounds of raptor_route - with sources round 0 has no trips, without them round 0 is the first trip
+    first_trips = 0 if sources is not None else 1
+    for k in range(first_trips, first_trips + MAX_ROUNDS):
+        if k in best and best[k][0] < best_arrival:
+            best_arrival = best[k][0]
+            total_result_routes.append([trace(*best[k][1:])])
+        else:
+            total_result_routes.append([])
+    if debug:
+        print(f"transfer patterns - {len(source_arrivals)} sources, {len(nodes)} DAG nodes, {num_evaluated} rides evaluated")
+    return total_result_routes
+
+
+############################################################
+### TEST TRANSFER PATTERNS #################################
+############################################################
+
+def _earliest_arrival(result_routes):
+    arrivals = [result[-1][1][-1].arrival_time for round_res in result_routes for result in round_res]
+    return min(arrivals) if len(arrivals) > 0 else None
+
+def _query_benchmark(tt, ods, station_pairs, start_time, limit_walking_time):
+    # returns (raptor ms, transfer patterns ms, number of different earliest arrivals)
+    raptor_time = tp_time = 0
+    num_different = 0
+    for start_loc, end_loc, od_start_time in ods:
+        # mapped timetables materialize stations on first use, and sources of the index are loaded on first use - don't time that
+        run_ultra_wrapper(start_loc, end_loc, od_start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner)
+        run_ultra_wrapper(start_loc, end_loc, od_start_time, tt, limit_walking_time=limit_walking_time, engine=transfer_patterns_route)
+        query_start = time.perf_counter()
+        raptor_results = run_ultra_wrapper(start_loc, end_loc, od_start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner)
+        raptor_time += time.perf_counter() - query_start
+        query_start = time.perf_counter()
+        tp_results = run_ultra_wrapper(start_loc, end_loc, od_start_time, tt, limit_walking_time=limit_walking_time, engine=transfer_patterns_route)
+        tp_time += time.perf_counter() - query_start
+        raptor_best = min((r.arrival_time for r in raptor_results), default=None)
+        tp_best = min((r.arrival_time for r in tp_results), default=None)
+        if raptor_best != tp_best:
+            num_different += 1
+            print(f"    [!] {od_start_time} - raptor arrives at {raptor_best}, transfer patterns at {tp_best}")
+    for start_station, end_station in station_pairs:
+        raptor_route(start_station, end_station, start_time, tt, scanner=PatternScanner, targets={end_station: 0})
+        transfer_patterns_route(start_station, end_station, start_time, tt, targets={end_station: 0})
+        query_start = time.perf_counter()
+        raptor_results = raptor_route(start_station, end_station, start_time, tt, scanner=PatternScanner, targets={end_station: 0})
+        raptor_time += time.perf_counter() - query_start
+        query_start = time.perf_counter()
+        tp_results = transfer_patterns_route(start_station, end_station, start_time, tt, targets={end_station: 0})
+        tp_time += time.perf_counter() - query_start
+        if _earliest_arrival(raptor_results) != _earliest_arrival(tp_results):
+            num_different += 1
+            print(f"    [!] {start_station} -> {end_station} - raptor arrives at {_earliest_arrival(raptor_results)}, "
+                  f"transfer patterns at {_earliest_arrival(tp_results)}")
+    num_queries = len(ods) + len(station_pairs)
+    return raptor_time / num_queries * 1000, tp_time / num_queries * 1000, num_different
+
+def test_transfer_patterns(workers=4, max_trips_options=(2, 3, 4), num_queries=200, start_time="08:00:00", limit_walking_time=60*15, seed=0,
+                           folder=TLV_TRANSFER_PATTERNS_STORE):
+    """
+    Build the TLV index for each max_trips (in two parts, the second resuming the first), and report its size against query latency,
+    next to raptor_route (PatternScanner) on the benchmark ODs and random station to station queries.
+    returns True if the earliest arrivals always matched raptor_route with the full max_trips
+    """
+    tt = get_tlv_timetable()
+    patterns = tt.get_route_patterns()
+    rng = random.Random(seed)
+    station_ids = [station_id for station_id in tt.stations if station_id in patterns.station_patterns]
+    station_pairs = [tuple(rng.sample(station_ids, 2)) for _ in range(num_queries)]
+
+    report = []
+    same = True
+    for max_trips in max_trips_options:
+        trips_folder = f"{folder}_{max_trips}_trips"
+        # timing the whole build
+        shutil.rmtree(trips_folder, ignore_errors=True)
+        start = time.perf_counter()
+        compute_transfer_patterns(tt, trips_folder, max_trips=max_trips, workers=workers, max_sources=len(station_ids) // 2)
+        compute_transfer_patterns(tt, trips_folder, max_trips=max_trips, workers=workers)
+        build_time = time.perf_counter() - start
+        index = get_transfer_pattern_index(tt, trips_folder)
+        print_log(f"{max_trips} trips - {index}, built in {build_time:.2f} seconds")
+        raptor_ms, tp_ms, num_different = _query_benchmark(tt, BENCHMARK_ODS, station_pairs, start_time, limit_walking_time)
+        if max_trips == DEFAULT_MAX_TRIPS:
+            same = num_different == 0
+        report.append((max_trips, index.size()[1], build_time, raptor_ms, tp_ms, num_different))
+
+    print_log(f"{'max trips':>9} {'index MB':>9} {'build s':>8} {'raptor ms':>10} {'patterns ms':>12} {'different':>10}")
+    for max_trips, num_bytes, build_time, raptor_ms, tp_ms, num_different in report:
+        print_log(f"{max_trips:>9} {num_bytes / 2**20:>9.2f} {build_time:>8.1f} {raptor_ms:>10.2f} {tp_ms:>12.2f} {num_different:>10}")
+    return same
+
+
+def main():
+    test_transfer_patterns()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,507 @@
+import hashlib
+import json
+import os
+import random
+import time
+from bisect import bisect_left
+from multiprocessing import Pool
+
+import numpy as np
+
+from utils import ARTIFACTS_FOLDER, FOOTPATH_ID, time_to_int, print_log
+from footpath_pipeline import _stations_fingerprint
+from connection_builder import Connection, TripView, get_tlv_timetable
+from raptor_routing import raptor_route, run_ultra_wrapper, BENCHMARK_ODS, MAX_ROUNDS
+from pattern_raptor_routing import PatternScanner
+
+# Trip-Based public transit routing (Witt, "Trip-Based Public Transit Routing").
+# Select it with run_ultra_wrapper(..., engine=trip_based_route).
+# Preprocessing - for every trip t and stop i of it, the trips u we can transfer to: walk from the stop (tt.stations_footpaths,
+# up to limit_mid_walking_time, or stay at the station) and board the earliest trip of each pattern passing there, at stop j.
+# Most of them are useless, and two reductions drop them:
+#   U-turns - getting off at i to ride u back to the stop before i, when we could have changed there.
+#   not improving - going over the stops of t from the last one back, keeping the earliest arrival (and walk from there) at every station
+#   we can get to from t@i. A transfer is kept only if riding u after it improves one of them.
+# Queries are a BFS over trip segments - round n holds the segments (t, from stop b, to stop e) reached with n transfers.
+# A trip reached at stop j marks all the later trips of its pattern at j too (no trip overtakes an earlier one), so each trip stop is
+# scanned once per query, and transfers are only followed from stops that arrive before the best arrival at the end.
+#
+# Transfers file (next to the timetable artifact) - a numpy .npz of
+#   "header" - json of {"format", "version", "limit_mid_walking_time", "stations" (fingerprint), "trips" (fingerprint of the patterns' trips)}
+#   "transfer_offset" - transfers of trip stop s (trip_stop_offset[trip] + stop position) are transfer_offset[s]:transfer_offset[s + 1]
+#   "transfer_trip", "transfer_stop", "transfer_walk" - the trip (numbered pattern by pattern), its stop and the walking time of a transfer
+
+TRIP_TRANSFERS_FORMAT = "tremp-trip-transfers"
+TRIP_TRANSFERS_VERSION = 2
+TLV_TRIP_TRANSFERS = os.path.join(ARTIFACTS_FOLDER, "tlv_trip_transfers.npz")
+
+DEFAULT_LIMIT_MID_WALKING_TIME = 60 * 6 # seconds, like raptor_route's limit_mid_walking_time
+
+INFINITY = 2**40
+UNREACHED = 2**30
+
+# preprocessing state of this process - set by the pool initializer in workers, or by compute_trip_transfers when running inline
+_patterns = None
+_pattern_offset = None
+_footpaths = None
+
+
+def _init_worker(patterns, pattern_offset, footpaths):
+    global _patterns, _pattern_offset, _footpaths
+    _patterns = patterns
+    _pattern_offset = pattern_offset
+    _footpaths = footpaths
+
+
+def _improve(earliest, station, arrival_time):
+    # the earliest arrival at station (and walking from it) of the trip being reduced, returns True if anything improved
+    improved = False
+    if arrival_time < earliest.get(station, INFINITY):
+        earliest[station] = arrival_time
+        improved = True
+    for walking_time, target in _footpaths.get(station, ()):
+        if arrival_time + walking_time < earliest.get(target, INFINITY):
+            earliest[target] = arrival_time + walking_time
+            improved = True
+    return improved
+
+
+def pattern_transfers(p):
+    """
+    returns (p, transfers of every trip of pattern p - [trip row][stop position] -> list of (trip, stop, walking time), number of transfers before reducing)
+    """
+    pattern = _patterns[p]
+    station_patterns = _patterns.station_patterns
+    stops = pattern.stops
+    num_candidates = 0
+    trips = []
+    for row, arrivals in enumerate(pattern.scan_arrays()[1]):
+        earliest = {}
+        by_stop = [[] for _ in stops]
+        for i in range(len(stops) - 1, 0, -1):
+            station = stops[i]
+            arrival_time = arrivals[i]
+            _improve(earliest, station, arrival_time)
+            for walking_time, target in [(0, station)] + _footpaths.get(station, []):
+                for other_p, j in station_patterns.get(target, ()):
+                    other = _patterns[other_p]
+                    if j == len(other.stops) - 1:
+                        continue
+                    other_departures, other_arrivals = other.scan_arrays()
+                    u = bisect_left(other_departures[j], arrival_time + walking_time)
+                    if u == len(other) or (other_p == p and u >= row and j >= i):
+                        # nothing to board, or a later trip of the same line further on - staying on t gets everywhere as early.
+                        # Boarding the line at an earlier stop (j < i, a loop line passing the station twice) is a real transfer.
+                        continue
+                    if i >= 2 and other.stops[j + 1] == stops[i - 1] and other_departures[j + 1][u] >= arrivals[i - 1]:
+                        # U-turn
+                        continue
+                    num_candidates += 1
+                    u_arrivals = other_arrivals[u]
+                    keep = False
+                    for k in range(j + 1, len(other.stops)):
+                        keep = _improve(earliest, other.stops[k], u_arrivals[k]) or keep
+                    if keep:
+                        by_stop[i].append((_pattern_offset[other_p] + u, j, walking_time))
+        trips.append(by_stop)
+    return p, trips, num_candidates
+
+
+def run_patterns(patterns):
+    """
+    returns [pattern_transfers of each pattern], number of patterns, seconds. Runs in a pool worker (or inline with one worker).
+    """
+    start = time.perf_counter()
+    return [pattern_transfers(p) for p in patterns], len(patterns), time.perf_counter() - start
+
+
+class TripTransfers(object):
+    """
+    The reduced trip to trip transfers of route patterns. Trips are numbered pattern by pattern - trip row t of pattern p is
+    pattern_offset[p] + t.
+    """
+    def __init__(self, patterns, header, transfer_offset, transfer_trip, transfer_stop, transfer_walk, num_candidates=None):
+        self.patterns = patterns
+        self.header = header
+        self.pattern_offset = _pattern_offsets(patterns)
+        # trip -> pattern, and where its stops start in the trip stops
+        self.trip_pattern = []
+        self.trip_stop_offset = [0]
+        for p, pattern in enumerate(patterns.patterns):
+            for _ in range(len(pattern)):
+                self.trip_pattern.append(p)
+                self.trip_stop_offset.append(self.trip_stop_offset[-1] + len(pattern.stops))
+        self.transfer_offset = transfer_offset
+        self.transfer_trip = transfer_trip
+        self.transfer_stop = transfer_stop
+        self.transfer_walk = transfer_walk
+        self.num_candidates = num_candidates
+        self._lists = None
+
+    def lists(self):
+        """
+        returns (transfer_offset, transfer_trip, transfer_stop, transfer_walk) as python lists - a query reads them one at a time
+        """
+        if self._lists is None:
+            self._lists = (self.transfer_offset.tolist(), self.transfer_trip.tolist(), self.transfer_stop.tolist(), self.transfer_walk.tolist())
+        return self._lists
+
+    def __len__(self):
+        return len(self.transfer_trip)
+
+    def nbytes(self):
+        return self.transfer_offset.nbytes + self.transfer_trip.nbytes + self.transfer_stop.nbytes + self.transfer_walk.nbytes
+
+    def __repr__(self):
+        reduced = f" out of {self.num_candidates}" if self.num_candidates is not None else ""
+        return f"TripTransfers({len(self)} transfers{reduced}, {len(self.trip_pattern)} trips, {self.nbytes() / 2**20:.1f}MB)"
+
+
+def _pattern_offsets(patterns):
+    offsets = [0]
+    for pattern in patterns.patterns:
+        offsets.append(offsets[-1] + len(pattern))
+    return offsets
+
+
+def _trips_fingerprint(patterns):
+    h = hashlib.sha1()
+    for pattern in patterns.patterns:
+        h.update((",".join(pattern.trip_ids) + ";").encode())
+    return h.hexdigest()
+
+
+def _trip_transfers_header(tt, limit_mid_walking_time):
+    return {"format": TRIP_TRANSFERS_FORMAT, "version": TRIP_TRANSFERS_VERSION, "limit_mid_walking_time": limit_mid_walking_time,
+            "stations": _stations_fingerprint(tt.stations.values()), "trips": _trips_fingerprint(tt.get_route_patterns())}
+
+
+def compute_trip_transfers(tt, limit_mid_walking_time=DEFAULT_LIMIT_MID_WALKING_TIME, workers=1, chunk_size=20):
+    """
+    @limit_mid_walking_time - seconds, walks from tt.stations_footpaths up to this long are transfers
+    @workers - number of processes, patterns are split to chunks of chunk_size patterns
+    returns TripTransfers
+    """
+    patterns = tt.get_route_patterns()
+    pattern_offset = _pattern_offsets(patterns)
+    footpaths = {station_id: [(f["time"], f["station_id"]) for f in station_footpaths if f["time"] <= limit_mid_walking_time]
+                 for station_id, station_footpaths in tt.stations_footpaths.items()}
+    chunks = [list(range(i, min(i + chunk_size, len(patterns)))) for i in range(0, len(patterns), chunk_size)]
+
+    by_pattern = [None] * len(patterns)
+    num_candidates = 0
+    finished = 0
+    start = time.perf_counter()
+    def chunk_done(result):
+        nonlocal num_candidates, finished
+        chunk_transfers, num_patterns, _ = result
+        for p, trips, candidates in chunk_transfers:
+            by_pattern[p] = trips
+            num_candidates += candidates
+        finished += num_patterns
+        if finished % (chunk_size * 50) < num_patterns or finished == len(patterns):
+            print_log(f"trip transfers - {finished}/{len(patterns)} patterns, {time.perf_counter() - start:.1f} seconds")
+
+    if workers is None or workers <= 1:
+        global _patterns, _pattern_offset, _footpaths
+        previous = (_patterns, _pattern_offset, _footpaths)
+        _init_worker(patterns, pattern_offset, footpaths)
+        try:
+            for chunk in chunks:
+                chunk_done(run_patterns(chunk))
+        finally:
+            _patterns, _pattern_offset, _footpaths = previous
+    else:
+        with Pool(workers, initializer=_init_worker, initargs=(patterns, pattern_offset, footpaths)) as pool:
+            for result in pool.imap_unordered(run_patterns, chunks):
+                chunk_done(result)
+
+    transfer_offset = [0]
+    transfers = []
+    for trips in by_pattern:
+        for by_stop in trips:
+            for stop_transfers in by_stop:
+                transfers += stop_transfers
+                transfer_offset.append(len(transfers))
+    transfers = np.array(transfers, dtype=np.int32).reshape(-1, 3)
+    trip_transfers = TripTransfers(patterns, _trip_transfers_header(tt, limit_mid_walking_time), np.array(transfer_offset, dtype=np.int64),
+                                   np.ascontiguousarray(transfers[:, 0]), np.ascontiguousarray(transfers[:, 1]), np.ascontiguousarray(transfers[:, 2]),
+                                   num_candidates)
+    print_log(f"{trip_transfers}, {time.perf_counter() - start:.2f} seconds, {workers or 1} workers")
+    return trip_transfers
+
+
+def save_trip_transfers(trip_transfers, path):
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, header=np.array(json.dumps(trip_transfers.header)), transfer_offset=trip_transfers.transfer_offset,
+             transfer_trip=trip_transfers.transfer_trip, transfer_stop=trip_transfers.transfer_stop, transfer_walk=trip_transfers.transfer_walk)
+    os.replace(tmp_path, path)
+
+
+def load_trip_transfers(path, tt, limit_mid_walking_time=DEFAULT_LIMIT_MID_WALKING_TIME):
+    """
+    returns None when there is no file, or it was made for other stations / trips / walking limit
+    """
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        header = json.loads(str(data["header"]))
+        if header.get("format") != TRIP_TRANSFERS_FORMAT or header.get("version") != TRIP_TRANSFERS_VERSION:
+            return None
+        if header != _trip_transfers_header(tt, limit_mid_walking_time):
+            print_log(f"trip transfers {path} were made for another timetable")
+            return None
+        return TripTransfers(tt.get_route_patterns(), header, data["transfer_offset"], data["transfer_trip"], data["transfer_stop"], data["transfer_walk"])
+
+
+def get_trip_transfers(tt, path=None, reparse=False, limit_mid_walking_time=DEFAULT_LIMIT_MID_WALKING_TIME, workers=1):
+    """
+    The transfers of tt's route patterns, kept on the patterns (so a service day has its own).
+    @path - load them from this file, or compute and save them there. None to only compute them (TLV_TRIP_TRANSFERS for the tlv timetable).
+    @workers - None for all cores
+    """
+    patterns = tt.get_route_patterns()
+    trip_transfers = getattr(patterns, "_trip_transfers", None)
+    if trip_transfers is not None and not reparse and trip_transfers.header["limit_mid_walking_time"] == limit_mid_walking_time:
+        return trip_transfers
+    trip_transfers = None if reparse or path is None else load_trip_transfers(path, tt, limit_mid_walking_time)
+    if trip_transfers is None:
+        workers = os.cpu_count() if workers is None else workers
+        trip_transfers = compute_trip_transfers(tt, limit_mid_walking_time=limit_mid_walking_time, workers=workers)
+        if path is not None:
+            save_trip_transfers(trip_transfers, path)
+    patterns._trip_transfers = trip_transfers
+    return trip_transfers
+
+
+def trip_based_route(start_station, end_station, start_time, tt, end_footpath_connections=None, relax_footpaths=True, limit_walking_time=1* 60 * 60,
+                     limit_mid_walking_time= 60*6, debug=False, scanner=None, transfer_shortcuts=None, sources=None, targets=None,
+                     source_trip_ids=None, target_trip_ids=None):
+    """
+    raptor_route's parameters and results (a round per number of trips), by BFS over trip segments.
+    The transfers are get_trip_transfers(tt) - call it first to load / compute them (for a service day, with its timetable). Walks of them longer than
+    limit_mid_walking_time are skipped, and all of them if not relax_footpaths. scanner and transfer_shortcuts are ignored.
+    A round only has a result if it arrives earlier than the rounds before it.
+    """
+    source_trip_ids = source_trip_ids or {}
+    target_trip_ids = target_trip_ids or {}
+    trip_transfers = getattr(tt.get_route_patterns(), "_trip_transfers", None)
+    if trip_transfers is None:
+        # computing them here would run the whole preprocessing in one process on the first query
+        raise AssertionError("no trip transfers for this timetable, call get_trip_transfers(tt, path) first")
+    patterns = trip_transfers.patterns
+    station_patterns = patterns.station_patterns
+    pattern_offset = trip_transfers.pattern_offset
+    trip_pattern = trip_transfers.trip_pattern
+    trip_stop_offset = trip_transfers.trip_stop_offset
+    transfer_offset, transfer_trip, transfer_stop, transfer_walk = trip_transfers.lists()
+    walking_limit = limit_mid_walking_time if relax_footpaths else 0
+    start_time_int = time_to_int(start_time)
+
+    stations_to_end = {}
+    if end_footpath_connections is not None:
+        dense_stations = tt.get_dense_stations()
+        for s_to_t in end_footpath_connections["sources_to_targets"]:
+            if s_to_t[0]["time"] is not None:
+                stations_to_end[dense_stations.station_id(s_to_t[0]["from_index"])] = s_to_t[0]["time"]
+    for station_id, egress_time in (targets or {}).items():
+        stations_to_end[station_id] = min(egress_time, stations_to_end.get(station_id, egress_time))
+    stations_to_end = {station_id: egress_time for station_id, egress_time in stations_to_end.items() if egress_time < limit_walking_time}
+    # pattern -> [(stop position, walking time to the end)] of the stops we can get off at and walk to the end
+    egress_stops = {}
+    for station_id, egress_time in stations_to_end.items():
+        for p, i in station_patterns.get(station_id, ()):
+            if i > 0:
+                egress_stops.setdefault(p, []).append((i, egress_time))
+
+    # pattern -> earliest trip reached at each stop. A trip reached at a stop reaches the later trips of the pattern there too
+    # (they get everywhere later), so the first stop trip t is reached at is the first stop with an earlier (or the same) trip.
+    reached = {}
+    # (trip, board stop, end stop, parent segment, then the parent's stop we got off at and the walk, or the source station and its arrival time)
+    segments = []
+    def enqueue(trip, stop, parent, info, time_info, queue):
+        p = trip_pattern[trip]
+        reached_trips = reached.get(p)
+        if reached_trips is None:
+            reached_trips = reached[p] = [UNREACHED] * len(patterns[p].stops)
+        for j in range(stop + 1):
+            if reached_trips[j] <= trip:
+                return
+        end = stop + 1
+        while end < len(reached_trips) and reached_trips[end] > trip:
+            end += 1
+        segments.append((trip, stop, end, parent, info, time_info))
+        queue.append(len(segments) - 1)
+        reached_trips[stop] = trip
+
+    def board(station_id, arrival_time, queue):
+        for p, j in station_patterns.get(station_id, ()):
+            pattern = patterns[p]
+            if j == len(pattern.stops) - 1:
+                continue
+            u = bisect_left(pattern.scan_arrays()[0][j], arrival_time)
+            if u < len(pattern):
+                enqueue(pattern_offset[p] + u, j, -1, station_id, arrival_time, queue)
+
+    def trace(segment, alight, egress_time):
+        trip, board_stop, _, parent, info, time_info = segments[segment]
+        p = trip_pattern[trip]
+        pattern = patterns[p]
+        station_id = pattern.stops[alight]
+        arrival_time = pattern.scan_arrays()[1][trip - pattern_offset[p]][alight]
+        result_route = [(end_station, [Connection(station_id, end_station, arrival_time, arrival_time + egress_time,
+                                                  target_trip_ids.get(station_id, FOOTPATH_ID))])]
+        while True:
+            trip, board_stop, _, parent, info, time_info = segments[segment]
+            p = trip_pattern[trip]
+            pattern = patterns[p]
+            trip_id = pattern.trip_ids[trip - pattern_offset[p]]
+            result_route.insert(0, (pattern.stops[alight], TripView(tt.trip_connections[trip_id], board_stop, alight)))
+            if parent == -1:
+                if info != start_station:
+                    result_route.insert(0, (info, [Connection(start_station, info, start_time_int, time_info, source_trip_ids.get(info, FOOTPATH_ID))]))
+                return result_route
+            parent_trip = segments[parent][0]
+            parent_p = trip_pattern[parent_trip]
+            walk_from = patterns[parent_p].stops[info]
+            if walk_from != pattern.stops[board_stop]:
+                walk_departure = patterns[parent_p].scan_arrays()[1][parent_trip - pattern_offset[parent_p]][info]
+                result_route.insert(0, (pattern.stops[board_stop], [Connection(walk_from, pattern.stops[board_stop], walk_departure,
+                                                                               walk_departure + time_info, FOOTPATH_ID)]))
+            segment, alight = parent, info
+
+    total_result_routes = []
+    best_arrival = INFINITY
+    queue = []
+    if sources is None:
+        board(start_station, start_time_int, queue)
+    else:
+        # Round 0 has no trips, the sources are the stations it reached
+        best_source = None
+        for station_id, arrival_time in sources.items():
+            if arrival_time < start_time_int:
+                continue
+            board(station_id, arrival_time, queue)
+            if station_id in stations_to_end and arrival_time + stations_to_end[station_id] < best_arrival:
+                best_arrival = arrival_time + stations_to_end[station_id]
+                best_source = station_id
+        round_res_routes = []
+        if best_source is not None:
+            arrival_time = sources[best_source]
+            round_res_routes.append([(best_source, [Connection(start_station, best_source, start_time_int, arrival_time, source_trip_ids.get(best_source, FOOTPATH_ID))]),
+                                     (end_station, [Connection(best_source, end_station, arrival_time, best_arrival, target_trip_ids.get(best_source, FOOTPATH_ID))])])
+        total_result_routes.append(round_res_routes)
+
+    while len(total_result_routes) < MAX_ROUNDS:
+        # the end first, so transfers are only followed from stops that get there earlier
+        round_best = None
+        for segment in queue:
+            trip, board_stop = segments[segment][:2]
+            p = trip_pattern[trip]
+            arrivals = patterns[p].scan_arrays()[1][trip - pattern_offset[p]]
+            for i, egress_time in egress_stops.get(p, ()):
+                if i > board_stop and arrivals[i] + egress_time < best_arrival:
+                    best_arrival = arrivals[i] + egress_time
+                    round_best = (segment, i, egress_time)
+        total_result_routes.append([trace(*round_best)] if round_best is not None else [])
+
+        next_queue = []
+        for segment in queue:
+            trip, board_stop, end = segments[segment][:3]
+            p = trip_pattern[trip]
+            arrivals = patterns[p].scan_arrays()[1][trip - pattern_offset[p]]
+            stop_offset = trip_stop_offset[trip]
+            for i in range(board_stop + 1, min(end + 1, len(arrivals))):
+                if arrivals[i] >= best_arrival:
+                    break
+                for k in range(transfer_offset[stop_offset + i], transfer_offset[stop_offset + i + 1]):
+                    if transfer_walk[k] <= walking_limit:
+                        enqueue(transfer_trip[k], transfer_stop[k], segment, i, transfer_walk[k], next_queue)
+        if debug:
+            print(f"round {len(total_result_routes) - 1} - {len(queue)} segments, {len(next_queue)} next")
+        queue = next_queue
+    return total_result_routes
+
+
+############################################################
+### TEST TRIP BASED ########################################
+############################################################
+
+def _earliest_arrival(result_routes):
+    arrivals = [result[-1][1][-1].arrival_time for round_res in result_routes for result in round_res]
+    return min(arrivals) if len(arrivals) > 0 else None
+
+def test_trip_transfers_preprocessing(workers=(1, 4)):
+    """
+    Time computing the tlv transfers with each number of workers, and save them.
+    """
+    tt = get_tlv_timetable()
+    tt.get_route_patterns()
+    for num_workers in workers:
+        start = time.perf_counter()
+        trip_transfers = get_trip_transfers(tt, path=TLV_TRIP_TRANSFERS, reparse=True, workers=num_workers)
+        print_log(f"{num_workers} workers - {time.perf_counter() - start:.2f} seconds, {trip_transfers}")
+    start = time.perf_counter()
+    loaded = load_trip_transfers(TLV_TRIP_TRANSFERS, tt)
+    print_log(f"loading {TLV_TRIP_TRANSFERS} ({os.path.getsize(TLV_TRIP_TRANSFERS) / 2**20:.1f}MB) took {time.perf_counter() - start:.4f} seconds - {loaded}")
+
+def test_trip_based_route(ods=BENCHMARK_ODS, num_queries=200, start_time="08:00:00", limit_walking_time=60*15, seed=0):
+    """
+    Query benchmark and parity with raptor_route (PatternScanner) - the benchmark ODs (with walking) and random station to station queries.
+    Trip-Based and RAPTOR both ride up to 4 trips, so the earliest arrivals should be the same.
+    returns True if they always were
+    """
+    tt = get_tlv_timetable()
+    get_trip_transfers(tt, path=TLV_TRIP_TRANSFERS)
+    same = True
+    raptor_time = trip_based_time = 0
+    for start_loc, end_loc, od_start_time in ods:
+        # mapped timetables materialize stations on first use, don't time that
+        run_ultra_wrapper(start_loc, end_loc, od_start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner)
+        run_ultra_wrapper(start_loc, end_loc, od_start_time, tt, limit_walking_time=limit_walking_time, engine=trip_based_route)
+        query_start = time.perf_counter()
+        raptor_results = run_ultra_wrapper(start_loc, end_loc, od_start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner)
+        raptor_time += time.perf_counter() - query_start
+        query_start = time.perf_counter()
+        trip_based_results = run_ultra_wrapper(start_loc, end_loc, od_start_time, tt, limit_walking_time=limit_walking_time, engine=trip_based_route)
+        trip_based_time += time.perf_counter() - query_start
+        raptor_best = min((r.arrival_time for r in raptor_results), default=None)
+        trip_based_best = min((r.arrival_time for r in trip_based_results), default=None)
+        if raptor_best != trip_based_best:
+            same = False
+            print(f"    [!] {od_start_time} - raptor arrives at {raptor_best}, trip based at {trip_based_best}")
+            for r in raptor_results:
+                print("    raptor     -", r)
+            for r in trip_based_results:
+                print("    trip based -", r)
+    print_log(f"benchmark ODs - raptor {raptor_time / len(ods) * 1000:.2f} ms, trip based {trip_based_time / len(ods) * 1000:.2f} ms per query (with walking)")
+
+    rng = random.Random(seed)
+    patterns = tt.get_route_patterns()
+    station_ids = [station_id for station_id in tt.stations if station_id in patterns.station_patterns]
+    raptor_time = trip_based_time = 0
+    num_different = 0
+    for _ in range(num_queries):
+        start_station, end_station = rng.sample(station_ids, 2)
+        raptor_route(start_station, end_station, start_time, tt, scanner=PatternScanner, targets={end_station: 0})
+        query_start = time.perf_counter()
+        raptor_results = raptor_route(start_station, end_station, start_time, tt, scanner=PatternScanner, targets={end_station: 0})
+        raptor_time += time.perf_counter() - query_start
+        query_start = time.perf_counter()
+        trip_based_results = trip_based_route(start_station, end_station, start_time, tt, targets={end_station: 0})
+        trip_based_time += time.perf_counter() - query_start
+        if _earliest_arrival(raptor_results) != _earliest_arrival(trip_based_results):
+            same = False
+            num_different += 1
+            print(f"    [!] {start_station} -> {end_station} - raptor arrives at {_earliest_arrival(raptor_results)}, trip based at {_earliest_arrival(trip_based_results)}")
+    print_log(f"{num_queries} station queries - raptor {raptor_time / num_queries * 1000:.2f} ms, trip based {trip_based_time / num_queries * 1000:.2f} ms per query, "
+              f"{num_different} different")
+    return same
+
+
+def main():
+    test_trip_transfers_preprocessing()
+    test_trip_based_route()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from multiprocessing import Pool
+
+from utils import ARTIFACTS_FOLDER, print_log
+from footpath_pipeline import build_footpaths, _stations_fingerprint
+
+# ULTRA transfer shortcuts (Baum et al., "UnLimited TRAnsfers for Multi-Modal Route Planning").
+# raptor_route relaxes tt.stations_footpaths between rounds, which only has stations up to ~1km apart and is also cut
+# by limit_mid_walking_time. ULTRA walks without a limit, but only keeps the station to station walks that are the transfer
+# of some optimal journey - trip, walk, trip - so a round relaxes few transfers.
+#
+# Computing them - for every station s and every departure time from s, a two round search from s:
+#   round 0 - walk from s (witness, a journey which doesn't start with a trip from s)
+#   round 1 - trips boarded at s at that departure time are candidates, anything else is a witness. Candidates remember where they got off (v).
+#   transfers - walk from v to w, candidates remember (v, w)
+#   round 2 - trips boarded at w, candidates carry (v, w)
+#   final transfers
+# Every station whose best arrival is a candidate from round 2 (its trip or the final transfers after it) needed the (v, w) walk,
+# so it is a shortcut (v != w). Candidates which end with the round 1 walk are a final walk, not a transfer between two trips.
+# Ties go to witnesses, so a walk is only kept if nothing else gets there as early.
+# The walking (transfer graph) is station to station footpaths up to max_transfer_distance, built by the footpath pipeline
+# (so with valhalla, or any walking engine). Shortcuts are searched in parallel over source stations.
+#
+# Shortcuts file (next to the timetable artifact) - json of
+#   {"format", "version", the parameters, "stations" (fingerprint), "num_trips", "shortcuts": {station_id: [{"station_id", "distance", "time"}]}}
+# shortcuts are in the format of tt.stations_footpaths, sorted by time, and are given to raptor_route(transfer_shortcuts=...).
+
+TRANSFER_SHORTCUTS_FORMAT = "tremp-transfer-shortcuts"
+TRANSFER_SHORTCUTS_VERSION = 2
+TLV_TRANSFER_SHORTCUTS = os.path.join(ARTIFACTS_FOLDER, "tlv_transfer_shortcuts.json")
+TLV_TRANSFER_GRAPH_STORE = os.path.join(ARTIFACTS_FOLDER, "tlv_transfer_graph_store")
+
+DEFAULT_MAX_TRANSFER_DISTANCE = 3.0 # KM, "unlimited" walking - a transfer walk longer than this is never worth it in a city
+DEFAULT_MAX_JOURNEY_TIME = 2 * 60 * 60 # seconds, the two round search from a departure doesn't look further than this
+INFINITY = 2**40 # no label yet, later than any time
+
+WITNESS = 0
+CANDIDATE = 1
+
+# search state of this process - set by the pool initializer in workers, or by compute_transfer_shortcuts when running inline
+_patterns = None
+_transfer_graph = None
+_max_journey_time = DEFAULT_MAX_JOURNEY_TIME
+
+
+def _init_worker(patterns, transfer_graph, max_journey_time):
+    global _patterns, _transfer_graph, _max_journey_time
+    _patterns = patterns
+    _transfer_graph = transfer_graph
+    _max_journey_time = max_journey_time
+
+
+class ShortcutSearch(object):
+    """
+    Shortcut search from one source station, over its departure times latest first (the rRAPTOR order ULTRA uses).
+    Arrivals of later departures are kept in later_arrivals - leaving later and arriving as early is a witness against
+    anything an earlier departure finds, so each departure only scans and relaxes the stations it improves.
+    """
+    def __init__(self, source, patterns, transfer_graph, max_journey_time):
+        """
+        @transfer_graph - station_id -> list of (walking time, station_id) sorted by time
+        """
+        self.source = source
+        self.patterns = patterns
+        self.transfer_graph = transfer_graph
+        self.max_journey_time = max_journey_time
+        self.later_arrivals = {}
+        # station -> (arrival_time, rank, via) of the current departure
+        self.labels = {}
+
+    def _improve(self, station, arrival_time, rank, via):
+        # Witnesses win ties (lower rank), and so do later departures
+        if arrival_time >= self.later_arrivals.get(station, INFINITY):
+            return False
+        current = self.labels.get(station)
+        if current is not None and (current[0] < arrival_time or (current[0] == arrival_time and current[1] <= rank)):
+            return False
+        self.labels[station] = (arrival_time, rank, via)
+        return True
+
+    def departure_times(self):
+        departure_times = set()
+        for p, i in self.patterns.station_patterns.get(self.source, ()):
+            pattern = self.patterns[p]
+            if i < len(pattern.stops) - 1:
+                departure_times.update(pattern.scan_arrays()[0][i])
+        return sorted(departure_times, reverse=True)
+
+    def _scan_patterns(self, marked, round_number, departure_time, max_arrival_time):
+        """
+        One RAPTOR round by route patterns, with labels.
+        @marked - station -> (arrival_time, rank, via) of stations improved last round
+        returns station -> (arrival_time, rank, via) improved this round
+        Round 1 labels - a trip boarded at source at departure_time is a candidate, its via is the station we get off at.
+        Round 2 labels - via (v, w) of the station boarded at is carried on.
+        """
+        station_patterns = self.patterns.station_patterns
+        patterns_to_scan = {}
+        for station in marked:
+            for p, i in station_patterns.get(station, ()):
+                if p not in patterns_to_scan or i < patterns_to_scan[p]:
+                    patterns_to_scan[p] = i
+
+        improved = {}
+        for p, first_stop in patterns_to_scan.items():
+            pattern = self.patterns[p]
+            departures_by_stop, arrivals_by_trip = pattern.scan_arrays()
+            stops = pattern.stops
+            last_stop = len(stops) - 1
+            num_trips = len(pattern.trip_ids)
+            trip = num_trips
+            trip_arrivals = None
+            trip_rank, trip_via = WITNESS, None
+            for i in range(first_stop, len(stops)):
+                station = stops[i]
+                if trip_arrivals is not None:
+                    arrival_time = trip_arrivals[i]
+                    if arrival_time > max_arrival_time:
+                        trip = num_trips
+                        trip_arrivals = None
+                    else:
+                        via = station if trip_rank == CANDIDATE and round_number == 1 else trip_via
+                        if self._improve(station, arrival_time, trip_rank, via):
+                            improved[station] = self.labels[station]
+
+                if i == last_stop or station not in marked:
+                    continue
+                st_arrival_time, rank, via = marked[station]
+                departures = departures_by_stop[i]
+                earliest_trip = bisect_left(departures, st_arrival_time, 0, min(trip + 1, num_trips))
+                if earliest_trip >= num_trips or departures[earliest_trip] > max_arrival_time:
+                    continue
+                if round_number == 1 and station == self.source:
+                    rank = CANDIDATE if departures[earliest_trip] == departure_time else WITNESS
+                # switch to an earlier trip, or to the same trip with a witness label (it gets everywhere as early)
+                if earliest_trip < trip or (earliest_trip == trip and rank < trip_rank):
+                    trip = earliest_trip
+                    trip_arrivals = arrivals_by_trip[trip]
+                    trip_rank, trip_via = rank, via
+        return improved
+
+    def _relax_transfers(self, improved, round_number, max_arrival_time):
+        """
+        Walk from stations improved this round. After round 1 a candidate walking from v to w becomes (v, w).
+        returns improved, with the stations reached by walking added
+        """
+        result = dict(improved)
+        for station, (arrival_time, rank, via) in improved.items():
+            if self.labels[station][0] < arrival_time:
+                # improved again by a walk from another station, which is relaxed on its own
+                continue
+            candidate_transfer = round_number == 1 and rank == CANDIDATE
+            if candidate_transfer:
+                # boarding again where we got off - no walk, not a shortcut
+                result[station] = (arrival_time, rank, (station, station))
+            for walking_time, target in self.transfer_graph.get(station, ()):
+                new_time = arrival_time + walking_time
+                if new_time > max_arrival_time:
+                    break
+                if self._improve(target, new_time, rank, (station, target) if candidate_transfer else via):
+                    result[target] = self.labels[target]
+        return result
+
+    def run(self):
+        """
+        returns the set of (v, w) shortcuts of journeys starting at source
+        """
+        shortcuts = set()
+        for departure_time in self.departure_times():
+            max_arrival_time = departure_time + self.max_journey_time
+            self.labels = {self.source: (departure_time, WITNESS, None)}
+            marked = self._relax_transfers({self.source: self.labels[self.source]}, 0, max_arrival_time)
+            for round_number in (1, 2):
+                improved = self._scan_patterns(marked, round_number, departure_time, max_arrival_time)
+                marked = self._relax_transfers(improved, round_number, max_arrival_time)
+            # stations improved by round 2 and its transfers - their labels rode a trip boarded after the (v, w) walk
+            for station in marked:
+                arrival_time, rank, via = self.labels[station]
+                if rank == CANDIDATE and isinstance(via, tuple) and via[0] != via[1]:
+                    shortcuts.add(via)
+            for station, (arrival_time, rank, via) in self.labels.items():
+                self.later_arrivals[station] = arrival_time
+        return shortcuts
+
+
+def _transfer_lists(transfer_graph):
+    # footpath dicts to (time, station_id) tuples, the search reads them millions of times
+    return {station_id: [(f["time"], f["station_id"]) for f in footpaths] for station_id, footpaths in transfer_graph.items()}
+
+
+def station_shortcuts(source):
+    """
+    returns the set of (v, w) shortcuts of journeys starting at source
+    """
+    return ShortcutSearch(source, _patterns, _transfer_graph, _max_journey_time).run()
+
+
+def run_sources(sources):
+    """
+    returns (set of shortcuts of the sources, number of sources, seconds). Runs in a pool worker (or inline with one worker).
+    """
+    start = time.perf_counter()
+    shortcuts = set()
+    for source in sources:
+        shortcuts |= station_shortcuts(source)
+    return shortcuts, len(sources), time.perf_counter() - start
+
+
+def build_transfer_graph(tt, max_transfer_distance=DEFAULT_MAX_TRANSFER_DISTANCE, workers=1, folder=None, walking_engine=None):
+    """
+    Station to station walking up to max_transfer_distance KM - the walking of the shortcuts search.
+    @folder - footpath store folder (see footpath_pipeline.py), so an interrupted run resumes
+    """
+    # tiles of about the transfer distance, a tile's matrix calls target stations up to the transfer distance away anyway
+    return build_footpaths(tt.stations.values(), folder, tile_size=int(max_transfer_distance * 1000),
+                           max_walking_distance=max_transfer_distance, workers=workers, walking_engine=walking_engine)
+
+
+def compute_transfer_shortcuts(tt, transfer_graph=None, max_transfer_distance=DEFAULT_MAX_TRANSFER_DISTANCE,
+                               max_journey_time=DEFAULT_MAX_JOURNEY_TIME, workers=1, chunk_size=20, walking_engine=None,
+                               transfer_graph_folder=None):
+    """
+    @transfer_graph - station_id -> footpaths sorted by time, None to build one (build_transfer_graph)
+    @max_journey_time - seconds, see DEFAULT_MAX_JOURNEY_TIME
+    @workers - number of processes, sources are split to chunks of chunk_size stations
+    returns station_id -> shortcut footpaths sorted by time, in the format of tt.stations_footpaths
+    """
+    if transfer_graph is None:
+        transfer_graph = build_transfer_graph(tt, max_transfer_distance, workers, transfer_graph_folder, walking_engine)
+    patterns = tt.get_route_patterns()
+    sources = [station_id for station_id in tt.stations.keys() if station_id in patterns.station_patterns]
+    chunks = [sources[i:i + chunk_size] for i in range(0, len(sources), chunk_size)]
+
+    transfer_lists = _transfer_lists(transfer_graph)
+    shortcuts = set()
+    finished = 0
+    start = time.perf_counter()
+    def chunk_done(result):
+        nonlocal shortcuts, finished
+        chunk_shortcuts, num_sources, _ = result
+        shortcuts |= chunk_shortcuts
+        finished += num_sources
+        if finished % (chunk_size * 50) < num_sources or finished == len(sources):
+            print_log(f"shortcuts - {finished}/{len(sources)} stations, {len(shortcuts)} shortcuts, {time.perf_counter() - start:.1f} seconds")
+
+    if workers is None or workers <= 1:
+        global _patterns, _transfer_graph, _max_journey_time
+        previous = (_patterns, _transfer_graph, _max_journey_time)
+        _init_worker(patterns, transfer_lists, max_journey_time)
+        try:
+            for chunk in chunks:
+                chunk_done(run_sources(chunk))
+        finally:
+            _patterns, _transfer_graph, _max_journey_time = previous
+    else:
+        with Pool(workers, initializer=_init_worker, initargs=(patterns, transfer_lists, max_journey_time)) as pool:
+            for result in pool.imap_unordered(run_sources, chunks):
+                chunk_done(result)
+
+    by_station = {}
+    for v, w in shortcuts:
+        f = next(f for f in transfer_graph[v] if f["station_id"] == w)
+        by_station.setdefault(v, []).append(f)
+    for station_shortcut_list in by_station.values():
+        station_shortcut_list.sort(key=lambda x: x["time"])
+    num_footpaths = sum(len(f) for f in transfer_graph.values())
+    print_log(f"{len(shortcuts)} shortcuts out of {num_footpaths} transfer graph footpaths, {time.perf_counter() - start:.2f} seconds, {workers or 1} workers")
+    return by_station
+
+
+def _shortcuts_header(tt, max_transfer_distance, max_journey_time):
+    return {"format": TRANSFER_SHORTCUTS_FORMAT, "version": TRANSFER_SHORTCUTS_VERSION,
+            "max_transfer_distance": max_transfer_distance, "max_journey_time": max_journey_time,
+            "stations": _stations_fingerprint(tt.stations.values()), "num_trips": len(tt.trip_connections)}
+
+
+def save_transfer_shortcuts(shortcuts, path, header):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(dict(header, shortcuts=shortcuts), f)
+    os.replace(tmp_path, path)
+
+
+def load_transfer_shortcuts(path, tt=None):
+    """
+    @tt - if given, returns None when the file was made for other stations / trips
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        data = json.load(f)
+    if data.get("format") != TRANSFER_SHORTCUTS_FORMAT or data.get("version") != TRANSFER_SHORTCUTS_VERSION:
+        return None
+    if tt is not None and (data["stations"] != _stations_fingerprint(tt.stations.values()) or data["num_trips"] != len(tt.trip_connections)):
+        print_log(f"transfer shortcuts {path} were made for another timetable")
+        return None
+    return data["shortcuts"]
+
+
+def get_transfer_shortcuts(tt, path=TLV_TRANSFER_SHORTCUTS, reparse=False, max_transfer_distance=DEFAULT_MAX_TRANSFER_DISTANCE,
+                           max_journey_time=DEFAULT_MAX_JOURNEY_TIME, workers=None, walking_engine=None, transfer_graph_folder=TLV_TRANSFER_GRAPH_STORE):
+    """
+    Load the shortcuts of tt from path, or compute and save them.
+    @workers - None for all cores
+    """
+    shortcuts = None if reparse else load_transfer_shortcuts(path, tt)
+    if shortcuts is None:
+        workers = os.cpu_count() if workers is None else workers
+        shortcuts = compute_transfer_shortcuts(tt, max_transfer_distance=max_transfer_distance, max_journey_time=max_journey_time,
+                                               workers=workers, walking_engine=walking_engine, transfer_graph_folder=transfer_graph_folder)
+        save_transfer_shortcuts(shortcuts, path, _shortcuts_header(tt, max_transfer_distance, max_journey_time))
+    return shortcuts
+
+
+############################################################
+### TEST TRANSFER SHORTCUTS ################################
+############################################################
+
+def test_transfer_shortcuts(workers=4):
+    """
+    Compute the tlv shortcuts, and route the benchmark queries with them and with the 1km footpaths.
+    """
+    from codetiming import Timer
+    from connection_builder import get_tlv_timetable
+    from raptor_routing import run_ultra_wrapper, BENCHMARK_ODS
+    tt = get_tlv_timetable()
+    with Timer(text="[+] transfer shortcuts took {:.4f} seconds..."):
+        shortcuts = get_transfer_shortcuts(tt, reparse=True, workers=workers)
+    print_log(f"{sum(len(s) for s in shortcuts.values())} shortcuts from {len(shortcuts)} stations, "
+              f"{sum(len(f) for f in tt.stations_footpaths.values())} footpaths from {len(tt.stations_footpaths)} stations")
+
+    for start_loc, end_loc, start_time in BENCHMARK_ODS:
+        results = {}
+        for name, transfer_shortcuts in (("footpaths", None), ("shortcuts", shortcuts)):
+            # run_ultra_wrapper routes on tt.for_query(), so both queries share tt
+            with Timer(text="[+] " + name + " query took {:.4f} seconds..."):
+                results[name] = run_ultra_wrapper(start_loc, end_loc, start_time, tt, transfer_shortcuts=transfer_shortcuts)
+        arrivals = {name: min((r.arrival_time for r in res), default=None) if res else None for name, res in results.items()}
+        print_log(f"{start_time} - earliest arrival with footpaths {arrivals['footpaths']}, with shortcuts {arrivals['shortcuts']}")
+
+
+def main():
+    test_transfer_shortcuts()
+
+if __name__ == "__main__":
+    main()
@@ -70,7 +70,15 @@ def time_text_to_int(time_text):
     return (int(h) * 60 + int(m)) * 60 + int(s)
 
 def time_int_to_text(seconds):
-    return time.strftime('%H:%M:%S', time.gmtime(seconds))
+    # Unlike time.strftime this keeps GTFS times past midnight as 24:xx:xx and not 00:xx:xx
+    seconds = int(seconds)
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+def time_to_int(t):
+    # Times are kept as int seconds from the start of the service day, but user facing APIs still get "hh:mm:ss" text.
+    if type(t) == str:
+        return time_text_to_int(t)
+    return int(t)
 
 
 
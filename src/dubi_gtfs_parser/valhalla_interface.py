@@ -13,20 +13,25 @@ class ValhallaActor():
             cls.instance = super(ValhallaActor, cls).__new__(cls)
         return cls.instance
     
-    def init_actor(self, tt):
+    def init_actor(self, tt, num_stations=None):
+        """
+        @num_stations - size the matrix limits by this instead of len(tt.stations) (workers which don't have the timetable)
+        """
+        if num_stations is None:
+            num_stations = len(tt.stations)
         config = valhalla.get_config(tile_extract=os.path.join(VALHALLA_FOLDER,'./custom_files/valhalla_tiles.tar'), verbose=True)
         # TODO: figure out why changing this in json doesn't work
 
         
 
         # config["service_limits"]["pedestrian"]["max_matrix_location_pairs"] = len(tt.stations)*2 + 100 # pad another 100 just to be sure
-        config["service_limits"]["pedestrian"]["max_matrix_location_pairs"] = len(tt.stations)*3 + 100  # pad another 100 just to be sure
-        config["service_limits"]["auto"]["max_matrix_location_pairs"] = len(tt.stations)*2 + 100  # pad another 100 just to be sure
+        config["service_limits"]["pedestrian"]["max_matrix_location_pairs"] = num_stations*3 + 100  # pad another 100 just to be sure
+        config["service_limits"]["auto"]["max_matrix_location_pairs"] = num_stations*2 + 100  # pad another 100 just to be sure
         self.actor = valhalla.Actor(config)
 
     
-def get_actor(tt):
+def get_actor(tt, num_stations=None):
     va = ValhallaActor()
     if va.actor is None:
-        va.init_actor(tt)
+        va.init_actor(tt, num_stations)
     return va.actor
\ No newline at end of file
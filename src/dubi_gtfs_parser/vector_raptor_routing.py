@@ -0,0 +1,375 @@
+import random
+import time
+
+import numpy as np
+
+from utils import time_to_int, FOOTPATH_ID, print_log
+from connection_builder import Connection, TripView, get_tlv_timetable
+from raptor_routing import raptor_route, run_ultra_wrapper, result_route_key, BENCHMARK_ODS, UNREACHABLE_WALKING_TIME, MAX_ROUNDS, INITIAL_ARRIVAL_TIME
+from pattern_raptor_routing import PatternScanner
+
+# RAPTOR rounds as NumPy array arithmetic (select it with run_ultra_wrapper(..., engine=vector_raptor_route)).
+# Labels are arrays indexed by dense station id (tt.get_dense_stations()), and a round scans every route pattern at once:
+#   all "route stops" (pattern, stop position) are laid out one after the other, pattern by pattern, and
+#   1. the earliest trip each route stop can board is one searchsorted - columns of departures are sorted (no overtaking),
+#      so they are flattened with the route stop in the high bits of the key.
+#   2. the trip ridden at each stop is the earliest trip boarded at an earlier stop of the pattern - a minimum.accumulate,
+#      with a key per pattern that is bigger than any key of a later pattern, so it starts over at every pattern.
+#   3. arrival times of those trips are min-reduced per station.
+# Walking between rounds (footpaths / transfer shortcuts) is the same with the footpaths as flat edge arrays.
+# The rounds and results follow raptor_route with PatternScanner, so the results are comparable. Pruning doesn't -
+# raptor_route lowers the target arrival time as soon as a label reaches a target, and prunes the rest of the round's scan with it.
+# Here the target arrival time is updated once per round, after the scan (the round's walks already use it), so a scan
+# prunes with the previous rounds' target and keeps labels raptor_route would have dropped - more work, same results.
+
+INFINITY = np.int64(2**40)
+SOURCE = 1
+TRIP = 2
+WALK = 3
+
+
+class VectorPatterns(object):
+    """
+    The route patterns of a timetable as flat arrays over route stops, by dense station id.
+    get_vector_patterns(tt) builds them once per patterns (a timetable, or a service day).
+    """
+    def __init__(self, patterns, dense_stations):
+        self.patterns = patterns
+        num_route_stops = sum(len(pattern.stops) for pattern in patterns.patterns)
+        max_trips = max((len(pattern) for pattern in patterns.patterns), default=0)
+        max_stops = max((len(pattern.stops) for pattern in patterns.patterns), default=0)
+        self.stop_key_size = np.int64(max_stops + 1)
+        self.pattern_key_size = np.int64(max_trips + 1) * self.stop_key_size
+
+        self.station = np.empty(num_route_stops, dtype=np.int64)
+        self.pattern = np.empty(num_route_stops, dtype=np.int64)
+        self.position = np.empty(num_route_stops, dtype=np.int64)
+        self.num_trips = np.empty(num_route_stops, dtype=np.int64)
+        # where the column of the route stop starts in the flat arrays - trip t of it is at offset + t
+        self.offset = np.empty(num_route_stops, dtype=np.int64)
+        self.pattern_key = np.empty(num_route_stops, dtype=np.int64)
+        departures = []
+        arrivals = []
+        rs = 0
+        flat_size = 0
+        num_patterns = len(patterns)
+        for p, pattern in enumerate(patterns.patterns):
+            num_stops = len(pattern.stops)
+            self.station[rs:rs + num_stops] = [dense_stations.index(station_id) for station_id in pattern.stops]
+            self.pattern[rs:rs + num_stops] = p
+            self.position[rs:rs + num_stops] = np.arange(num_stops)
+            self.num_trips[rs:rs + num_stops] = len(pattern)
+            self.offset[rs:rs + num_stops] = flat_size + np.arange(num_stops) * len(pattern)
+            # earlier patterns get bigger keys, so a minimum.accumulate doesn't carry into the next pattern
+            self.pattern_key[rs:rs + num_stops] = (num_patterns - 1 - p) * self.pattern_key_size
+            departures.append(np.ascontiguousarray(pattern.departures.T).ravel())
+            arrivals.append(np.ascontiguousarray(pattern.arrivals.T).ravel())
+            rs += num_stops
+            flat_size += num_stops * len(pattern)
+        self.departures = np.concatenate(departures).astype(np.int64) if departures else np.empty(0, dtype=np.int64)
+        self.arrivals = np.concatenate(arrivals).astype(np.int64) if arrivals else np.empty(0, dtype=np.int64)
+        # sorted search keys - route stop in the high bits, departure in the low ones
+        self.departure_keys = np.repeat(np.arange(num_route_stops, dtype=np.int64), self.num_trips) << 32 | self.departures
+        self.first_stop = self.position == 0
+        self.num_stations = len(dense_stations)
+        self._transfers = {}
+
+    def __len__(self):
+        return len(self.station)
+
+    def transfer_edges(self, transfers, limit_mid_walking_time, dense_stations):
+        """
+        returns (from, to, time) int64 arrays of the footpaths, sorted by from station
+        """
+        key = (id(transfers), limit_mid_walking_time)
+        if key not in self._transfers:
+            edges = [(dense_stations.index(station_id), dense_stations.index(f["station_id"]), f["time"])
+                     for station_id, footpaths in transfers.items() for f in footpaths if f["time"] <= limit_mid_walking_time]
+            edges = np.array(sorted(edges), dtype=np.int64).reshape(-1, 3)
+            # transfers is kept so its id isn't reused by another dict
+            self._transfers[key] = (transfers, (edges[:, 0], edges[:, 1], edges[:, 2]))
+        return self._transfers[key][1]
+
+    def __repr__(self):
+        return f"VectorPatterns({len(self.patterns)} patterns, {len(self)} route stops, {len(self.departures)} stop times)"
+
+
+def get_vector_patterns(tt):
+    patterns = tt.get_route_patterns()
+    vector_patterns = getattr(patterns, "_vector_patterns", None)
+    if vector_patterns is None:
+        vector_patterns = VectorPatterns(patterns, tt.get_dense_stations())
+        patterns._vector_patterns = vector_patterns
+    return vector_patterns
+
+
+class VectorRaptorSearch(object):
+    """
+    Labels of one query - the best arrival of every station (visited_stations of raptor_route) and how it was reached.
+    """
+    def __init__(self, tt, vector_patterns, start_time):
+        self.tt = tt
+        self.vp = vector_patterns
+        self.dense_stations = tt.get_dense_stations()
+        num_stations = len(self.dense_stations)
+        self.start_time = start_time
+        self.arrival = np.full(num_stations, INFINITY, dtype=np.int64)
+        self.kind = np.zeros(num_stations, dtype=np.int8)
+        # TRIP - route stop we got off at, the route stop we boarded at and the trip's row in the pattern.
+        # WALK - station we walked from, and the walk's departure.
+        self.parent = np.full(num_stations, -1, dtype=np.int64)
+        self.parent_info = np.full(num_stations, -1, dtype=np.int64)
+        self.trip = np.full(num_stations, -1, dtype=np.int64)
+
+    def scan(self, marked, max_time_threshold, current_target_arrival_time):
+        """
+        One round - ride patterns from the stations in marked (arrival time, INFINITY if not marked).
+        returns (stations improved, their arrival times)
+        """
+        vp = self.vp
+        board_time = marked[vp.station]
+        can_board = (board_time <= max_time_threshold) & (board_time >= self.start_time)
+        # number of trips of the column departing before we are there = the earliest trip we can board
+        trip = np.searchsorted(vp.departure_keys, np.arange(len(vp), dtype=np.int64) << 32 | np.where(can_board, board_time, 0)) - vp.offset
+        valid = can_board & (trip < vp.num_trips)
+        valid[valid] &= vp.departures[vp.offset[valid] + trip[valid]] <= max_time_threshold
+        board_key = vp.pattern_key + np.where(valid, trip * vp.stop_key_size + vp.position, vp.pattern_key_size - 1)
+        ridden = np.minimum.accumulate(board_key)
+        # a stop rides what was boarded at an earlier stop
+        ridden = np.concatenate(([vp.pattern_key_size * len(vp.patterns)], ridden[:-1]))
+        ridden_trip, board_position = np.divmod(ridden - vp.pattern_key, vp.stop_key_size)
+        riding = (ridden_trip < vp.num_trips) & ~vp.first_stop
+        arrival = np.full(len(vp), INFINITY, dtype=np.int64)
+        arrival[riding] = vp.arrivals[vp.offset[riding] + ridden_trip[riding]]
+        arrival[(arrival >= current_target_arrival_time) | (arrival < self.start_time)] = INFINITY
+
+        improving = np.nonzero(arrival < self.arrival[vp.station])[0]
+        if len(improving) == 0:
+            return improving, improving
+        # the earliest arrival of each station
+        order = np.lexsort((arrival[improving], vp.station[improving]))
+        stations, first = np.unique(vp.station[improving[order]], return_index=True)
+        chosen = improving[order[first]]
+        self.arrival[stations] = arrival[chosen]
+        self.kind[stations] = TRIP
+        self.parent[stations] = chosen
+        self.parent_info[stations] = chosen - vp.position[chosen] + board_position[chosen]
+        self.trip[stations] = ridden_trip[chosen]
+        return stations, arrival[chosen]
+
+    def relax(self, stations, arrivals, edges, max_time_threshold, current_target_arrival_time):
+        """
+        Walk from stations (improved by trips this round).
+        returns (stations improved by walking, their arrival times)
+        """
+        edge_from, edge_to, edge_time = edges
+        if len(stations) == 0 or len(edge_from) == 0:
+            return stations[:0], arrivals[:0]
+        # edges of the improved stations - they are sorted by from station
+        starts = np.searchsorted(edge_from, stations)
+        ends = np.searchsorted(edge_from, stations, side="right")
+        counts = ends - starts
+        edge_idx = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        walk_from = np.repeat(stations, counts)
+        walk_departure = np.repeat(arrivals, counts)
+        new_time = walk_departure + edge_time[edge_idx]
+        to = edge_to[edge_idx]
+        ok = (new_time < current_target_arrival_time) & (new_time <= max_time_threshold) & (new_time < self.arrival[to])
+        if not ok.any():
+            return stations[:0], arrivals[:0]
+        new_time, to, walk_from, walk_departure = new_time[ok], to[ok], walk_from[ok], walk_departure[ok]
+        order = np.lexsort((new_time, to))
+        targets, first = np.unique(to[order], return_index=True)
+        chosen = order[first]
+        self.arrival[targets] = new_time[chosen]
+        self.kind[targets] = WALK
+        self.parent[targets] = walk_from[chosen]
+        self.parent_info[targets] = walk_departure[chosen]
+        return targets, new_time[chosen]
+
+    def trace(self, station, start_station, end_station, egress_time, source_trip_ids, target_trip_ids):
+        """
+        returns the result route (like raptor_route's) of getting off at station and walking to the end
+        """
+        station_id = self.dense_stations.station_id(station)
+        arrival_time = int(self.arrival[station])
+        result_route = [(end_station, [Connection(station_id, end_station, arrival_time, arrival_time + int(egress_time),
+                                                  target_trip_ids.get(station_id, FOOTPATH_ID))])]
+        while station_id != start_station:
+            kind = self.kind[station]
+            if kind == TRIP:
+                alight = self.parent[station]
+                board = self.parent_info[station]
+                pattern = self.vp.patterns[int(self.vp.pattern[alight])]
+                trip_id = pattern.trip_ids[int(self.trip[station])]
+                connections = TripView(self.tt.trip_connections[trip_id], int(self.vp.position[board]), int(self.vp.position[alight]))
+                previous = int(self.vp.station[board])
+            elif kind == WALK:
+                previous = int(self.parent[station])
+                connections = [Connection(self.dense_stations.station_id(previous), station_id, int(self.parent_info[station]), int(self.arrival[station]), FOOTPATH_ID)]
+            else:
+                previous = self.dense_stations.index(start_station)
+                connections = [Connection(start_station, station_id, self.start_time, int(self.arrival[station]), source_trip_ids.get(station_id, FOOTPATH_ID))]
+            result_route.insert(0, (station_id, connections))
+            station = previous
+            station_id = self.dense_stations.station_id(station)
+        return result_route
+
+
+def vector_raptor_route(start_station, end_station, start_time, tt, end_footpath_connections=None, relax_footpaths=True, limit_walking_time=1* 60 * 60,
+                        limit_mid_walking_time= 60*6, debug=False, scanner=None, transfer_shortcuts=None, sources=None, targets=None,
+                        source_trip_ids=None, target_trip_ids=None):
+    """
+    raptor_route with array labels and batch pattern scans - same parameters and results (scanner is ignored, it always scans by patterns).
+    """
+    source_trip_ids = source_trip_ids or {}
+    target_trip_ids = target_trip_ids or {}
+    vp = get_vector_patterns(tt)
+    dense_stations = tt.get_dense_stations()
+    # walking stations of the query get their ids now
+    dense_stations.sync()
+    num_stations = len(dense_stations)
+    start_time_int = time_to_int(start_time)
+    search = VectorRaptorSearch(tt, vp, start_time_int)
+
+    # stations_to_end of raptor_route
+    stations_to_end = np.full(num_stations, UNREACHABLE_WALKING_TIME, dtype=np.int64)
+    if end_footpath_connections is not None:
+        for s_to_t in end_footpath_connections["sources_to_targets"]:
+            if s_to_t[0]["time"] is not None:
+                stations_to_end[s_to_t[0]["from_index"]] = s_to_t[0]["time"]
+    if targets is not None:
+        for station_id, egress_time in targets.items():
+            idx = dense_stations.index(station_id)
+            stations_to_end[idx] = min(egress_time, stations_to_end[idx])
+
+    start = dense_stations.index(start_station)
+    search.arrival[start] = start_time_int
+    marked = np.full(num_stations, INFINITY, dtype=np.int64)
+    if sources is None:
+        marked[start] = start_time_int
+        new_stations = new_arrivals = np.empty(0, dtype=np.int64)
+    else:
+        # Round 0 has nothing to scan, the sources are the stations it reached
+        source_stations = np.array([dense_stations.index(station_id) for station_id in sources], dtype=np.int64)
+        source_arrivals = np.array(list(sources.values()), dtype=np.int64)
+        ok = (source_arrivals >= start_time_int) & (source_arrivals < search.arrival[source_stations])
+        new_stations, new_arrivals = source_stations[ok], source_arrivals[ok]
+        search.arrival[new_stations] = new_arrivals
+        search.kind[new_stations] = SOURCE
+
+    edges = None
+    if relax_footpaths:
+        transfers = tt.stations_footpaths if transfer_shortcuts is None else transfer_shortcuts
+        edges = vp.transfer_edges(transfers, limit_mid_walking_time if transfer_shortcuts is None else INFINITY, dense_stations)
+
+    # The best arrival to the end only prunes from the next round - a batch scan has no order to update it in
+    current_target_arrival_time = INITIAL_ARRIVAL_TIME
+    total_result_routes = []
+    for r in range(MAX_ROUNDS):
+        if current_target_arrival_time != INITIAL_ARRIVAL_TIME:
+            max_time_threshold = current_target_arrival_time
+        else:
+            max_time_threshold = stations_to_end[start] + start_time_int + limit_walking_time
+        if r > 0 or sources is None:
+            new_stations, new_arrivals = search.scan(marked, max_time_threshold, current_target_arrival_time)
+
+        round_res_routes = []
+        can_walk = stations_to_end[new_stations] < limit_walking_time
+        if can_walk.any():
+            walking_arrivals = np.where(can_walk, new_arrivals + stations_to_end[new_stations], INFINITY)
+            best = int(np.argmin(walking_arrivals))
+            if walking_arrivals[best] < current_target_arrival_time:
+                round_res_routes.append(search.trace(int(new_stations[best]), start_station, end_station, stations_to_end[new_stations[best]],
+                                                     source_trip_ids, target_trip_ids))
+                current_target_arrival_time = int(walking_arrivals[best])
+        total_result_routes.append(round_res_routes)
+
+        marked = np.full(num_stations, INFINITY, dtype=np.int64)
+        marked[new_stations] = new_arrivals
+        if edges is not None:
+            walked, walked_arrivals = search.relax(new_stations, new_arrivals, edges, max_time_threshold, current_target_arrival_time)
+            marked[walked] = walked_arrivals
+        if debug:
+            print(f"round {r} - {len(new_stations)} stations by trips, {np.count_nonzero(marked < INFINITY)} marked")
+        if not (marked < INFINITY).any():
+            # like raptor_route, stop once a round marks no stations
+            total_result_routes.extend([] for _ in range(r + 1, MAX_ROUNDS))
+            break
+    return total_result_routes
+
+
+############################################################
+### TEST VECTOR RAPTOR #####################################
+############################################################
+
+def _best_arrivals(result_routes):
+    # round -> arrival time of its result
+    return {r: result[0][-1][1][-1].arrival_time for r, result in enumerate(result_routes) if len(result) > 0}
+
+def test_vector_raptor(ods=BENCHMARK_ODS, limit_walking_time=60*15, repeat=3):
+    """
+    Benchmark on TLV - the benchmark ODs with PatternScanner and with vector_raptor_route, compare the results.
+    returns True if the results arrive at the same times
+    """
+    tt = get_tlv_timetable()
+    get_vector_patterns(tt)
+    same = True
+    pattern_time = vector_time = 0
+    for start_loc, end_loc, start_time in ods:
+        # mapped timetables materialize stations on first use, don't time that
+        run_ultra_wrapper(start_loc, end_loc, start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner)
+        for _ in range(repeat):
+            query_start = time.perf_counter()
+            pattern_results = run_ultra_wrapper(start_loc, end_loc, start_time, tt, limit_walking_time=limit_walking_time, scanner=PatternScanner)
+            pattern_time += time.perf_counter() - query_start
+            query_start = time.perf_counter()
+            vector_results = run_ultra_wrapper(start_loc, end_loc, start_time, tt, limit_walking_time=limit_walking_time, engine=vector_raptor_route)
+            vector_time += time.perf_counter() - query_start
+        if [r.arrival_time for r in pattern_results] != [r.arrival_time for r in vector_results]:
+            same = False
+            print(f"    [!] {start_time} - different results:")
+            for r in pattern_results:
+                print("    patterns -", r)
+            for r in vector_results:
+                print("    vector   -", r)
+        elif [result_route_key(r.result_route) for r in pattern_results] != [result_route_key(r.result_route) for r in vector_results]:
+            print(f"    {start_time} - same arrival times, different journeys")
+    num_queries = repeat * len(ods)
+    print_log(f"tlv - patterns scan {pattern_time / num_queries * 1000:.2f} ms, vector {vector_time / num_queries * 1000:.2f} ms per query (with walking)")
+    return same
+
+def test_vector_raptor_nationwide(num_queries=50, start_time="08:00:00", seed=0):
+    """
+    Benchmark on the whole country - random station to station queries, without walking (footpaths aren't built nationwide).
+    returns True if PatternScanner and vector_raptor_route arrive at the same times
+    """
+    from connection_builder import Timetable
+    from parse_gtfs import get_is_gtfs
+    rng = random.Random(seed)
+    tt = Timetable(get_is_gtfs(), build_footpaths=False)
+    tt.get_route_patterns()
+    get_vector_patterns(tt)
+    station_ids = [station_id for station_id in tt.stations if station_id in tt.get_route_patterns().station_patterns]
+    same = True
+    pattern_time = vector_time = 0
+    for _ in range(num_queries):
+        start_station, end_station = rng.sample(station_ids, 2)
+        query_start = time.perf_counter()
+        pattern_results = raptor_route(start_station, end_station, start_time, tt, relax_footpaths=False, scanner=PatternScanner, targets={end_station: 0})
+        pattern_time += time.perf_counter() - query_start
+        query_start = time.perf_counter()
+        vector_results = vector_raptor_route(start_station, end_station, start_time, tt, relax_footpaths=False, targets={end_station: 0})
+        vector_time += time.perf_counter() - query_start
+        if _best_arrivals(pattern_results) != _best_arrivals(vector_results):
+            same = False
+            print(f"    [!] {start_station} -> {end_station} - {_best_arrivals(pattern_results)} / {_best_arrivals(vector_results)}")
+    print_log(f"nationwide - patterns scan {pattern_time / num_queries * 1000:.2f} ms, vector {vector_time / num_queries * 1000:.2f} ms per query")
+    return same
+
+
+def main():
+    test_vector_raptor()
+
+if __name__ == "__main__":
+    main()
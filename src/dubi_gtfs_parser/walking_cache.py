@@ -0,0 +1,262 @@
+import hashlib
+import math
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from utils import ARTIFACTS_FOLDER, print_log
+from station_index import METERS_PER_DEGREE
+
+# Caches of access (origin -> stations) and egress (stations -> destination) walking, used by RaptorRouter.
+# Origins and destinations are snapped to a grid of cell_size meters and walking is asked from / to the cell's center,
+# so every query from the same cell hits - at most cell_size / sqrt(2) meters off, about 15 seconds of walking for 30m cells.
+# Access and egress are cached apart, a new destination still hits the access cache of a known origin.
+#
+# Each cache has a memory LRU tier and an optional disk tier (a folder of pickles, one per key).
+# The disk tier is bounded by size - least recently used files (by mtime, touched on every hit) are deleted first.
+# Its size is taken from the folder on every put, processes sharing the folder all write to it.
+# A cache is shared by every RaptorRouter of the process, so its memory tier and counters are changed under its lock.
+# hits / misses / evictions are counted per cache, see WalkingCache.stats and walking_cache_stats.
+
+DEFAULT_CELL_SIZE = 30 # meters
+DEFAULT_MAX_ENTRIES = 2048
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+WALKING_CACHE_FOLDER = os.path.join(ARTIFACTS_FOLDER, "walking_cache")
+
+# get's default, values can be None
+_MISSING = object()
+
+
+def snap_location(location, cell_size=DEFAULT_CELL_SIZE):
+    """
+    @location - {"lat", "lon"} (text or float)
+    returns ((row, col) of the grid cell, {"lat", "lon"} of the cell's center)
+    """
+    lat, lon = float(location["lat"]), float(location["lon"])
+    cell_dlat = cell_size / METERS_PER_DEGREE
+    row = math.floor(lat / cell_dlat)
+    center_lat = (row + 0.5) * cell_dlat
+    # columns of a row are cell_size meters wide at the row's center
+    cell_dlon = cell_size / (METERS_PER_DEGREE * math.cos(math.radians(center_lat)))
+    col = math.floor(lon / cell_dlon)
+    return (row, col), {"lat": center_lat, "lon": (col + 0.5) * cell_dlon}
+
+
+class WalkingCache(object):
+    """
+    LRU cache with a memory tier and an optional disk tier.
+    Keys are tuples of str / int / float, values anything picklable.
+    """
+    def __init__(self, name, max_entries=DEFAULT_MAX_ENTRIES, folder=None, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        """
+        @max_entries - of the memory tier
+        @folder - disk tier folder, None for memory only
+        @max_disk_bytes - the disk tier deletes least recently used files above this
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.folder = folder
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self._disk_bytes = 0
+        self._lock = threading.RLock()
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    def _file(self, key):
+        return os.path.join(self.folder, hashlib.sha1(repr(key).encode()).hexdigest() + ".pkl")
+
+    def _disk_entries(self):
+        # (path, size, mtime) of the files in the folder, skipping ones another process deleted meanwhile
+        entries = []
+        for entry in os.scandir(self.folder):
+            if not entry.name.endswith(".pkl"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._memory.get(key, _MISSING)
+            if value is not _MISSING:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return value
+        if self.folder is not None:
+            path = self._file(key)
+            try:
+                with open(path, "rb") as f:
+                    stored_key, value = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                stored_key = None
+            if stored_key == key:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    # evicted by another process after we read it
+                    pass
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put_memory(key, value)
+                return value
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def _put_memory(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+                self.memory_evictions += 1
+
+    def put(self, key, value):
+        self._put_memory(key, value)
+        if self.folder is None:
+            return
+        path = self._file(key)
+        # a temp file per process and thread, so writers of the same key don't mix their bytes
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        with self._lock:
+            # other processes write to the folder too, so its size is counted from the folder and not kept
+            entries = self._disk_entries()
+            self._disk_bytes = sum(size for _, size, _ in entries)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk(entries, keep=path)
+
+    def _evict_disk(self, entries, keep=None):
+        # least recently used first, down to 90% of the limit so it doesn't run on every put
+        for entry_path, size, _ in sorted(entries, key=lambda e: e[2]):
+            if self._disk_bytes <= self.max_disk_bytes * 0.9:
+                break
+            if entry_path == keep:
+                continue
+            try:
+                os.remove(entry_path)
+                self.disk_evictions += 1
+            except FileNotFoundError:
+                # another process evicted it
+                pass
+            self._disk_bytes -= size
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+            if disk and self.folder is not None:
+                for entry_path, _, _ in self._disk_entries():
+                    try:
+                        os.remove(entry_path)
+                    except FileNotFoundError:
+                        pass
+                self._disk_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {"name": self.name, "memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+                    "memory_entries": len(self._memory), "memory_evictions": self.memory_evictions,
+                    "disk_bytes": self._disk_bytes, "disk_evictions": self.disk_evictions}
+
+    def __repr__(self):
+        stats = self.stats()
+        return (f"WalkingCache({self.name}: {stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, {stats['misses']} misses, "
+                f"{stats['memory_entries']} entries, {stats['disk_bytes'] / 1024:.0f}KB on disk)")
+
+
+class WalkingCaches(object):
+    """
+    The access and egress caches, and the grid they snap to.
+    """
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE, max_entries=DEFAULT_MAX_ENTRIES, folder=None, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        """
+        @folder - disk tier, access and egress get a sub folder each. None for memory only.
+        @max_disk_bytes - per cache
+        """
+        self.cell_size = cell_size
+        self.access = WalkingCache("access", max_entries, None if folder is None else os.path.join(folder, "access"), max_disk_bytes)
+        self.egress = WalkingCache("egress", max_entries, None if folder is None else os.path.join(folder, "egress"), max_disk_bytes)
+
+    def snap(self, location):
+        return snap_location(location, self.cell_size)
+
+    def stats(self):
+        return {"access": self.access.stats(), "egress": self.egress.stats()}
+
+    def __repr__(self):
+        return f"WalkingCaches({self.cell_size}m cells, {self.access}, {self.egress})"
+
+
+_walking_caches = None
+_walking_caches_lock = threading.Lock()
+
+def get_walking_caches():
+    """
+    The process wide caches RaptorRouter uses by default, with the disk tier in WALKING_CACHE_FOLDER.
+    """
+    global _walking_caches
+    with _walking_caches_lock:
+        if _walking_caches is None:
+            _walking_caches = WalkingCaches(folder=WALKING_CACHE_FOLDER)
+    return _walking_caches
+
+def walking_cache_stats():
+    return get_walking_caches().stats()
+
+
+############################################################
+### TEST WALKING CACHE #####################################
+############################################################
+
+def test_walking_cache(num_queries=40, spread=60, seed=0):
+    """
+    Queries from random points around the benchmark origins / destinations (spread meters), with a memory only cache.
+    Prints the hit rates and how far the snapped walking times are from the exact ones.
+    """
+    import random
+    from codetiming import Timer
+    from connection_builder import get_tlv_timetable
+    from raptor_routing import RaptorRouter, BENCHMARK_ODS
+    rng = random.Random(seed)
+    tt = get_tlv_timetable()
+    caches = WalkingCaches()
+    router = RaptorRouter(tt, walking_caches=caches)
+    exact_router = RaptorRouter(tt, walking_caches=WalkingCaches(cell_size=0.01))
+
+    def jitter(location):
+        return {"lat": float(location["stop_lat"]) + rng.uniform(-spread, spread) / METERS_PER_DEGREE,
+                "lon": float(location["stop_lon"]) + rng.uniform(-spread, spread) / METERS_PER_DEGREE}
+
+    differences = []
+    with Timer(text="[+] " + str(num_queries) + " access / egress lookups took {:.4f} seconds..."):
+        for q in range(num_queries):
+            start_loc, end_loc, _ = BENCHMARK_ODS[q % len(BENCHMARK_ODS)]
+            start, end = jitter(start_loc), jitter(end_loc)
+            start_to_st, _ = router._get_walking_start_end_results(start, end)
+            exact_start_to_st, _ = exact_router._get_walking_start_end_results(start, end)
+            exact = {f["to_index"]: f["time"] for f in exact_start_to_st}
+            differences += [abs(f["time"] - exact[f["to_index"]]) for f in start_to_st if f["to_index"] in exact and f["to_index"] != 0]
+    print_log(caches)
+    print_log(f"snapped access walking times are off by {sum(differences) / max(len(differences), 1):.1f} seconds on average, {max(differences, default=0)} at most")
+
+
+def main():
+    test_walking_cache()
+
+if __name__ == "__main__":
+    main()